@@ -0,0 +1,241 @@
+import os
+import json
+import shutil
+import numpy as np
+from array import array
+from typing import Any, Iterable, Iterator
+
+META = 'meta.json'
+EXTENSION = '.col'
+DICT_COLUMNS = ('instruction',)     # the str columns that are dictionary-encoded, list of str columns are always encoded
+
+def is_columnar(path: str) -> bool:
+    return path.rstrip('/').endswith(EXTENSION) or os.path.exists(os.path.join(path, META))
+
+class ColumnarWriter:
+    ''' This is a writer of the columnar dataset, a directory of column files and a meta.json. '''
+    def __init__(self, path: str, dict_columns: tuple = DICT_COLUMNS, rows: int = None):
+        '''
+        Usage:
+            Create or append to a columnar dataset. Each key of the records is a column:
+                dict: a str column in dict_columns, e.g. instruction, each row is the id in the dictionary (int32).
+                labels: a list of str column, e.g. query and output, the labels are ids in the dictionary,
+                    stored back to back with the end offset of each row.
+                text: a str column, e.g. input, stored as utf-8 back to back with the end offset of each row.
+                json: any other column, stored as the text of json.
+            Each column also has a mask of whether the row has the key.
+            The data files are only appended, and meta.json (the number of rows and the dictionaries) is replaced at commit(),
+            so the dataset on the disk is always the one of the last commit.
+
+        Parameters:
+            :path: the directory of the dataset, e.g. ../dataset/train.col
+            :dict_columns: the str columns to be dictionary-encoded
+            :rows: truncate the dataset to the first rows, e.g. the position returned by a previous commit()
+        '''
+        self.path = path
+        self.dict_columns = dict_columns
+        self.rows = 0
+        self.columns = {}       # column -> {'type': str, 'dictionary': list}
+        self._index = {}        # column -> {value: id}
+        self._files = {}        # column -> {file name: file object}
+        self._ends = {}         # column -> the end offset of the last row, for labels, text and json
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META)):
+            with open(os.path.join(path, META), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.rows = meta['rows'] if rows is None else min(rows, meta['rows'])
+            self.columns = meta['columns']
+            for column, info in self.columns.items():
+                self._index[column] = {value: i for i, value in enumerate(info.get('dictionary', []))}
+                self._recover(column)
+
+    def _file(self, column: str, name: str) -> str:
+        return os.path.join(self.path, f"{column}.{name}.bin")
+
+    def _recover(self, column: str):
+        ''' Truncate the files of the column to the committed rows. '''
+        info = self.columns[column]
+        sizes = {'mask': self.rows}
+        end = 0
+        if info['type'] == 'dict':
+            sizes['ids'] = self.rows * 4
+        else:
+            sizes['offsets'] = self.rows * 8
+            if self.rows:
+                end = int(np.fromfile(self._file(column, 'offsets'), dtype=np.int64, count=1, offset=(self.rows - 1) * 8)[0])
+            sizes['ids' if info['type'] == 'labels' else 'data'] = end * (4 if info['type'] == 'labels' else 1)
+        for name, size in sizes.items():
+            if os.path.getsize(self._file(column, name)) > size:
+                os.truncate(self._file(column, name), size)
+        self._ends[column] = end
+        self._files[column] = {name: open(self._file(column, name), 'ab') for name in sizes}
+
+    def _add_column(self, column: str, value: Any):
+        if isinstance(value, str):
+            column_type = 'dict' if column in self.dict_columns else 'text'
+        elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+            column_type = 'labels'
+        else:
+            column_type = 'json'
+        self.columns[column] = {'type': column_type}
+        if column_type in ('dict', 'labels'):
+            self.columns[column]['dictionary'] = []
+            self._index[column] = {}
+        names = ['mask'] + (['ids'] if column_type == 'dict' else ['offsets', 'ids' if column_type == 'labels' else 'data'])
+        self._files[column] = {name: open(self._file(column, name), 'wb') for name in names}
+        self._ends[column] = 0
+        # the rows before the column appears do not have the key
+        self._files[column]['mask'].write(bytes(self.rows))
+        if column_type == 'dict':
+            self._files[column]['ids'].write(array('i', [-1] * self.rows).tobytes())
+        else:
+            self._files[column]['offsets'].write(array('q', [0] * self.rows).tobytes())
+
+    def _encode(self, column: str, value: str) -> int:
+        index = self._index[column]
+        if value not in index:
+            index[value] = len(index)
+            self.columns[column]['dictionary'].append(value)
+        return index[value]
+
+    def write(self, js: dict):
+        for column, value in js.items():
+            if column not in self.columns:
+                self._add_column(column, value)
+        for column, info in self.columns.items():
+            files = self._files[column]
+            files['mask'].write(b'\x01' if column in js else b'\x00')
+            value = js.get(column)
+            if info['type'] == 'dict':
+                if column in js and not isinstance(value, str):
+                    raise ValueError(f"The column {column} should be str: {value!r}")
+                files['ids'].write(array('i', [self._encode(column, value) if column in js else -1]).tobytes())
+                continue
+            if info['type'] == 'labels':
+                if column in js and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+                    raise ValueError(f"The column {column} should be a list of str: {value!r}")
+                ids = [self._encode(column, v) for v in value] if column in js else []
+                files['ids'].write(array('i', ids).tobytes())
+                self._ends[column] += len(ids)
+            else:
+                if info['type'] == 'text' and column in js and not isinstance(value, str):
+                    raise ValueError(f"The column {column} should be str: {value!r}")
+                data = b''
+                if column in js:
+                    data = (value if info['type'] == 'text' else json.dumps(value, ensure_ascii=False)).encode('utf-8')
+                files['data'].write(data)
+                self._ends[column] += len(data)
+            files['offsets'].write(array('q', [self._ends[column]]).tobytes())
+        self.rows += 1
+
+    def commit(self) -> int:
+        '''
+        Usage:
+            Flush and fsync the column files, then replace meta.json.
+
+        Returns:
+            The number of rows committed.
+        '''
+        for files in self._files.values():
+            for f in files.values():
+                f.flush()
+                os.fsync(f.fileno())
+        tmp_path = os.path.join(self.path, META + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'rows': self.rows, 'columns': self.columns}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, META))
+        return self.rows
+
+    def close(self) -> int:
+        rows = self.commit()
+        for files in self._files.values():
+            for f in files.values():
+                f.close()
+        return rows
+
+class ColumnarDataset:
+    ''' This is a reader of the columnar dataset, the column files are memory-mapped. '''
+    def __init__(self, path: str):
+        '''
+        Parameters:
+            :path: the directory of the dataset written by ColumnarWriter
+        '''
+        self.path = path
+        with open(os.path.join(path, META), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.columns = meta['columns']
+        self._arrays = {}
+        for column, info in self.columns.items():
+            arrays = {'mask': self._map(column, 'mask', np.uint8, self.rows)}
+            if info['type'] == 'dict':
+                arrays['ids'] = self._map(column, 'ids', np.int32, self.rows)
+            else:
+                arrays['offsets'] = self._map(column, 'offsets', np.int64, self.rows)
+                end = int(arrays['offsets'][-1]) if self.rows else 0
+                if info['type'] == 'labels':
+                    arrays['ids'] = self._map(column, 'ids', np.int32, end)
+                else:
+                    arrays['data'] = self._map(column, 'data', np.uint8, end)
+            self._arrays[column] = arrays
+
+    def _map(self, column: str, name: str, dtype: Any, size: int) -> np.ndarray:
+        if size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, f"{column}.{name}.bin"), dtype=dtype, mode='r', shape=(size,))
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def _value(self, column: str, i: int) -> Any:
+        info, arrays = self.columns[column], self._arrays[column]
+        if info['type'] == 'dict':
+            return info['dictionary'][arrays['ids'][i]]
+        start = int(arrays['offsets'][i - 1]) if i > 0 else 0
+        end = int(arrays['offsets'][i])
+        if info['type'] == 'labels':
+            return [info['dictionary'][t] for t in arrays['ids'][start:end].tolist()]
+        text = arrays['data'][start:end].tobytes().decode('utf-8')
+        return text if info['type'] == 'text' else json.loads(text)
+
+    def __getitem__(self, i: int) -> dict:
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError(i)
+        # the decoded values of the dictionary columns are the same str objects, so they are interned in memory
+        return {column: self._value(column, i) for column in self.columns if self._arrays[column]['mask'][i]}
+
+    def __iter__(self) -> Iterator[dict]:
+        for i in range(self.rows):
+            yield self[i]
+
+    def to_hf(self) -> Any:
+        '''
+        Usage:
+            Convert to a Hugging Face datasets.Dataset, the rows are written to a memory-mapped Arrow cache file.
+        '''
+        from datasets import Dataset
+        version = (self.rows, os.path.getmtime(os.path.join(self.path, META)))     # a new cache when the dataset changes
+        return Dataset.from_generator(_generate_rows, gen_kwargs={'path': self.path, 'version': version})
+
+def _generate_rows(path: str, version: Any = None) -> Iterator[dict]:
+    yield from ColumnarDataset(path)
+
+def write_columnar(records: Iterable[dict], path: str, dict_columns: tuple = DICT_COLUMNS) -> int:
+    '''
+    Usage:
+        Write the records to a new columnar dataset, the existing dataset in path is replaced.
+        It can be used to convert a json or jsonl file, e.g. write_columnar(iter_records('train.jsonl'), 'train.col')
+
+    Returns:
+        The number of rows written.
+    '''
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    writer = ColumnarWriter(path, dict_columns=dict_columns)
+    for js in records:
+        writer.write(js)
+    return writer.close()
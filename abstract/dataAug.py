@@ -1,10 +1,22 @@
 import json
 from rouge_chinese import Rouge
 import jieba
-from typing import Literal, Any, Callable
-from utils import Log, query, logger
+from typing import Literal, Any, Callable, Iterator, Iterable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from collections import deque
+from itertools import islice, chain
+from functools import partial
+from utils import Journal, query, query_n, parse_list, logger
+from refIndex import ReferenceIndex
+from reader import iter_records, exists, FORMATS
+from writer import RecordWriter, RecordRouter
+from columnar import is_columnar, write_columnar
+from scheduler import AugmentScheduler
 from tqdm import tqdm
 import os
+import shutil
+import tempfile
+import weakref
 
 class DataAugmentation:
     ''' This is a class for data augmentation. '''
@@ -16,11 +28,42 @@ class DataAugmentation:
             :key_name: the key name of the input in the dataset. Each data is a dict with key_name as the input. 
         '''
         self.dataset = []           # list of dict
-        self.references = []        # list of str that has been tokenized
+        self.references = []        # list of str that has been tokenized, or a ReferenceIndex
         self.key_name = key_name    
 
+    def attach_index(self, index_dir: str, readonly: bool = False) -> ReferenceIndex:
+        '''
+        Usage:
+            Attach an on-disk ReferenceIndex as the references of dedup.
+            The references that have been loaded are appended to the index if they are not in it yet,
+            so the dedup knowledge is kept across cleanse, augment and finetune iterations.
+
+        Parameters:
+            :index_dir: the directory of the reference index, it will be created if not exists.
+            :readonly: whether to attach the index read-only, e.g. in a worker process.
+
+        Return:
+            :index: the attached ReferenceIndex
+        '''
+        if isinstance(self.references, ReferenceIndex) and self.references.index_dir == index_dir:
+            return self.references
+        index = ReferenceIndex(index_dir, readonly=readonly)
+        if not readonly:
+            index.extend([reference for reference in self.references if reference not in index])
+        self.references = index
+        return index
+
+    def _attach_temporary_index(self) -> ReferenceIndex:
+        '''
+        Usage:
+            Move the references to a ReferenceIndex in a temporary directory, which is removed with the object.
+        '''
+        index_dir = tempfile.mkdtemp(prefix='references_')
+        weakref.finalize(self, shutil.rmtree, index_dir, ignore_errors=True)
+        return self.attach_index(index_dir)
+
     @ staticmethod
-    def from_file(file_path: str, key_name: str='input', ref: bool = True) -> 'DataAugmentation':
+    def from_file(file_path: str, key_name: str='input', ref: bool = True, index_dir: str = '') -> 'DataAugmentation':
         '''
         Usage:
             This is a factory method to create a DataAugmentation object from a file. 
@@ -29,27 +72,21 @@ class DataAugmentation:
             :file_path: the path of the file. 
             :key_name: the key name of the input in the dataset. 
             :ref: whether to load the reference of each input from the file. 
+            :index_dir: the directory of a ReferenceIndex to attach, if not provided, the references are kept in memory.
 
         Return:
             :dataAug: the DataAugmentation object
         '''
         dataAug = DataAugmentation()
-        if not os.path.exists(file_path):
+        if not exists(file_path):
             logger.error(f"🐞 File not found: {file_path}")
             return None
         
-        if file_path.endswith('.json'):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                dataAug.dataset = json.load(f)
-        elif file_path.endswith('.jsonl'):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in tqdm(lines, desc='Loading dataset'):
-                    js = json.loads(line)
-                    dataAug.dataset.append(js)
-        else:
+        if not file_path.endswith(FORMATS):
             logger.error(f"🐞only support json or jsonl")
             return None
+        for js in tqdm(iter_records(file_path), desc='Loading dataset'):
+            dataAug.dataset.append(js)
 
         if ref:
             for js in dataAug.dataset:
@@ -59,10 +96,12 @@ class DataAugmentation:
                 reference = ' '.join(jieba.cut(js[key_name]))
                 dataAug.references.append(reference)
 
+        if index_dir:
+            dataAug.attach_index(index_dir)
         return dataAug
 
     @ staticmethod
-    def from_dataset(dataset: list[dict], key_name: str='input', ref: bool = True) -> 'DataAugmentation':
+    def from_dataset(dataset: list[dict], key_name: str='input', ref: bool = True, index_dir: str = '') -> 'DataAugmentation':
         '''
         Usage:
             This is a factory method to create a DataAugmentation object from a dataset. 
@@ -71,6 +110,7 @@ class DataAugmentation:
             :dataset: the dataset, a list of dict. 
             :key_name: the key name of the input in the dataset. 
             :ref: whether to load the reference of each input from the dataset. 
+            :index_dir: the directory of a ReferenceIndex to attach, if not provided, the references are kept in memory.
 
         Return:
             :dataAug: the DataAugmentation object
@@ -84,6 +124,8 @@ class DataAugmentation:
                     return None
                 reference = ' '.join(jieba.cut(js[key_name]))
                 dataAug.references.append(reference)
+        if index_dir:
+            dataAug.attach_index(index_dir)
         return dataAug
 
     def _insert(self, 
@@ -94,6 +136,7 @@ class DataAugmentation:
         rouge_metric: Literal['f', 'p', 'r'] ='r',    
         min_rouge_score: float = 0.7,           
         max_length: int = 100,          
+        retain: bool = True,
     ) -> list[dict]:
         '''
         Usage:
@@ -108,6 +151,7 @@ class DataAugmentation:
             :rouge_metric: the metric to use in rouge score, f for f1, p for precision, r for recall
             :min_rouge_score: the minimum rouge score , representing the threshold of the similarity between the input and the reference
             :max_length: the maximum length of the input
+            :retain: whether to append the output data to self.dataset
 
         Return:
             :output_js: the batch output data that satisfy the pool's condition
@@ -131,7 +175,8 @@ class DataAugmentation:
 
         self.references.append(hypothesis)
         output_js = pool.add_query(js, last=last)       # add the query to the pool and get the batch output data that satisfy the pool's condition
-        self.dataset.extend(output_js)
+        if retain:
+            self.dataset.extend(output_js)
         for js in output_js:
             logger.success(f"🎉 Successfully add the user input: {js[self.key_name]}")
         return output_js
@@ -139,16 +184,27 @@ class DataAugmentation:
     def cleanse(self, 
         pool: Any,           
         save_path: str = '',  
+        workers: int = 1,
         **kwargs              
     ) -> list[dict]:
         '''
         Usage:
             Given a pool that contains the condition to filter the data, and scoring data(pool_size) in a time
             Save the cleaned dataset, if not provided, the cleaned dataset will not be saved.
+            If workers > 1, the dataset is split into contiguous shards that are cleansed by worker processes:
+                1. Each worker tokenizes its shard, removes the inputs that are too long or repetitive to the references,
+                   and finds the blockers of each remaining input: the previous inputs of the shard it is repetitive to.
+                2. The remaining inputs of all the shards are appended to a shared ReferenceIndex, 
+                   each worker finds the blockers of its inputs among the inputs of the previous shards.
+                3. The inputs are resolved in the order of the dataset: an input is kept if none of its blockers is kept,
+                   so an input blocked only by a removed input is kept, the same as the serial run.
+                4. Each worker scores its kept inputs by the pool, the accepted inputs are merged in the order of the dataset.
+            The kept inputs and the references are the same as the serial run, only the batches of the pool are different.
 
         Parameters:
-            :pool: the pool of query which is a subclass of QueryPool
-            :save_path: the path to save the cleaned dataset
+            :pool: the pool of query which is a subclass of QueryPool, it should be picklable if workers > 1
+            :save_path: the path to save the cleaned dataset, a json file or a columnar dataset (ends with .col)
+            :workers: the number of worker processes
             :kwargs: other arguments for the _insert method
 
         Return:
@@ -157,23 +213,95 @@ class DataAugmentation:
         dataset = self.dataset.copy()
         length = len(dataset)
         self.dataset = []
-        for i, js in tqdm(enumerate(dataset), total=length):
-            last = (i == length - 1)
-            self._insert(js, pool, last=last, **kwargs)
-        if save_path:
+        if workers > 1 and length > 1:
+            self.dataset = self._cleanse_sharded(dataset, pool, workers, **kwargs)
+        else:
+            for i, js in tqdm(enumerate(dataset), total=length):
+                last = (i == length - 1)
+                self._insert(js, pool, last=last, **kwargs)
+        if save_path and is_columnar(save_path):
+            write_columnar(self.dataset, save_path)
+        elif save_path:
             with open(save_path, 'w', encoding='utf-8') as f:
                 json.dump(self.dataset, f, ensure_ascii=False, indent=4)
         return self.dataset
 
+    def _cleanse_sharded(self, 
+        dataset: list[dict], 
+        pool: Any, 
+        workers: int, 
+        rouge_type: Literal['rouge-1', 'rouge-2', 'rouge-l'] = 'rouge-l',      
+        rouge_metric: Literal['f', 'p', 'r'] ='r',    
+        min_rouge_score: float = 0.7,           
+        max_length: int = 100,          
+    ) -> list[dict]:
+        '''
+        Usage:
+            Cleanse the dataset by worker processes, see cleanse.
+
+        Return:
+            :cleaned_dataset: the cleaned dataset in the order of the input dataset
+        '''
+        rouge_kwargs = {'rouge_type': rouge_type, 'rouge_metric': rouge_metric, 'min_rouge_score': min_rouge_score}
+        size = -(-len(dataset) // workers)
+        shards = [dataset[i:i + size] for i in range(0, len(dataset), size)]
+        index_dir = tempfile.mkdtemp(prefix='cleanse_')
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                dedup = partial(_dedup_shard, references=self.references, key_name=self.key_name, max_length=max_length, **rouge_kwargs)
+                candidates = list(tqdm(executor.map(dedup, shards), total=len(shards), desc='Deduplicating shards'))
+
+                index = ReferenceIndex(index_dir)       # the inputs of all the shards, shared by the workers read-only
+                starts = []
+                for shard_candidates in candidates:
+                    starts.append(len(index))
+                    index.extend([hypothesis for _, hypothesis, _ in shard_candidates])
+
+                block = partial(_block_shard, index=index, **rouge_kwargs)
+                cross = list(tqdm(executor.map(block, candidates, starts), total=len(shards), desc='Comparing shards'))
+
+                # resolve the inputs in the order of the dataset, the blockers of an input are all before it
+                kept, kept_indices = set(), []
+                for shard, shard_candidates, shard_cross, start in zip(shards, candidates, cross, starts):
+                    kept_indices.append([])
+                    for k, (i, hypothesis, local) in enumerate(shard_candidates):
+                        if any(start + j in kept for j in local) or any(j in kept for j in shard_cross[k]):
+                            logger.warning(f"🤢 repetitve user input: {shard[i][self.key_name]}")
+                            continue
+                        kept.add(start + k)
+                        kept_indices[-1].append(i)
+                        self.references.append(hypothesis)
+
+                score = partial(_score_shard, pool=pool)
+                results = list(tqdm(executor.map(score, shards, kept_indices), total=len(shards), desc='Scoring shards'))
+        finally:
+            shutil.rmtree(index_dir, ignore_errors=True)
+
+        cleaned_dataset = []
+        for output_js in results:
+            cleaned_dataset.extend(output_js)
+            for js in output_js:
+                logger.success(f"🎉 Successfully add the user input: {js[self.key_name]}")
+        return cleaned_dataset
+
     def augment(self, 
         pool: Any,                  
-        prompt_func: Callable,      
-        output_path: str,    
+        prompt_func: Callable | list[Callable],      
+        output_path: str | dict[str, str],    
         repeat_num: int = 3,
         from_log: bool = True, 
         indent: int = None,   
+        workers: int = 1,
+        ordered: bool = True,
+        variants: Literal['chain', 'list', 'choices'] = 'chain',
+        commit_interval: int = 1,
+        compression: Literal['gzip', 'zstd'] = None,
+        shard_records: int = 0,
+        shard_bytes: int = 0,
+        stream: bool = False,
+        scheduler: AugmentScheduler = None,
         **kwargs
-    ) -> list[dict]:
+    ) -> Any:
         '''
         Usage:
             Given a pool that contains the condition to filter the data, and a prompt_func to generate the prompt for each input,
@@ -219,19 +347,58 @@ class DataAugmentation:
                     #Previous Generated Prompts#: 
                     {history}
                     #Rewritten Prompt#: {prompt}
-            :output_path: the path to save the augmented dataset
+
+                It can also be a list of prompt_func, e.g. [lazy_func, implicit_func], they are fused in one pass:
+                each seed is rewritten by every prompt_func with its own history, and the rewrites share 
+                the references of dedup, the pool and the checkpoint journal. 
+                Each returned augmented data is tagged with the name of its prompt_func in the key 'aug_func',
+                the tag is not written to output_path, so the output keeps the schema of the seeds, 
+                and the number of the accepted rewrites of each prompt_func is in the summary.
+            :output_path: the path to save the augmented dataset, 
+                or a dict of the path of each prompt_func by name, e.g. {'lazy_func': 'lazy.jsonl', 'implicit_func': 'implicit.jsonl'},
+                then the output of each prompt_func is written to its own path without the 'aug_func' tag.
             :repeat_num: the number of times to repeat the augmentation for each input
             :from_log: whether to start from the last index in the log file or from the beginning
             :indent: the indent of the json file
+            :workers: the number of seeds (and prompt_func) to rewrite concurrently, each of them keeps its own history chain
+            :ordered: whether to insert the rewrites in the order of the seeds, so that the output is deterministic.
+                If False, the seeds are inserted as soon as they are rewritten, which is faster.
+            :variants: how to generate the repeat_num rewrites of each seed
+                chain: call the LLM repeat_num times, resending the growing history each time.
+                list: ask for K rewrites in one call, prompt_func takes a third parameter num, 
+                    the number of rewrites to ask for, and the response should be a json list of str.
+                    Example:
+                        def prompt_func(js: dict, history: list[str], num: int) -> str:
+                            return aug_list_prompt.format(input=js['input'], intentions=js['query'], history=history, num=num)
+                choices: ask for K rewrites in one call through the n choices of the LLM.
+                In list and choices mode, only the missing or repetitive rewrites are requested again.
+            :commit_interval: the number of seeds in a group commit of the checkpoint journal, 
+                the output file and the journal are fsynced once per group commit.
+            :compression: compress the output by gzip or zstd, the output is written to shards with a manifest, see writer.RecordWriter.
+            :shard_records: the maximum number of records in a shard of the output, 0 means no limit.
+            :shard_bytes: the maximum size of a shard of the output, 0 means no limit.
+                If any of compression, shard_records and shard_bytes is set, the output is sharded, 
+                and reader.iter_records(output_path) reads the shards transparently.
+            :stream: bounded-memory mode, the augmented data is only written to output_path, 
+                neither returned nor appended to self.dataset, and the references are kept in a ReferenceIndex 
+                (a temporary one if no index is attached), so the memory does not grow with the output size.
+            :scheduler: an AugmentScheduler to allocate the rewrites by the online acceptance rates of the seeds and prompt_func,
+                and stop at the budget of LLM calls or tokens. The seeds that are not rewritten before the budget is used up
+                are not committed, so they are rewritten when the augmentation is resumed.
+                The yield statistics of each seed are saved to output_path + '.yield.json'.
 
         Return:
-            :augment_dataset: the augmented dataset
+            :augment_dataset: the augmented dataset, 
+                or a summary if stream is True, e.g. {"seeds": 300, "rewrites": 900, "accepted": 612, "output_path": "train.jsonl"}
 
-            Record the index of the augmented dataset in the augment.log file under the same directory as output_path.
+            Record the checkpoint of the augmentation in the augment.journal file under the same directory as output_path.
+            The idx is the number of seeds that have been committed (counting each seed once per prompt_func), offset is the size of output_path when they were committed,
+            and pool is the inputs that are still waiting in the pool to be scored.
                 Example:
-                    {"filename": "train.jsonl", "idx": 110}
+                    {"filename": "train.jsonl", "idx": 110, "offset": 52371, "pool": [...]}
                 Usage:
-                    If there is an interruption in the augmentation process, we can start from the last index in the log file.
+                    If there is an interruption in the augmentation process, the output file is truncated to the offset,
+                    the pool is restored, and the augmentation continues from idx.
 
             Record the augment infomation in the log/{time}.log file according to the utils.py.
                 Example:
@@ -242,25 +409,406 @@ class DataAugmentation:
                 Usage:
                     We can check the log file to see the details of the augmentation process.
         '''
-        log = Log(output_path)
-        last_idx = log.last_idx if from_log else 0
-        f = open(output_path, 'a', encoding='utf-8')
+        prompt_funcs = list(prompt_func) if isinstance(prompt_func, (list, tuple)) else [prompt_func]
+        names = [func.__name__ for func in prompt_funcs]
+        tagged = len(prompt_funcs) > 1 or isinstance(output_path, dict)
+        base_path = output_path
+        if isinstance(output_path, dict):
+            missing = [name for name in names if name not in output_path]
+            if missing:
+                raise ValueError(f"The output path of {missing} is not provided")
+            paths = [output_path[name].rstrip('/') for name in names]
+            base_path = os.path.join(os.path.dirname(paths[0]), '+'.join(os.path.basename(path) for path in paths))
+        journal = Journal(base_path, commit_interval=commit_interval)
+        last_idx = 0
+        position = None
+        committed = set()           # the index of the seeds after next_idx that have been committed
+        if from_log and journal.state:
+            last_idx = journal.last_idx
+            position = journal.offset       # drop the output of the seeds that are not committed
+            committed = set(journal.state.get('done', []))
+            pool.input_js = journal.pool + pool.input_js
+        # each seed is rewritten by every prompt_func, the idx of the journal counts the (seed, prompt_func) pairs
+        total = len(self.dataset) * len(prompt_funcs)
+        todo = [idx for idx in range(last_idx, total) if idx not in committed]
+        seeds = [self.dataset[idx // len(prompt_funcs)] for idx in todo]
+        next_idx = last_idx         # all the seeds before next_idx have been committed
+        pending = [None] * len(pool.input_js)       # the (seed, prompt_func) tag of each input waiting in the pool
         augment_dataset = []
-        for i, js in tqdm(enumerate(self.dataset[last_idx:]), 
-                            total=len(self.dataset)-last_idx,
-                            desc=f'Augmenting by {prompt_func.__name__}'):
-            history = []
-            for j in range(repeat_num):
-                prompt = prompt_func(js, history)
-                aug_input = query(prompt)
+        summary = {'seeds': len({idx // len(prompt_funcs) for idx in todo}), 'rewrites': 0, 'accepted': 0, 'output_path': output_path}
+        if tagged:
+            summary['funcs'] = {name: 0 for name in names}
+        if stream and not isinstance(self.references, ReferenceIndex):
+            self._attach_temporary_index()
+        if scheduler is not None:       # reserve the calls of the last scoring of the pool
+            scheduler.reserve_flush(len(pool.get_score_thresholds()) * getattr(pool, 'repeat_time', 1))
+
+        writer_kwargs = {'indent': indent, 'compression': compression, 'shard_records': shard_records, 'shard_bytes': shard_bytes}
+        if isinstance(output_path, dict):
+            writer = RecordRouter({name: output_path[name] for name in names}, key='aug_func', position=position, **writer_kwargs)
+        else:
+            writer = RecordWriter(output_path, position=position, **writer_kwargs)
+
+        def write(output_js: list[dict]):
+            summary['accepted'] += len(output_js)
+            for js in output_js:
+                if tagged:
+                    summary['funcs'][js['aug_func']] += 1
+                if not stream:
+                    augment_dataset.append(js)
+                if tagged and not isinstance(output_path, dict):       # RecordRouter pops the tag itself
+                    js = {k: v for k, v in js.items() if k != 'aug_func'}
+                writer.put(js)
+
+        def tag_of(i: int) -> tuple:
+            seed_idx, k = divmod(todo[i], len(prompt_funcs))
+            return seed_idx, names[k]
+
+        def rewrite(i: int, js: dict) -> list[str]:
+            func = prompt_funcs[todo[i] % len(prompt_funcs)]
+            return self._rewrite(js, func, repeat_num, variants=variants, scheduler=scheduler, tag=tag_of(i), **kwargs)
+
+        try:
+            stop = scheduler.exhausted if scheduler is not None else None
+            for n, (i, rewrites) in enumerate(tqdm(self._rewrite_all(seeds, rewrite, workers, ordered, stop=stop), 
+                                total=len(seeds), 
+                                desc=f"Augmenting by {'+'.join(names)}")):
+                if rewrites is None:        # stopped by the budget before any call, rewritten when resumed
+                    continue
+                js = seeds[i].copy()
+                if tagged:
+                    js['aug_func'] = tag_of(i)[1]
+                for j, aug_input in enumerate(rewrites):
+                    js[self.key_name] = aug_input
+                    last = (n == len(seeds) - 1 and j == len(rewrites) - 1)
+                    write(self._insert_tagged(js.copy(), tag_of(i), pool, pending, scheduler, 
+                                              last=last, retain=not stream, **kwargs))
+                summary['rewrites'] += len(rewrites)
+                committed.add(todo[i])
+                while next_idx in committed:       # only advance past the seeds that are all committed
+                    committed.remove(next_idx)
+                    next_idx += 1
+                journal.update(next_idx, pool.input_js, writer, done=committed)
+            if pool.input_js:          # score the inputs restored from the journal or left in the pool
+                batch = pool.input_js.copy()
+                output_js = pool.flush()
+                self._attribute(batch, pending, output_js, scheduler)
+                if not stream:
+                    self.dataset.extend(output_js)
+                for js in output_js:
+                    logger.success(f"🎉 Successfully add the user input: {js[self.key_name]}")
+                write(output_js)
+                journal.update(next_idx, pool.input_js, writer, done=committed)
+        finally:
+            journal.close()
+            writer.close()
+        if scheduler is not None:
+            summary['yield'] = scheduler.report(base_path.rstrip('/') + '.yield.json')['total']
+        if stream:
+            logger.info(f"📊 {summary['accepted']} / {summary['rewrites']} rewrites of {summary['seeds']} seeds are written to {base_path}")
+            return summary
+        return augment_dataset
+
+    def _insert_tagged(self, 
+        js: dict, 
+        tag: tuple, 
+        pool: Any, 
+        pending: list[tuple], 
+        scheduler: AugmentScheduler = None, 
+        **kwargs
+    ) -> list[dict]:
+        '''
+        Usage:
+            Insert the input data like _insert, and report the outcome of the rewrite to the scheduler.
+            pending is the tags of the inputs waiting in the pool, in the same order as pool.input_js.
+            The input is either
+                1. dropped as a duplicate (or too long), the pool is not changed.
+                2. added to the pool, its tag is appended to pending until the pool is scored.
+                3. dropped because the pool is full or it is the last one, then the pool is scored, 
+                   the inputs in the output are accepted and the others are rejected.
+        '''
+        if scheduler is None:
+            return self._insert(js, pool, **kwargs)
+        batch = pool.input_js.copy()
+        calls = scheduler.used()['calls']
+        output_js = self._insert(js, pool, **kwargs)
+        if len(pool.input_js) == len(batch) + 1:
+            pending.append(tag)
+        elif batch and not pool.input_js:
+            scheduler.flushed(scheduler.used()['calls'] - calls)
+            self._attribute(batch, pending, output_js, scheduler)
+        elif not kwargs.get('last'):
+            scheduler.record(tag, 'duplicate')
+        return output_js
+
+    @staticmethod
+    def _attribute(batch: list[dict], pending: list[tuple], output_js: list[dict], scheduler: AugmentScheduler = None):
+        '''
+        Usage:
+            Match the scored batch of the pool with its output_js, which keeps the order of the batch,
+            report the accepted and rejected inputs to the scheduler and clear pending.
+        '''
+        k = 0
+        for js, tag in zip(batch, pending):
+            accepted = k < len(output_js) and output_js[k] == js
+            k += accepted
+            if scheduler is not None:
+                scheduler.record(tag, 'accepted' if accepted else 'rejected')
+        pending.clear()
+
+    def _rewrite(self, 
+        js: dict, 
+        prompt_func: Callable, 
+        repeat_num: int, 
+        variants: Literal['chain', 'list', 'choices'] = 'chain', 
+        scheduler: AugmentScheduler = None,
+        tag: tuple = None,
+        **kwargs
+    ) -> list[str]:
+        '''
+        Usage:
+            Rewrite the input of js for repeat_num times.
+            chain: call the LLM repeat_num times, each rewrite is based on the previous one and the history.
+            list: ask for all the missing rewrites in one call, the response should be a json list of str.
+            choices: ask for all the missing rewrites in one call through the n choices of the LLM.
+            In list and choices mode, the rewrites that are empty, repetitive to each other or to the input are dropped,
+            and only the missing ones are requested again, at most repeat_num calls are made.
+            If a scheduler is provided, the number of rewrites is decided by the scheduler instead of repeat_num,
+            each LLM call is reserved from its budget before it is issued,
+            and in chain mode the repetitive rewrites are kept in the history of the prompt but not returned.
+
+        Parameters:
+            :js: the input data(dict)
+            :prompt_func: the function to generate the prompt for each input
+            :repeat_num: the number of times to rewrite
+            :variants: the mode to generate the rewrites, chain, list or choices
+            :scheduler: the AugmentScheduler of the augmentation, optional
+            :tag: the (index of the seed, name of the prompt_func) for the scheduler
+            :kwargs: rouge_type, rouge_metric and min_rouge_score to check the diversity of the rewrites
+
+        Return:
+            :history: the list of the rewritten inputs, 
+                or None if the budget of the scheduler is used up before any call, then the seed should not be committed.
+        '''
+        js = js.copy()
+        history = []
+        if variants == 'chain':
+            if scheduler is None:
+                for _ in range(repeat_num):
+                    prompt = prompt_func(js, history)
+                    aug_input = query(prompt)
+                    js[self.key_name] = aug_input
+                    history.append(aug_input)
+                return history
+            seed_input = js[self.key_name]
+            rewrites = []
+            while scheduler.next(tag, len(history), repeat_num):      # an LLM call is reserved
+                try:
+                    aug_input = query(prompt_func(js, history))
+                finally:
+                    scheduler.release()
+                diverse = self._is_diverse(aug_input, [seed_input] + history, **kwargs)
+                scheduler.observe(tag, diverse)
                 js[self.key_name] = aug_input
-                last = (i == len(self.dataset) - 1 and j == repeat_num - 1)
-                output_js = self._insert(js.copy(), pool, last=last, **kwargs)
-                if output_js:
-                    for js in output_js:
-                        augment_dataset.append(js)
-                        f.write(json.dumps(js, ensure_ascii=False, indent=indent) + '\n')
                 history.append(aug_input)
-            log.update(i+last_idx)
-        f.close()
-        return augment_dataset
\ No newline at end of file
+                if diverse:
+                    rewrites.append(aug_input)
+            if not history and scheduler.exhausted():
+                return None
+            return rewrites
+
+        if scheduler is not None:
+            repeat_num = scheduler.quota(tag, repeat_num)
+        calls = 0
+        for _ in range(repeat_num):
+            missing = repeat_num - len(history)
+            if missing <= 0:
+                break
+            if scheduler is not None and not scheduler.acquire():
+                break
+            try:
+                if variants == 'list':
+                    candidates = parse_list(query(prompt_func(js, history, missing)))
+                else:
+                    candidates = query_n(prompt_func(js, history), n=missing)
+            finally:
+                if scheduler is not None:
+                    scheduler.release()
+            calls += 1
+            for candidate in candidates:
+                diverse = len(history) < repeat_num and self._is_diverse(candidate, [js[self.key_name]] + history, **kwargs)
+                if scheduler is not None:
+                    scheduler.observe(tag, diverse)
+                if diverse:
+                    history.append(candidate)
+            if len(history) < repeat_num:
+                logger.warning(f"🤢 {repeat_num - len(history)} rewrites are missing or repetitive: {js[self.key_name]}")
+        if scheduler is not None and not calls and repeat_num > 0:
+            return None
+        return history
+
+    def _is_diverse(self, 
+        candidate: Any, 
+        references: list[str], 
+        rouge_type: Literal['rouge-1', 'rouge-2', 'rouge-l'] = 'rouge-l',      
+        rouge_metric: Literal['f', 'p', 'r'] ='r',    
+        min_rouge_score: float = 0.7, 
+        **kwargs
+    ) -> bool:
+        '''
+        Usage:
+            Check whether a candidate rewrite is a non-empty str that is not repetitive to any of the references.
+        '''
+        if not isinstance(candidate, str) or not candidate.strip():
+            return False
+        candidate = candidate.strip()
+        if any(candidate == reference.strip() for reference in references):
+            return False
+        if min_rouge_score > 0:
+            hypothesis = ' '.join(jieba.cut(candidate))
+            references = [' '.join(jieba.cut(reference)) for reference in references]
+            if self._similar(hypothesis, references, rouge_type, rouge_metric, min_rouge_score) is not None:
+                return False
+        return True
+
+    @classmethod
+    def _similar(cls, 
+        hypothesis: str, 
+        references: Iterable[str], 
+        rouge_type: Literal['rouge-1', 'rouge-2', 'rouge-l'] = 'rouge-l',      
+        rouge_metric: Literal['f', 'p', 'r'] ='r',    
+        min_rouge_score: float = 0.7
+    ) -> float:
+        '''
+        Usage:
+            Return the first rouge score between the hypothesis and the references that is larger than min_rouge_score,
+            or None if the hypothesis is not repetitive to any of the references.
+        '''
+        if min_rouge_score <= 0 or not hypothesis.strip():
+            return None
+        for reference in references:
+            if not reference.strip():
+                continue
+            score = cls.rouge.get_scores(hypothesis, reference)[0][rouge_type][rouge_metric]
+            if score > min_rouge_score:
+                return score
+        return None
+
+    def _rewrite_all(self, 
+        seeds: list[dict], 
+        rewrite: Callable, 
+        workers: int = 1, 
+        ordered: bool = True,
+        stop: Callable = None
+    ) -> Iterator[tuple[int, list[str]]]:
+        '''
+        Usage:
+            Rewrite all the seeds, each seed keeps its own history chain.
+            If workers > 1, the seeds are rewritten concurrently by a thread pool, 
+            at most 2 * workers seeds are in flight at the same time.
+
+        Parameters:
+            :seeds: the list of input data
+            :rewrite: the function to rewrite a seed, it takes the index and the seed, and returns the list of the rewritten inputs
+            :workers: the number of seeds to rewrite concurrently
+            :ordered: whether to yield the seeds in order, or as soon as they are finished
+            :stop: a function that returns True to stop rewriting the rest of the seeds, e.g. when the budget is used up
+
+        Return:
+            An iterator of (index of the seed, the list of the rewritten inputs)
+        '''
+        if workers <= 1:
+            for i, js in enumerate(seeds):
+                if stop is not None and stop():
+                    logger.info(f"💸 The budget is used up, {len(seeds) - i} seeds are left")
+                    return
+                yield i, rewrite(i, js)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()           # (index, future) in the submitted order
+        todo = iter(enumerate(seeds))
+        try:
+            for i, js in islice(todo, 2 * workers):
+                pending.append((i, executor.submit(rewrite, i, js)))
+            while pending:
+                if ordered:
+                    i, future = pending.popleft()
+                else:
+                    wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                    i, future = next((i, future) for i, future in pending if future.done())
+                    pending.remove((i, future))
+                rewrites = future.result()
+                if stop is not None and stop():
+                    todo = iter([])
+                for j, js in islice(todo, 1):
+                    pending.append((j, executor.submit(rewrite, j, js)))
+                yield i, rewrites
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _dedup_shard(
+    shard: list[dict], 
+    references: Iterable[str], 
+    key_name: str, 
+    max_length: int = 100, 
+    **rouge_kwargs
+) -> list[tuple[int, str, list[int]]]:
+    '''
+    Usage:
+        The first step of the sharded cleanse in a worker process.
+        Tokenize the inputs of the shard, remove the inputs that are too long or repetitive to the references,
+        and find the blockers of each remaining input among the previous remaining inputs of the shard.
+        Whether an input is kept depends on whether its blockers are kept, see DataAugmentation.cleanse.
+
+    Return:
+        A list of (index in the shard, tokenized input, the positions of its blockers in the list) of the remaining inputs.
+    '''
+    candidates = []
+    for i, js in enumerate(shard):
+        user_input = js[key_name]
+        if len(user_input) > max_length:
+            logger.warning(f"🤮 The length of user input is too long")
+            continue
+        hypothesis = ' '.join(jieba.cut(user_input))
+        score = DataAugmentation._similar(hypothesis, references, **rouge_kwargs)
+        if score is not None:
+            logger.warning(f"🤢 repetitve user input: {user_input} => {score:.4f}")
+            continue
+        blockers = [j for j, (_, reference, _) in enumerate(candidates) if DataAugmentation._similar(hypothesis, [reference], **rouge_kwargs) is not None]
+        candidates.append((i, hypothesis, blockers))
+    return candidates
+
+def _block_shard(
+    candidates: list[tuple[int, str, list[int]]], 
+    start: int, 
+    index: ReferenceIndex, 
+    **rouge_kwargs
+) -> list[list[int]]:
+    '''
+    Usage:
+        The second step of the sharded cleanse in a worker process.
+        Find the blockers of the remaining inputs of a shard among the remaining inputs of the previous shards, which are index[:start].
+
+    Return:
+        The indices in index of the blockers of each input.
+    '''
+    return [
+        [j for j in range(start) if DataAugmentation._similar(hypothesis, [index[j]], **rouge_kwargs) is not None]
+        for _, hypothesis, _ in candidates
+    ]
+
+def _score_shard(shard: list[dict], kept: list[int], pool: Any) -> list[dict]:
+    '''
+    Usage:
+        The last step of the sharded cleanse in a worker process, score the kept inputs of a shard by the pool in batches of pool_size.
+
+    Return:
+        The inputs accepted by the pool.
+    '''
+    batch, output_js = [shard[i] for i in kept], []
+    for i in range(0, len(batch), pool.pool_size):
+        pool.input_js = batch[i:i + pool.pool_size]
+        output_js.extend(pool.flush())
+    return output_js
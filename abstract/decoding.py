@@ -0,0 +1,174 @@
+import time
+import torch
+from transformers import StoppingCriteria
+from typing import Any, Callable
+
+class BracketStoppingCriteria(StoppingCriteria):
+    ''' This is a stopping criterion that stops a sequence once its generated list is closed by ']'. '''
+    def __init__(self, tokenizer: Any, start: int, open_bracket: str = '[', close_bracket: str = ']'):
+        '''
+        Parameters:
+            :tokenizer: Hugging Face Transformers tokenizer
+            :start: the length of the input ids, the tokens after it are the generated ones
+            :open_bracket: the bracket that opens the list
+            :close_bracket: the bracket that closes the list
+        '''
+        self.tokenizer = tokenizer
+        self.start = start
+        self.open_bracket = open_bracket
+        self.close_bracket = close_bracket
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = []
+        for ids in input_ids[:, self.start:].tolist():
+            text = self.tokenizer.decode(ids, skip_special_tokens=True)
+            i = text.find(self.open_bracket)
+            done.append(i != -1 and self.close_bracket in text[i + 1:])
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class TimeoutStoppingCriteria(StoppingCriteria):
+    ''' This is a stopping criterion that stops the generation once it runs longer than max_time seconds of wall-clock time. '''
+    def __init__(self, max_time: float, finished_ids: set[int], start_time: float = None, criteria: list[StoppingCriteria] = None):
+        '''
+        Usage:
+            A done mask of the rows is kept across the steps: a row is done once it generates one of finished_ids,
+            or once one of criteria stops it, e.g. BracketStoppingCriteria. When the time is up, only the rows
+            that are not done are timed out, so the rows that finished earlier in the batch are kept.
+            The criteria are called by this criterion, do not add them to the StoppingCriteriaList again.
+
+        Parameters:
+            :max_time: the maximum seconds of the generation, including the prefill
+            :finished_ids: the token ids of a finished sequence, e.g. the eos and pad tokens
+            :start_time: the start time of the generation, default to now
+            :criteria: the other stopping criteria of the generation, whose stops are not timeouts
+        '''
+        self.max_time = max_time
+        self.finished_ids = finished_ids
+        self.start_time = start_time or time.time()
+        self.criteria = criteria or []
+        self.done = None        # whether each row is finished
+        self.timed_out = []     # the rows of the sequences that were not finished when the time is up
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        finished_ids = torch.tensor(sorted(self.finished_ids), device=input_ids.device)
+        stop = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for criterion in self.criteria:
+            stop = stop | criterion(input_ids, scores, **kwargs)
+        done = stop | torch.isin(input_ids[:, -1], finished_ids)
+        self.done = done if self.done is None else self.done | done
+        if time.time() - self.start_time < self.max_time:
+            return stop
+        if not self.timed_out:
+            self.timed_out = [i for i, row_done in enumerate(self.done.tolist()) if not row_done]
+        return torch.ones(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+class FirstStepTimer(StoppingCriteria):
+    ''' This is a criterion that never stops, it records the time of the first step to split the prefill and the decoding. '''
+    def __init__(self):
+        self.first_step = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.first_step is None:
+            self.first_step = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+class LabelListGrammar:
+    ''' This is a grammar that constrains the generation to a list of the known labels, e.g. ['label1', 'label2']. '''
+    def __init__(self, tokenizer: Any, labels: list[str], quote: str = "'", sep: str = ', ', max_cache: int = 100000):
+        '''
+        Usage:
+            The output is [ then zero or more quoted labels separated by sep, then ] and the eos token,
+            the default quote and sep are the same as str(list) of the gold outputs in the training prompts.
+            The allowed tokens of a step follow the canonical tokenization of the rendered lists: the generated text
+            is completed to the lists that finish the current label and at most one more, each of them is encoded as a whole,
+            and the next token of each encoding that starts with the generated ids is allowed.
+            So the tokens merged across the brackets, the quotes and sep are generated as the model saw them in training.
+            Pass prefix_allowed_tokens_fn(start) to model.generate.
+
+        Parameters:
+            :tokenizer: Hugging Face Transformers tokenizer
+            :labels: the known labels, e.g. the intent names
+            :quote: the quote of each label
+            :sep: the separator between the labels
+            :max_cache: the maximum number of the generated prefixes whose allowed tokens are cached
+        '''
+        self.tokenizer = tokenizer
+        self.eos_token_id = tokenizer.eos_token_id
+        self.items = [f"{quote}{label}{quote}" for label in labels]
+        self.sep = sep
+        self.max_cache = max_cache
+        self._cache = {}        # the generated ids -> the allowed tokens
+
+    def _rest(self, partial: str) -> list[str]:
+        ''' The completions of a partial item: the rest of the item, then ] or sep, one more item and ]. '''
+        ends = [']'] + [f"{self.sep}{item}]" for item in self.items]
+        return [item[len(partial):] + end for item in self.items if item.startswith(partial) for end in ends]
+
+    def completions(self, text: str) -> list[str] | None:
+        '''
+        Usage:
+            The strings that complete text to a rendered list, [''] if text is a complete list,
+            or None if text is not the prefix of a rendered list.
+        '''
+        if not text:
+            return ['[]'] + ['[' + rest for rest in self._rest('')]
+        if text[0] != '[':
+            return None
+        body, pos, state = text[1:], 0, 'first'
+        while True:
+            rest = body[pos:]
+            if state == 'next':
+                if rest == ']':
+                    return ['']
+                if rest.startswith(self.sep):
+                    pos, state = pos + len(self.sep), 'item'
+                    continue
+                if self.sep.startswith(rest):
+                    return [']'] * (not rest) + [self.sep[len(rest):] + item + ']' for item in self.items]
+                return None
+            if state == 'first' and rest == ']':
+                return ['']
+            item = next((item for item in self.items if rest.startswith(item)), None)
+            if item is None:
+                completions = ([']'] if state == 'first' and not rest else []) + self._rest(rest)
+                return completions or None
+            pos, state = pos + len(item), 'next'
+
+    def allowed_tokens(self, generated: list[int]) -> list[int]:
+        '''
+        Usage:
+            Return the token ids allowed after the generated token ids.
+            If the generated ids are not a canonical prefix of a rendered list, e.g. generated without the constraint,
+            all the tokens are allowed.
+        '''
+        if self.eos_token_id in generated:
+            return [self.eos_token_id]
+        key = tuple(generated)
+        if key not in self._cache:
+            if len(self._cache) >= self.max_cache:
+                self._cache = {}
+            self._cache[key] = self._allowed_tokens(generated)
+        return self._cache[key]
+
+    def _allowed_tokens(self, generated: list[int]) -> list[int]:
+        text = self.tokenizer.decode(generated, clean_up_tokenization_spaces=False)
+        completions = self.completions(text)
+        allowed = set()
+        if completions is not None:
+            if '' in completions:
+                allowed.add(self.eos_token_id)
+            completions = [text + completion for completion in completions if completion]
+            n = len(generated)
+            for ids in self.tokenizer(completions, add_special_tokens=False)['input_ids'] if completions else []:
+                if len(ids) > n and ids[:n] == generated:
+                    allowed.add(ids[n])
+        return sorted(allowed) if allowed else list(range(len(self.tokenizer)))
+
+    def prefix_allowed_tokens_fn(self, start: int) -> Callable:
+        '''
+        Parameters:
+            :start: the length of the input ids, the tokens after it are the generated ones
+        '''
+        def fn(batch_id: int, input_ids: torch.Tensor) -> list[int]:
+            return self.allowed_tokens(input_ids[start:].tolist())
+        return fn
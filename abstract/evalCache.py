@@ -0,0 +1,120 @@
+import os
+import glob
+import json
+import hashlib
+from typing import Any
+
+def record_hash(data: dict) -> str:
+    ''' The sha256 of the content of a record, independent of the order of the keys. '''
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+def model_fingerprint(model: Any, config: dict) -> str:
+    '''
+    Usage:
+        The sha256 of the adapter weights (the LoRA parameters, e.g. lora_A and lora_B) and the config,
+        e.g. the generation config and the base model. If the model has no adapter, the weights are not hashed,
+        the model is identified by its path, its revision (the commit hash of the hub) and its config instead,
+        so pass a version key in config if the weights change under the same path, e.g. a merged or retrained model.
+
+    Parameters:
+        :model: Hugging Face Transformers model, or a PEFT model
+        :config: any JSON serializable config that changes the predictions
+    '''
+    params = [(name, p) for name, p in model.named_parameters() if 'lora_' in name]
+    if not params:
+        model_config = getattr(model, 'config', None)
+        config = {
+            **config,
+            'model_path': getattr(model_config, '_name_or_path', ''),
+            'model_revision': getattr(model_config, '_commit_hash', None),
+            'model_config': model_config.to_dict() if hasattr(model_config, 'to_dict') else None,
+        }
+    sha256 = hashlib.sha256(json.dumps(config, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8'))
+    for name, p in params:
+        sha256.update(name.encode('utf-8'))
+        sha256.update(p.detach().float().cpu().numpy().tobytes())
+    return sha256.hexdigest()
+
+class PredictionCache:
+    ''' This is a persistent cache of the predictions of a model, one jsonl file per model fingerprint. '''
+    def __init__(self, cache_dir: str, fingerprint: str, shard: int = None):
+        '''
+        Usage:
+            The prediction of each record is appended to cache_dir/<fingerprint>.jsonl once it is computed,
+            so the records that have been predicted by the same model and config are skipped, even across runs.
+            The predictions that are not JSON serializable are not cached.
+            The worker processes of a sharded evaluation append to their own files cache_dir/<fingerprint>.shard<k>.jsonl,
+            so no file is written by two processes, and the shard files are merged by merge_shards at the end.
+            The shard files left by an interrupted evaluation are read as well.
+
+        Parameters:
+            :cache_dir: the directory of the cache
+            :fingerprint: the fingerprint of the model and the config, see model_fingerprint
+            :shard: the index of the worker process of a sharded evaluation, None in one process
+        '''
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_path = os.path.join(cache_dir, f'{fingerprint}.jsonl')
+        self.results = {}       # record hash -> (pred, gold)
+        self.hits = 0
+        for path in [self.cache_path] + self.shard_paths(cache_dir, fingerprint):
+            self.results.update(self._read(path))
+        if shard is not None:
+            self.cache_path = os.path.join(cache_dir, f'{fingerprint}.shard{shard}.jsonl')
+        self.f = open(self.cache_path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def shard_paths(cache_dir: str, fingerprint: str) -> list[str]:
+        return sorted(glob.glob(os.path.join(glob.escape(cache_dir), f'{fingerprint}.shard*.jsonl')))
+
+    @staticmethod
+    def _read(path: str) -> dict[str, tuple[Any, Any]]:
+        results = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        js = json.loads(line)
+                    except json.JSONDecodeError:       # the torn tail of an interrupted write
+                        continue
+                    results[js['hash']] = (js['pred'], js['gold'])
+        return results
+
+    @classmethod
+    def merge_shards(cls, cache_dir: str, fingerprint: str):
+        '''
+        Usage:
+            Append the predictions of the shard files to cache_dir/<fingerprint>.jsonl and remove the shard files,
+            call it after all the worker processes of a sharded evaluation have closed their caches.
+        '''
+        paths = cls.shard_paths(cache_dir, fingerprint)
+        if not paths:
+            return
+        cache_path = os.path.join(cache_dir, f'{fingerprint}.jsonl')
+        cached = cls._read(cache_path)
+        with open(cache_path, 'a', encoding='utf-8') as f:
+            for path in paths:
+                for key, (pred, gold) in cls._read(path).items():
+                    if key not in cached:
+                        cached[key] = (pred, gold)
+                        f.write(json.dumps({'hash': key, 'pred': pred, 'gold': gold}, ensure_ascii=False) + '\n')
+        for path in paths:
+            os.remove(path)
+
+    def get(self, key: str) -> tuple[Any, Any]:
+        result = self.results.get(key)
+        self.hits += result is not None
+        return result
+
+    def add(self, key: str, result: tuple[Any, Any]):
+        pred, gold = result
+        try:
+            line = json.dumps({'hash': key, 'pred': pred, 'gold': gold}, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return
+        self.results[key] = (pred, gold)
+        self.f.write(line + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
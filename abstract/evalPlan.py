@@ -0,0 +1,75 @@
+import os
+import json
+from collections import defaultdict
+from reader import iter_records
+from evalCache import record_hash
+from typing import Any, Callable
+
+def intent_stratum(data: dict) -> tuple:
+    ''' The stratum of a record by its gold intents: (the number of intents, the first intent). '''
+    labels = data.get('output')
+    if not isinstance(labels, (list, tuple)):
+        labels = [labels] if labels else []
+    return len(labels), str(labels[0]) if labels else ''
+
+class EvalPlan:
+    ''' This is a plan that evaluates the intermediate iterations on a stratified subsample of the test set. '''
+    def __init__(self,
+        test_file_path: str,
+        sample_size: int = 200,
+        sample_path: str = '',
+        stratum: Callable[[dict], Any] = intent_stratum
+    ):
+        '''
+        Usage:
+            The records of the test file are grouped by stratum, e.g. by the number of intents and the first intent,
+            and each stratum gets a share of sample_size proportional to its size (largest remainder).
+            The records of a stratum are ordered by their hashes and the first ones are drawn,
+            so the subsample is deterministic and the same across the iterations and the runs,
+            and the scores of the iterations are comparable. The subsample is written to sample_path in the order of the test file.
+
+        Parameters:
+            :test_file_path: the path of the full test set
+            :sample_size: the number of examples of the subsample, the full test set is used if it is not larger
+            :sample_path: the path of the subsample, default to the test file with the extension .sample<size>.jsonl
+            :stratum: a function that takes a record and returns its stratum (hashable)
+        '''
+        self.test_file_path = test_file_path
+        self.sample_path = sample_path or f"{os.path.splitext(test_file_path)[0]}.sample{sample_size}.jsonl"
+        strata = defaultdict(list)      # stratum -> [(hash, index)]
+        records = []
+        for i, data in enumerate(iter_records(test_file_path)):
+            records.append(data)
+            strata[stratum(data)].append((record_hash(data), i))
+        self.total = len(records)
+        self.strata = len(strata)
+        self.full = sample_size >= self.total
+        if self.full:
+            self.sample_path = test_file_path
+            self.size = self.total
+            return
+
+        quotas = {key: sample_size * len(items) / self.total for key, items in strata.items()}
+        counts = {key: int(quota) for key, quota in quotas.items()}
+        rest = sample_size - sum(counts.values())
+        for key in sorted(quotas, key=lambda key: (counts[key] - quotas[key], str(key)))[:rest]:
+            counts[key] += 1
+        chosen = sorted(i for key, items in strata.items() for _, i in sorted(items)[:counts[key]])
+        self.size = len(chosen)
+
+        tmp_path = self.sample_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for i in chosen:
+                f.write(json.dumps(records[i], ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.sample_path)
+
+    def evaluate(self, evaluator: Any, **kwargs) -> dict[str, float]:
+        '''
+        Usage:
+            Evaluate on the subsample by evaluator.evaluate, the confidence intervals are in evaluator.last_stats['intervals'].
+
+        Parameters:
+            :evaluator: an ABCEvaluator
+            :kwargs: the other arguments of evaluator.evaluate, e.g. wrong_output_path
+        '''
+        return evaluator.evaluate(test_file_path=self.sample_path, **kwargs)
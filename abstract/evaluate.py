@@ -1,23 +1,288 @@
 from dotenv import load_dotenv
 load_dotenv()
 from abc import ABC, abstractmethod
-from unsloth import FastLanguageModel
-from transformers import TextStreamer
+try:
+    from unsloth import FastLanguageModel
+except ImportError:         # e.g. evaluate a plain Hugging Face model on CPU
+    FastLanguageModel = None
+from transformers import TextStreamer, StoppingCriteriaList
+import os
 import json
+import copy
+import time
+import torch
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from typing import Any
+from itertools import islice
+from reader import iter_records, FORMATS
+from decoding import BracketStoppingCriteria, LabelListGrammar, TimeoutStoppingCriteria, FirstStepTimer
+from metrics import RunningMetrics, MultiLabelMetrics, profile_summary
+from evalCache import PredictionCache, model_fingerprint, record_hash
+from typing import Any, Callable, Iterable, Iterator, Literal
+
+def _evaluate_shard(
+    cls: type,
+    model_factory: Callable[[str], tuple[Any, Any]],
+    device: str,
+    test_file_path: str,
+    shard: int,
+    num_shards: int,
+    evaluator_kwargs: dict
+) -> dict:
+    '''
+    Usage:
+        Evaluate the records whose indices % num_shards == shard in a worker process, see ABCEvaluator.evaluate_sharded.
+        The predictions are cached to the shard file of the worker, see evalCache.PredictionCache.
+
+    Returns:
+        A dictionary of
+            :label_vocab: the label_vocab of the evaluator
+            :results: [(index, pred, gold, metric, wrong)], metric is None if label_vocab is provided,
+                then the metrics are computed from pred and gold
+            :cache: (cache_dir, fingerprint) of the prediction cache, or None
+            :cached: the number of the cached examples
+            :timeouts: the index of the timed-out examples in the test file -> latency
+            :profile: whether the evaluator profiles the examples
+            :profiles: the profile of each example with its index in the test file, if profile
+    '''
+    if device == 'cpu':
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+    model, tokenizer = model_factory(device)
+    evaluator = cls(model, tokenizer, device=device, **evaluator_kwargs)
+    fingerprint = evaluator.fingerprint() if evaluator.cache_dir else ''
+    cache = PredictionCache(evaluator.cache_dir, fingerprint, shard=shard) if evaluator.cache_dir else None
+    records = (data for i, data in enumerate(iter_records(test_file_path)) if i % num_shards == shard)
+    index = lambda j: j * num_shards + shard        # the index in the shard -> the index in the test file
+    results = []
+    for j, (data, (pred, gold)) in enumerate(evaluator._predict_all(records, cache)):
+        metric = None if evaluator.label_vocab else evaluator.metric(pred, gold)
+        wrong = evaluator.is_wrong(pred, gold) or j in evaluator.timeouts
+        results.append((index(j), pred, gold, metric, wrong))
+    if cache:
+        cache.close()
+    return {
+        'label_vocab': evaluator.label_vocab,
+        'results': results,
+        'cache': (evaluator.cache_dir, fingerprint) if cache else None,
+        'cached': cache.hits if cache else 0,
+        'timeouts': {index(j): latency for j, latency in evaluator.timeouts.items()},
+        'profile': evaluator.profile,
+        'profiles': [{**profile, 'index': index(profile['index'])} for profile in evaluator.profiles],
+    }
+
+def _save_profile(profiles: list[dict], elapsed: float, profile_path: str = '') -> dict:
+    ''' Summarize the profile of each example, and save the summary and the profiles to profile_path if it is provided. '''
+    keys = ['prompt_tokens', 'generated_tokens', 'tokenize', 'prefill', 'decode', 'parse', 'latency']
+    summary = profile_summary(profiles, keys)
+    summary.update({
+        'examples': len(profiles),
+        'parsed': sum(profile['parsed'] for profile in profiles) / len(profiles) if profiles else 0.0,
+        'tokens_per_second': sum(profile.get('generated_tokens', 0) for profile in profiles) / elapsed if elapsed else 0.0,
+        'examples_per_second': len(profiles) / elapsed if elapsed else 0.0,
+    })
+    if profile_path:
+        with open(profile_path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'examples': profiles}, f, ensure_ascii=False, indent=4)
+    return summary
 
 class ABCEvaluator(ABC):
-    def __init__(self, model, tokenizer, max_new_tokens: int = 100):
+    bucket_window = 8       # the number of batches whose examples are sorted by the prompt length together
+
+    def __init__(self, 
+        model, 
+        tokenizer, 
+        max_new_tokens: int = 100,
+        device: str = None,
+        do_sample: bool = True,
+        batch_size: int = 1,
+        max_batch_tokens: int = 0,
+        stop_at_bracket: bool = False,
+        labels: list[str] = None,
+        label_vocab: list[str] = None,
+        cache_dir: str = '',
+        timeout: float = 0,
+        profile: bool = False,
+    ):
         '''
         Parameters:
-            :model: Hugging Face Transformers model that has been fastened by unsloth
+            :model: Hugging Face Transformers model that has been fastened by unsloth, or any causal LM
             :tokenizer: Hugging Face Transformers tokenizer
+            :max_new_tokens: the maximum number of tokens to generate
+            :device: the device of the inputs, default to cuda if available, otherwise cpu
+            :do_sample: whether to sample (top_p=0.9, top_k=50), or decode greedily, which is deterministic
+            :batch_size: the maximum number of examples generated in a batch, 
+                it only takes effect if the subclass implements prompt and parse, see forward_batch.
+            :max_batch_tokens: the maximum number of tokens in a batch, 
+                which is the number of examples * (the longest prompt + max_new_tokens), 0 means no limit.
+            :stop_at_bracket: whether to stop the generation once the generated list is closed by ']', see decoding.py
+            :labels: the known labels, if provided, the generation is constrained to a list of them, 
+                e.g. ['label1', 'label2'], see decoding.LabelListGrammar. Use it with do_sample=False for evaluation.
+            :label_vocab: the label vocabulary of the multi-label outputs, if provided, the metrics are computed
+                over the multi-hot matrices by metrics.MultiLabelMetrics instead of metric, see evaluate.
+            :cache_dir: the directory of the prediction cache, if provided, the predictions are cached by the fingerprint
+                of the model and the generation config and the hash of each example with its prompt, see fingerprint, cache_key and evalCache.py.
+            :timeout: the maximum seconds of each generation (a batch is generated at once), 0 means no limit.
+                The generation is stopped by decoding.TimeoutStoppingCriteria, so the device is released right away,
+                and the examples that are not finished by then are parsed from None and recorded as wrong predictions,
+                the examples of the batch that finished earlier are kept, see evaluate.
+            :profile: whether to record the tokens, the phase timings and the parse success of each example, see evaluate.
+                The phases are tokenize, prefill (until the first token), decode and parse, the first three are of the batch.
         '''
         self.model = model
         self.tokenizer = tokenizer
         self.max_new_tokens = max_new_tokens
-        FastLanguageModel.for_inference(self.model) # Enable native 2x faster inference
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.do_sample = do_sample
+        self.batch_size = max(1, batch_size)
+        self.max_batch_tokens = max_batch_tokens
+        self.stop_at_bracket = stop_at_bracket
+        self.grammar = LabelListGrammar(tokenizer, labels) if labels else None
+        self.label_vocab = label_vocab
+        self.labels = labels
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.last_timed_out = []    # whether each prompt of the last inference or forward_batch is timed out
+        self.timeouts = {}          # the index of the timed-out examples of the evaluation -> latency
+        self._watchdog = None
+        self.profile = profile
+        self.last_profile = []      # the profile of each example of the last forward_batch, if profile
+        self.profiles = []          # the profile of each example of the evaluation, if profile
+        self._timer = None
+        self._generation_profile = {}
+        self.last_stats = {}        # the statistics of the last evaluation, see evaluate
+        self.prefix_ids = []        # the token ids of the shared prefix of the prompts, see set_prefix
+        self._prefix_cache = {}     # batch size -> the past key values of the prefix
+        self._encodings = None      # prompt -> token ids, shared by _batches and _generate within a window of _predict_all
+        if FastLanguageModel is not None:
+            FastLanguageModel.for_inference(self.model) # Enable native 2x faster inference
+        else:
+            self.model.eval()
+
+    def generation_kwargs(self) -> dict:
+        ''' The arguments of model.generate except the inputs. '''
+        pad_token_id = self.tokenizer.pad_token_id
+        kwargs = {'max_new_tokens': self.max_new_tokens, 'pad_token_id': self.tokenizer.eos_token_id if pad_token_id is None else pad_token_id}
+        if self.do_sample:
+            kwargs.update(do_sample=True, top_p=0.9, top_k=50, temperature=1.0, num_return_sequences=1)
+        else:
+            kwargs.update(do_sample=False)
+        return kwargs
+
+    def fingerprint(self) -> str:
+        '''
+        Usage:
+            The fingerprint of the predictions, which changes with the adapter weights, the base model,
+            the evaluator class and the generation config. Override it to add anything else that changes the predictions.
+        '''
+        config = {
+            'evaluator': f'{type(self).__module__}.{type(self).__qualname__}',
+            'model': getattr(getattr(self.model, 'config', None), '_name_or_path', ''),
+            'generation': self.generation_kwargs(),
+            'stop_at_bracket': self.stop_at_bracket,
+            'labels': self.labels,
+            'prefix': self.prefix_ids,
+        }
+        return model_fingerprint(self.model, config)
+
+    def decoding_kwargs(self, start: int) -> dict:
+        '''
+        Usage:
+            The stopping criteria and the constraint of model.generate, which depend on the length of the input ids (start).
+        '''
+        kwargs, criteria = {}, []
+        if self.stop_at_bracket:
+            criteria.append(BracketStoppingCriteria(self.tokenizer, start))
+        self._watchdog = None
+        if self.timeout:
+            finished_ids = {self.tokenizer.eos_token_id, self.generation_kwargs()['pad_token_id']}
+            self._watchdog = TimeoutStoppingCriteria(self.timeout, finished_ids, criteria=criteria)
+            criteria = [self._watchdog]
+        self._timer = None
+        if self.profile:
+            self._timer = FirstStepTimer()
+            criteria.append(self._timer)
+        if criteria:
+            kwargs['stopping_criteria'] = StoppingCriteriaList(criteria)
+        if self.grammar is not None:
+            kwargs['prefix_allowed_tokens_fn'] = self.grammar.prefix_allowed_tokens_fn(start)
+        return kwargs
+
+    def set_prefix(self, prefix: str):
+        '''
+        Usage:
+            Set the shared prefix of the prompts, e.g. the prompt template and the instruction before the input.
+            The key values of the prefix are computed once (once per batch size) and copied for each generation, 
+            so only the rest of the prompt is encoded. The prompts whose tokens do not start with the tokens 
+            of the prefix, e.g. the tokens are merged across the boundary, are generated without the cache.
+            Set it to '' to disable the cache, it must be set again after the model is changed.
+
+        Example:
+            self.set_prefix(alpaca_prompt.split('{}')[0] + instruction + alpaca_prompt.split('{}')[1])
+        '''
+        self.prefix_ids = self.tokenizer(prefix)['input_ids'] if prefix else []
+        self._prefix_cache = {}
+
+    def _prefix_past(self, batch_size: int) -> Any:
+        if batch_size not in self._prefix_cache:
+            input_ids = torch.tensor([self.prefix_ids] * batch_size, device=self.device)
+            with torch.no_grad():
+                self._prefix_cache[batch_size] = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        return copy.deepcopy(self._prefix_cache[batch_size])      # generate extends the cache in place
+
+    def _encode(self, prompts: list[str]) -> list[list[int]]:
+        ''' The token ids of the prompts, the prompts that have been tokenized in the current window are not tokenized again. '''
+        if self._encodings is None:         # e.g. inference is called directly, nothing is kept
+            return self.tokenizer(prompts)['input_ids']
+        new = [prompt for prompt in dict.fromkeys(prompts) if prompt not in self._encodings]
+        if new:
+            self._encodings.update(zip(new, self.tokenizer(new)['input_ids']))
+        return [self._encodings[prompt] for prompt in prompts]
+
+    def _generate(self, prompts: list[str]) -> Any:
+        '''
+        Usage:
+            Generate the prompts in a batch, with the prefix cache if all of them start with the prefix.
+
+        Returns:
+            The generated token ids, each row includes the prompt.
+        '''
+        tokenize_start = time.perf_counter()
+        ids = self._encode(prompts)
+        k = len(self.prefix_ids)
+        length = max(len(x) for x in ids)
+        pad_token_id = self.generation_kwargs()['pad_token_id']
+        prefixed = bool(k) and all(len(x) > k and x[:k] == self.prefix_ids for x in ids)
+        if prefixed:
+            # [prefix][pad ... pad][rest of the prompt], the pads are masked and skipped by the position ids
+            input_ids = [x[:k] + [pad_token_id] * (length - len(x)) + x[k:] for x in ids]
+            attention_mask = [[1] * k + [0] * (length - len(x)) + [1] * (len(x) - k) for x in ids]
+        else:
+            # left padding, so that the generation of each prompt starts right after it
+            input_ids = [[pad_token_id] * (length - len(x)) + x for x in ids]
+            attention_mask = [[0] * (length - len(x)) + [1] * len(x) for x in ids]
+        inputs = {
+            'input_ids': torch.tensor(input_ids, device=self.device), 
+            'attention_mask': torch.tensor(attention_mask, device=self.device),
+        }
+        start = inputs['input_ids'].shape[1]
+        tokenize_end = time.perf_counter()
+        with torch.no_grad():
+            if prefixed:
+                inputs['past_key_values'] = self._prefix_past(len(prompts))
+            output = self.model.generate(**inputs, **self.generation_kwargs(), **self.decoding_kwargs(start))
+        if self.profile:
+            end = time.perf_counter()
+            first_step = self._timer.first_step or end
+            pad_token_id = self.generation_kwargs()['pad_token_id']
+            self._generation_profile = {
+                'prompt_tokens': inputs['attention_mask'].sum(1).tolist(),
+                'generated_tokens': (output[:, start:] != pad_token_id).sum(1).tolist(),
+                'tokenize': tokenize_end - tokenize_start,
+                'prefill': first_step - tokenize_end,
+                'decode': end - first_step,
+            }
+        return output
 
     def inference(self, 
         prompt: str,
@@ -34,25 +299,72 @@ class ABCEvaluator(ABC):
             :stream: Whether to use streaming inference or not. Default is False.
 
         Returns:
-            The generated output.
+            The generated output, or None if it is timed out.
         '''
-        inputs = self.tokenizer([prompt], return_tensors = "pt").to("cuda")
-
+        self.last_timed_out = [False]
         if stream:
+            inputs = self.tokenizer([prompt], return_tensors = "pt").to(self.device)
             text_streamer = TextStreamer(self.tokenizer)
             output = self.model.generate(**inputs, streamer=text_streamer, max_new_tokens=self.max_new_tokens)
 
         else:
-            output = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, do_sample=True, top_p=0.9, top_k=50, temperature=1.0, num_return_sequences=1)
+            output = self._generate([prompt])
             output = self.tokenizer.batch_decode(output, skip_special_tokens = True)[0]
+            if self._watchdog is not None and self._watchdog.timed_out:
+                self.last_timed_out = [True]
+                return None
         return output
 
-    @abstractmethod
+    def inference_batch(self, prompts: list[str]) -> list[str]:
+        '''
+        Usage:
+            Input a batch of prompts and get the generated outputs in the same order.
+            The prompts are left-padded, so that the generation of each prompt starts right after it,
+            and the outputs are the same as inference(prompt) in greedy mode (do_sample=False).
+
+        Parameters:
+            :prompts: The input prompts
+
+        Returns:
+            The generated outputs, each of them includes the prompt like inference, or None if it is timed out.
+        '''
+        if len(prompts) == 1:
+            return [self.inference(prompts[0])]
+        outputs = self.tokenizer.batch_decode(self._generate(prompts), skip_special_tokens = True)
+        timed_out = set(self._watchdog.timed_out) if self._watchdog is not None else set()
+        self.last_timed_out = [i in timed_out for i in range(len(prompts))]
+        return [None if i in timed_out else output for i, output in enumerate(outputs)]
+
+    def prompt(self, data: dict) -> str:
+        '''
+        Usage:
+            Optional hook, build the prompt of a data dictionary. 
+            If it is implemented with parse, forward and forward_batch are implemented by them,
+            and the examples are generated in batches of similar prompt lengths.
+
+        Example:
+            def prompt(self, data: dict) -> str:
+                return alpaca_prompt.format(data['instruction'], data['input'], "")
+        '''
+        return None
+
+    def parse(self, output: str, data: dict) -> tuple[Any, Any]:
+        '''
+        Usage:
+            Optional hook, parse the generated output of the prompt(data) into a tuple of predicted output and gold output.
+            The output is None if the generation is timed out, see timeout.
+
+        Example:
+            def parse(self, output: str, data: dict) -> tuple[str, str]:
+                return output.split('### Response:')[-1].strip(), data['output']
+        '''
+        raise NotImplementedError("Implement parse with prompt, or override forward")
+
     def forward(self, data: dict) -> tuple[str, str]:
         '''
         Usage:
-            This is an abstract method that needs to be implemented by the child class.
             It takes in a data dictionary and returns a tuple of predicted output and gold output.
+            The child class should either override it, or implement the prompt and parse hooks.
 
         Parameters:
             :data: A data dictionary containing the input prompt and the gold output.
@@ -73,7 +385,120 @@ class ABCEvaluator(ABC):
                 output = self.inference(prompt)
                 return output, gold
         '''
-        pass
+        prompt = self.prompt(data)
+        if prompt is None:
+            raise NotImplementedError("Override forward, or implement the prompt and parse hooks")
+        return self.parse(self.inference(prompt), data)
+
+    def forward_batch(self, batch: list[dict]) -> list[tuple[Any, Any]]:
+        '''
+        Usage:
+            It takes in a batch of data dictionaries and returns a list of (predicted output, gold output).
+            If the prompt hook is implemented, the prompts are generated in one batch by inference_batch,
+            otherwise, forward is called for each example.
+        '''
+        prompts = [self.prompt(data) for data in batch]
+        if any(prompt is None for prompt in prompts):
+            results, timed_out = [], []
+            for data in batch:
+                self.last_timed_out = []
+                results.append(self.forward(data))
+                timed_out.append(any(self.last_timed_out))
+            self.last_timed_out = timed_out
+            return results
+        self._generation_profile = {}
+        outputs = self.inference_batch(prompts)
+        timed_out = self.last_timed_out
+        if not self.profile:
+            results = [self.parse(output, data) for output, data in zip(outputs, batch)]
+            self.last_timed_out = timed_out
+            return results
+        results, profiles, generation = [], [], self._generation_profile
+        for j, (output, data) in enumerate(zip(outputs, batch)):
+            start = time.perf_counter()
+            results.append(self.parse(output, data))
+            profile = {key: generation[key][j] if isinstance(generation[key], list) else generation[key] for key in generation}
+            profile['parse'] = time.perf_counter() - start
+            profiles.append(profile)
+        self.last_timed_out, self.last_profile = timed_out, profiles
+        return results
+
+    def _batches(self, records: list[dict]) -> list[list[int]]:
+        '''
+        Usage:
+            Group the records into batches of similar prompt lengths, under batch_size and max_batch_tokens.
+
+        Returns:
+            The batches of the indices of the records.
+        '''
+        prompts = [self.prompt(data) for data in records]
+        if self.batch_size <= 1 or any(prompt is None for prompt in prompts):
+            return [[i] for i in range(len(records))]
+        lengths = [len(ids) for ids in self._encode(prompts)]
+        batches, batch = [], []
+        for i in sorted(range(len(records)), key=lambda i: lengths[i]):
+            tokens = (len(batch) + 1) * (lengths[i] + self.max_new_tokens)      # lengths[i] is the longest one
+            if batch and (len(batch) >= self.batch_size or (self.max_batch_tokens and tokens > self.max_batch_tokens)):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def cache_key(self, data: dict) -> str:
+        '''
+        Usage:
+            The key of an example in the prediction cache, the hash of the record and its rendered prompt,
+            so the cached predictions are not reused after the instruction or the template of the prompts changes.
+            Without the prompt hook, only the record is hashed, override it if forward reads anything else.
+        '''
+        prompt = self.prompt(data)
+        return record_hash(data if prompt is None else {'record': data, 'prompt': prompt})
+
+    def _predict_all(self, records: Iterable[dict], cache: PredictionCache = None) -> Iterator[tuple[dict, tuple[Any, Any]]]:
+        '''
+        Usage:
+            Predict all the records, batch_size * bucket_window records are read at a time 
+            and generated in batches by forward_batch. 
+            If cache is provided, the cached records are skipped and the new predictions are added to it.
+            The timed-out examples are kept in self.timeouts by their indices, with the latency of their batches,
+            and they are not cached. If profile, the profile of each predicted example is appended to self.profiles.
+
+        Returns:
+            An iterator of (data, (predicted output, gold output)) in the order of the records.
+        '''
+        records, offset = iter(records), 0
+        while True:
+            window = list(islice(records, self.batch_size * self.bucket_window))
+            if not window:
+                return
+            keys = [self.cache_key(data) for data in window] if cache else []
+            results = [cache.get(key) for key in keys] if cache else [None] * len(window)
+            todo = [i for i, result in enumerate(results) if result is None]
+            self._encodings = {}        # the prompts of the window are tokenized once, and released after the window
+            try:
+                for batch in self._batches([window[i] for i in todo]) if todo else []:
+                    batch = [todo[j] for j in batch]
+                    start = time.time()
+                    self.last_timed_out, self.last_profile = [], []
+                    predictions = self.forward_batch([window[i] for i in batch])
+                    latency, timed_out = time.time() - start, self.last_timed_out
+                    for k, (i, result) in enumerate(zip(batch, predictions)):
+                        results[i] = result
+                        if self.profile:
+                            profile = self.last_profile[k] if k < len(self.last_profile) else {}
+                            late = k < len(timed_out) and timed_out[k]
+                            parsed = not late and result[0] is not None and not (isinstance(result[0], (str, list, tuple, dict)) and not result[0])
+                            self.profiles.append({'index': offset + i, 'batch_size': len(batch), 'latency': latency, **profile, 'timed_out': late, 'parsed': parsed})
+                        if k < len(timed_out) and timed_out[k]:
+                            self.timeouts[offset + i] = latency
+                        elif cache:
+                            cache.add(keys[i], result)
+            finally:
+                self._encodings = None
+            offset += len(window)
+            yield from zip(window, results)
 
     @abstractmethod
     def metric(self, pred: Any, gold: Any) -> dict[str, float]:
@@ -136,43 +561,200 @@ class ABCEvaluator(ABC):
     def evaluate(self, 
         test_file_path: str,
         wrong_output_path: str = '',
+        target: str = '',
+        best_score: float = None,
+        abort: Literal['provable', 'statistical'] = None,
+        min_examples: int = 30,
+        max_examples: int = 0,
+        max_time: float = 0,
+        confidence: float = 0.95,
     ) -> dict[str, float]:
         '''
         Usage:
             This method evaluates the model on a test file and returns a dictionary of metrics.
             If the wrong_output_path is provided, it will save the wrong predictions to the file.
+            The metrics are aggregated incrementally by metrics.RunningMetrics with running confidence intervals,
+            so the evaluation can stop early:
+                1. If abort is set, stop once the target metric can not beat best_score, 
+                   provable: even if all the rest examples get the highest score (the metric should be in [0, 1]),
+                   statistical: the upper bound of the confidence interval is lower than best_score.
+                2. Stop after max_examples examples or max_time seconds.
+            If label_vocab is provided, the predicted and gold labels are encoded as multi-hot matrices, 
+            and the sample-averaged precision, recall, f1_score, the micro and macro ones and exact_match are 
+            computed in one vectorized pass, see metrics.MultiLabelMetrics. Otherwise, metric of each example is averaged.
+            The statistics are kept in self.last_stats, with the per-intent metrics and confusion if label_vocab is provided.
+            If cache_dir is provided, the examples predicted by the same model and config are read from the cache,
+            the number of them is kept as "cached".
+            If timeout is set, the timed-out examples are wrong predictions, their indices in the test file 
+            and latencies are kept as "timeouts".
+            If profile is set, the percentiles of the tokens and the phase timings, the throughput and the ratio of
+            the parsed examples (not timed out, and the prediction is not empty) are kept as "profile", and they are
+            saved with the profile of each example to the wrong_output_path with the extension .profile.json.
+            Example:
+                {"examples": 120, "total": 300, "stopped": "provable", "elapsed": 35.2, "cached": 0,
+                 "timeouts": [{"index": 17, "latency": 5.01}],
+                 "intervals": {"f1_score": [0.61, 0.72], ...},
+                 "per_intent": {"label1": {"precision": 0.9, "recall": 0.8, "f1": 0.85, "support": 20, "predicted": 18}, ...},
+                 "confusion": {"label1": {"label2": 3, ...}, ...}}
 
         Parameters:
             :test_file_path: The path to the test file.
             :wrong_output_path: The path to the file to save the wrong predictions. Default is ''.
+            :target: The metric to compare with best_score, e.g. f1_score.
+            :best_score: The best score so far, e.g. of the previous iterations of finetune.
+            :abort: The mode of early abort, None, provable or statistical.
+            :min_examples: The minimum number of examples before the statistical abort.
+            :max_examples: The maximum number of examples to evaluate, 0 means no limit.
+            :max_time: The maximum seconds of the evaluation, 0 means no limit.
+            :confidence: The confidence level of the intervals.
 
         Returns:
-            A dictionary of metrics.
+            A dictionary of metrics, the mean of the evaluated examples.
         '''
-        wrong_data = []
-        total_metric = {}
-        with open(test_file_path, 'r') as f:
-            if test_file_path.endswith('.jsonl'):
-                lines = f.readlines()
-                dataset = [json.loads(line) for line in lines]
-            elif test_file_path.endswith('.json'):
-                dataset = json.load(f)
-            else:
-                raise ValueError('Unsupported file format')
-        
-        for data in tqdm(dataset, desc='Evaluating'):
-            pred, gold = self.forward(data)
-            metric = self.metric(pred, gold)
-            for k, v in metric.items():
-                if k not in total_metric:
-                    total_metric[k] = 0.0
-                total_metric[k] += v
-            if self.is_wrong(pred, gold):
-                wrong_data.append(data)
-
-        if wrong_output_path:
-            with open(wrong_output_path, 'w', encoding='utf-8') as f:
-                for data in wrong_data:
+        if not test_file_path.endswith(FORMATS):
+            raise ValueError('Unsupported file format')
+        if abort and (not target or best_score is None):
+            raise ValueError('abort requires target and best_score')
+
+        total = sum(1 for _ in iter_records(test_file_path)) if abort else None
+        running = RunningMetrics(total=total, confidence=confidence)
+        multi = MultiLabelMetrics(self.label_vocab) if self.label_vocab else None
+        cache = PredictionCache(self.cache_dir, self.fingerprint()) if self.cache_dir else None
+        self.timeouts = {}
+        self.profiles = []
+        stopped = None
+        start = time.time()
+        with open(wrong_output_path or os.devnull, 'w', encoding='utf-8') as f:
+            for data, (pred, gold) in tqdm(self._predict_all(iter_records(test_file_path), cache), total=total, desc='Evaluating'):
+                running.add(multi.add(pred, gold) if multi else self.metric(pred, gold))
+                if self.is_wrong(pred, gold) or running.count - 1 in self.timeouts:
+                    f.write(json.dumps(data, ensure_ascii=False) + '\n')
+                if abort and running.hopeless(target, best_score, abort, min_examples):
+                    stopped = abort
+                elif max_examples and running.count >= max_examples:
+                    stopped = 'max_examples'
+                elif max_time and time.time() - start >= max_time:
+                    stopped = 'max_time'
+                if stopped:
+                    tqdm.write(f"Stop the evaluation after {running.count} examples: {stopped}")
+                    break
+        if cache:
+            cache.close()
+
+        self.last_stats = {
+            'examples': running.count,
+            'total': total,
+            'stopped': stopped,
+            'elapsed': time.time() - start,
+            'intervals': running.intervals(),
+            'cached': cache.hits if cache else 0,
+            'timeouts': [{'index': i, 'latency': latency} for i, latency in sorted(self.timeouts.items()) if i < running.count],
+        }
+        if self.profile:
+            self.save_profile(os.path.splitext(wrong_output_path)[0] + '.profile.json' if wrong_output_path else '')
+        if multi is None:
+            return running.means()
+        metrics, report = multi.compute()
+        self.last_stats.update(report)
+        return metrics
+
+    def save_profile(self, profile_path: str = ''):
+        '''
+        Usage:
+            Summarize self.profiles of the last evaluation into self.last_stats['profile'], 
+            and save the summary and the profile of each example to profile_path if it is provided.
+        '''
+        profiles = [profile for profile in self.profiles if profile['index'] < self.last_stats['examples']]
+        self.last_stats['profile'] = _save_profile(profiles, self.last_stats['elapsed'], profile_path)
+
+    @classmethod
+    def evaluate_sharded(cls,
+        model_factory: Callable[[str], tuple[Any, Any]],
+        test_file_path: str,
+        wrong_output_path: str = '',
+        devices: list[str] = None,
+        evaluator_kwargs: dict = None,
+        stats: dict = None,
+    ) -> dict[str, float]:
+        '''
+        Usage:
+            Evaluate the test file in len(devices) worker processes, each of them loads its own model on its device
+            by model_factory, and evaluates the records i % len(devices) == k by the forward, metric and is_wrong of cls.
+            The processes are spawned, so model_factory and cls must be importable (defined at the top level of a module,
+            and the script is guarded by if __name__ == '__main__'), and CUDA works in the workers.
+            The results are merged in the order of the test file, so the metrics and the wrong predictions are the same 
+            as evaluate in one process (with deterministic decoding). It does not stop early.
+            Each worker caches its predictions to its own shard file, and the shard files are merged into the cache
+            of the fingerprint after all the workers finish. The timeouts and the profiles of the workers are merged
+            by their indices in the test file into stats, with the same keys as last_stats of evaluate.
+
+        Parameters:
+            :model_factory: a picklable function that takes a device, e.g. 'cuda:1' or 'cpu', and returns (model, tokenizer)
+            :test_file_path: The path to the test file.
+            :wrong_output_path: The path to the file to save the wrong predictions. Default is ''.
+            :devices: the device of each worker process, e.g. ['cuda:0', 'cuda:1'], or ['cpu'] * 4 on a CPU-only host,
+                the CPU threads are split among the workers on cpu. Default to ['cpu', 'cpu'].
+            :evaluator_kwargs: the other arguments of cls, e.g. max_new_tokens and batch_size
+            :stats: if provided, it is updated with the statistics of the evaluation, see evaluate
+
+        Returns:
+            A dictionary of metrics, the same as evaluate.
+
+        Example:
+            def load_model(device):
+                return FastLanguageModel.from_pretrained(model_name="../lora_model", load_in_4bit=True, device_map={'': device})
+
+            if __name__ == '__main__':
+                result = Evaluator.evaluate_sharded(load_model, "../dataset/test.jsonl", devices=['cuda:0', 'cuda:1'])
+        '''
+        if not test_file_path.endswith(FORMATS):
+            raise ValueError('Unsupported file format')
+        devices = ['cpu', 'cpu'] if devices is None else devices
+        evaluator_kwargs = evaluator_kwargs or {}
+        if not devices:
+            raise ValueError('devices is empty')
+
+        start = time.time()
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=len(devices), mp_context=context) as executor:
+            futures = [
+                executor.submit(_evaluate_shard, cls, model_factory, device, test_file_path, k, len(devices), evaluator_kwargs)
+                for k, device in enumerate(devices)
+            ]
+            shards = [future.result() for future in futures]
+
+        if shards[0]['cache']:
+            PredictionCache.merge_shards(*shards[0]['cache'])
+
+        label_vocab = shards[0]['label_vocab']
+        results = sorted((result for shard in shards for result in shard['results']), key=lambda result: result[0])
+        running = RunningMetrics()
+        multi = MultiLabelMetrics(label_vocab) if label_vocab else None
+        with open(wrong_output_path or os.devnull, 'w', encoding='utf-8') as f:
+            for data, (_, pred, gold, metric, wrong) in zip(iter_records(test_file_path), results):
+                running.add(multi.add(pred, gold) if multi else metric)
+                if wrong:
                     f.write(json.dumps(data, ensure_ascii=False) + '\n')
 
-        return {k: v / len(dataset) for k, v in total_metric.items()}
\ No newline at end of file
+        timeouts = {i: latency for shard in shards for i, latency in shard['timeouts'].items()}
+        profiles = sorted((profile for shard in shards for profile in shard['profiles']), key=lambda profile: profile['index'])
+        elapsed = time.time() - start
+        merged = {
+            'examples': running.count,
+            'total': running.count,
+            'stopped': None,
+            'elapsed': elapsed,
+            'intervals': running.intervals(),
+            'cached': sum(shard['cached'] for shard in shards),
+            'timeouts': [{'index': i, 'latency': latency} for i, latency in sorted(timeouts.items())],
+        }
+        if shards[0]['profile']:
+            profile_path = os.path.splitext(wrong_output_path)[0] + '.profile.json' if wrong_output_path else ''
+            merged['profile'] = _save_profile(profiles, elapsed, profile_path)
+        metrics = running.means()
+        if multi is not None:
+            metrics, report = multi.compute()
+            merged.update(report)
+        if stats is not None:
+            stats.update(merged)
+        return metrics
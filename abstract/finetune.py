@@ -5,9 +5,23 @@ from datasets import load_dataset
 from trl import SFTTrainer
 from transformers import TrainingArguments
 from dataAug import DataAugmentation
+from evalPlan import EvalPlan
+from tokenCache import TokenizedDatasetCache
+from reader import iter_records, resolve_files
+from columnar import ColumnarDataset, is_columnar
 from typing import Any, Callable
 import torch
 
+def load_train_dataset(train_dataset_path: str) -> Any:
+    '''
+    Usage:
+        Load the training dataset as a Hugging Face Dataset, 
+        it can be a json or jsonl file, a sharded output with a manifest or a columnar dataset (ends with .col).
+    '''
+    if is_columnar(train_dataset_path):
+        return ColumnarDataset(train_dataset_path).to_hf()
+    return load_dataset('json', data_files=resolve_files(train_dataset_path), split='train')
+
 class FineTune:
     def __init__(self, 
         model_name: str = "unsloth/mistral-7b-instruct-v0.3-bnb-4bit",      
@@ -86,7 +100,14 @@ class FineTune:
         aug_funcs: list[Callable] = [],
         metric: str = "f1_score",
         aug_threshold: float = 0.02,
-        output_info: str = ''
+        output_info: str = '',
+        reference_index: str = '',
+        aug_workers: int = 1,
+        eval_batch_size: int = 1,
+        eval_abort: str = None,
+        eval_cache_dir: str = '',
+        eval_sample_size: int = 0,
+        tokenized_cache_dir: str = ''
     ):
         '''
         Usage:
@@ -116,7 +137,7 @@ class FineTune:
                         return { "text" : texts, }
             :max_step_each: The maximum number of steps to train for each iteration.
             :learning_rate: The learning rate to use for training.
-            :train_dataset_path: The path to the training dataset.
+            :train_dataset_path: The path to the training dataset, a jsonl file or a columnar dataset (ends with .col).
             :test_dataset_path: The path to the test dataset.
             :wrong_dataset_path: The path to the write the wrong predictions dataset.
             :model_save_path: The path to save the best model according to the metric.
@@ -138,9 +159,23 @@ class FineTune:
                             history=history, 
                         )
                         return prompt
+                The functions are fused in one pass of augmentation, and the augmented data is tagged with the function name in 'aug_func'.
             :metric: The metric to use for evaluation.
             :aug_threshold: The threshold for augmentation. If the score does not improve by this amount, stop augmenting.
             :output_info: A string to output at the beginning of the results.txt file.
+            :reference_index: The directory of a ReferenceIndex shared by all the iterations, 
+                so that the augmented data is not repetitive to the data augmented in the previous iterations.
+            :aug_workers: The number of seeds to augment concurrently.
+            :eval_batch_size: The batch size of the evaluation, see ABCEvaluator.
+            :eval_abort: None, 'provable' or 'statistical', stop the evaluation early once the metric can not beat 
+                the best score of the previous iterations, then the finetune stops as the score does not improve.
+            :eval_cache_dir: The directory of the prediction cache of the evaluation, see ABCEvaluator, 
+                so a re-run with the same adapter weights (e.g. after a crash) does not generate again.
+            :eval_sample_size: If it is positive, the iterations after the first one are evaluated on a stratified subsample
+                of this size first (see evalPlan.EvalPlan), and the full test set is only evaluated if the upper bound 
+                of the confidence interval of the metric on the subsample reaches the best score, i.e. a possible new best.
+            :tokenized_cache_dir: The directory of the tokenized training records, see tokenCache.TokenizedDatasetCache.
+                If it is provided, only the records appended by the augmentation are formatted and tokenized in each iteration.
 
         Returns:
             Save the best model according to the metric to the model_save_path.
@@ -163,10 +198,18 @@ class FineTune:
             output_dir = "outputs",
         )
 
-        dataset = load_dataset('json', data_files=train_dataset_path, split='train')
-        train_dataset = dataset.map(formatting_prompts_func, batched = True, fn_kwargs={"EOS": self.EOS_TOKEN})
+        token_cache = None
+        if tokenized_cache_dir:
+            token_cache = TokenizedDatasetCache(tokenized_cache_dir, self.tokenizer, formatting_prompts_func, self.max_seq_length, self.EOS_TOKEN)
+
+        dataset = load_train_dataset(train_dataset_path)
+        if token_cache is not None:
+            train_dataset = token_cache.update(dataset)
+        else:
+            train_dataset = dataset.map(formatting_prompts_func, batched = True, fn_kwargs={"EOS": self.EOS_TOKEN})
 
         last_score = 0
+        plan = EvalPlan(test_dataset_path, eval_sample_size) if eval_sample_size > 0 else None
 
         for i in range(max_iter):
 
@@ -180,7 +223,8 @@ class FineTune:
                 max_seq_length = self.max_seq_length,
                 dataset_num_proc = 1,
                 packing = False, # Can make training 5x faster for short sequences.
-                args = arguments
+                args = arguments,
+                **({'dataset_kwargs': {'skip_prepare_dataset': True}} if token_cache is not None else {})     # tokenized by token_cache
             )
 
             trainer_stats = trainer.train()
@@ -189,8 +233,17 @@ class FineTune:
                 model.save_pretrained(model_save_path)
                 self.tokenizer.save_pretrained(model_save_path)
 
-            evaluator = self.Evaluator(model, self.tokenizer, max_new_tokens=100)
-            result = evaluator.evaluate(test_file_path=test_dataset_path, wrong_output_path=wrong_dataset_path)
+            evaluator = self.Evaluator(model, self.tokenizer, max_new_tokens=100, batch_size=eval_batch_size, cache_dir=eval_cache_dir)
+            sampled = None      # the interval of the metric on the subsample, if the full evaluation is skipped
+            if plan is not None and not plan.full and last_score > 0:
+                result = plan.evaluate(evaluator, wrong_output_path=wrong_dataset_path)
+                low, high = evaluator.last_stats['intervals'].get(metric, (0.0, 1.0))
+                print(f"{metric} on the subsample of {plan.size} examples: {result.get(metric, 0.0): 0.4f} [{low: 0.4f}, {high: 0.4f}]")
+                if high < last_score:       # it can not be a new best, skip the full evaluation
+                    sampled = (low, high)
+            if sampled is None:
+                result = evaluator.evaluate(test_file_path=test_dataset_path, wrong_output_path=wrong_dataset_path, 
+                                            target=metric, best_score=last_score, abort=eval_abort)
             
             for key, value in result.items():
                 print(f"{key}: {value: 0.4f}")
@@ -200,8 +253,7 @@ class FineTune:
                 return
             score = result[metric]
 
-            with open(wrong_dataset_path, 'r', encoding='utf-8') as f:
-                length = len(f.readlines())
+            length = sum(1 for _ in iter_records(wrong_dataset_path))
 
             with open('results.txt', 'a') as f:
                 if output_info:
@@ -211,7 +263,12 @@ class FineTune:
                 for key, value in result.items():
                     f.write(f'\t{key}: {value: 0.4f}\n')
                 f.write(f'\ttrain dataset size: {len(train_dataset)}\n')
-                f.write(f'\twrong dataset size: {length}\n\n')
+                f.write(f'\twrong dataset size: {length}\n')
+                if sampled is not None:
+                    f.write(f"\tevaluated on the subsample of {plan.size} examples, {metric} interval: [{sampled[0]: 0.4f}, {sampled[1]: 0.4f}]\n")
+                if evaluator.last_stats.get('stopped'):
+                    f.write(f"\tevaluation stopped after {evaluator.last_stats['examples']} examples: {evaluator.last_stats['stopped']}\n")
+                f.write('\n')
                 f.flush()
 
             if score > last_score:
@@ -227,12 +284,15 @@ class FineTune:
             if not aug_funcs:
                 break
 
-            for aug_func in aug_funcs:      # Augment the wrong predictions using the list of augmentation functions.
-                dataAug = DataAugmentation.from_file(wrong_dataset_path)
-                dataAug.augment(pool=self.pool, prompt_func=aug_func, output_path=train_dataset_path, from_log=False, repeat_num=repeat_num)
+            # Augment the wrong predictions using all the augmentation functions in one pass.
+            dataAug = DataAugmentation.from_file(wrong_dataset_path, index_dir=reference_index)
+            dataAug.augment(pool=self.pool, prompt_func=aug_funcs, output_path=train_dataset_path, from_log=False, repeat_num=repeat_num, workers=aug_workers, stream=True)
 
-            dataset = load_dataset('json', data_files=train_dataset_path, split='train')        # reload the augmented dataset
-            train_dataset = dataset.map(formatting_prompts_func, batched = True, fn_kwargs={"EOS": self.EOS_TOKEN})
+            dataset = load_train_dataset(train_dataset_path)        # reload the augmented dataset
+            if token_cache is not None:
+                train_dataset = token_cache.update(dataset)
+            else:
+                train_dataset = dataset.map(formatting_prompts_func, batched = True, fn_kwargs={"EOS": self.EOS_TOKEN})
 
             del model       # Free up memory
             torch.cuda.empty_cache()
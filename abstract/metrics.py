@@ -0,0 +1,233 @@
+import math
+import numpy as np
+from statistics import NormalDist
+from typing import Any
+
+class RunningMetrics:
+    ''' This is an aggregator of the per-example metrics, which keeps the running mean and variance of each metric. '''
+    def __init__(self, total: int = None, confidence: float = 0.95, metric_range: tuple[float, float] = (0.0, 1.0)):
+        '''
+        Usage:
+            Add the metrics of each example, then get the mean and the confidence interval of each metric at any time.
+            The mean and variance are updated by Welford's algorithm, so the memory does not grow with the examples.
+
+        Parameters:
+            :total: the number of examples in the test set, if known, it is used by the finite population correction
+                and the provable bounds.
+            :confidence: the confidence level of the intervals.
+            :metric_range: the range of the per-example metrics, e.g. (0, 1) for precision, recall and f1_score.
+        '''
+        self.total = total
+        self.confidence = confidence
+        self.metric_range = metric_range
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.count = 0
+        self.sums = {}          # metric -> the sum of the metric, the examples without the metric count as 0
+        self._means = {}
+        self._m2 = {}
+
+    def add(self, metric: dict[str, float]):
+        self.count += 1
+        for k in set(self._means) | set(metric):
+            v = float(metric.get(k, 0.0))
+            mean = self._means.get(k, 0.0)
+            if k not in self._means:        # the previous examples without the metric count as 0
+                self._m2[k] = mean = 0.0
+            delta = v - mean
+            mean += delta / self.count
+            self._m2[k] += delta * (v - mean)
+            self._means[k] = mean
+            self.sums[k] = self.sums.get(k, 0.0) + v
+
+    def mean(self, key: str) -> float:
+        return self._means.get(key, 0.0)
+
+    def means(self) -> dict[str, float]:
+        return dict(self._means)
+
+    def interval(self, key: str) -> tuple[float, float]:
+        '''
+        Usage:
+            The normal confidence interval of the mean of the metric over the whole test set,
+            with the finite population correction if total is known, clipped to metric_range.
+        '''
+        low, high = self.metric_range
+        if self.count < 2:
+            return low, high
+        std = math.sqrt(self._m2.get(key, 0.0) / (self.count - 1) / self.count)
+        if self.total and self.total > 1:
+            std *= math.sqrt(max(self.total - self.count, 0) / (self.total - 1))
+        mean = self.mean(key)
+        return max(low, mean - self.z * std), min(high, mean + self.z * std)
+
+    def intervals(self) -> dict[str, tuple[float, float]]:
+        return {k: self.interval(k) for k in self._means}
+
+    def upper_bound(self, key: str) -> float:
+        '''
+        Usage:
+            The best mean of the metric over the whole test set if all the rest examples get the highest score,
+            it requires total.
+        '''
+        if not self.total:
+            return self.metric_range[1]
+        rest = max(self.total - self.count, 0)
+        return (self.sums.get(key, 0.0) + rest * self.metric_range[1]) / max(self.total, self.count)
+
+    def hopeless(self, key: str, best: float, mode: str = 'provable', min_examples: int = 30) -> bool:
+        '''
+        Usage:
+            Whether the mean of the metric over the whole test set can not beat best.
+            provable: even if all the rest examples get the highest score, see upper_bound.
+            statistical: the upper bound of the confidence interval is lower than best, after min_examples examples.
+        '''
+        if mode == 'provable':
+            return self.upper_bound(key) < best
+        if mode == 'statistical':
+            return self.count >= min_examples and self.interval(key)[1] < best
+        raise ValueError(f"Unsupported abort mode: {mode}")
+
+class MultiLabelMetrics:
+    ''' This is an aggregator of the multi-label predictions, which computes the metrics over multi-hot matrices. '''
+    def __init__(self, labels: list[str]):
+        '''
+        Usage:
+            Add the predicted and gold labels of each example, they are kept as label ids,
+            and encoded as multi-hot NumPy matrices over the labels at compute(), then all the metrics
+            are computed in one vectorized pass. Each distinct label that is not in the vocabulary gets its own column
+            (the ones that are not strings by their repr), so an unknown predicted label is a false positive 
+            unless the gold has the same label, and different unknown labels never match each other.
+            The unknown labels are reported, but not averaged in the macro metrics.
+
+        Parameters:
+            :labels: the label vocabulary, e.g. the intent names
+        '''
+        self.labels = list(labels)
+        self.known = len(self.labels)       # the columns after it are the unknown labels
+        self.index = {label: i for i, label in enumerate(self.labels)}
+        self.preds = []         # the label ids of each example
+        self.golds = []
+
+    def _id(self, label: Any) -> int:
+        label = label if isinstance(label, str) else repr(label)
+        if label not in self.index:
+            self.index[label] = len(self.labels)
+            self.labels.append(label)
+        return self.index[label]
+
+    def encode(self, labels: Any) -> list[int]:
+        if labels is None:
+            return []
+        if isinstance(labels, str) or not isinstance(labels, (list, tuple, set)):
+            labels = [labels]
+        return sorted({self._id(label) for label in labels})
+
+    def add(self, pred: Any, gold: Any) -> dict[str, float]:
+        '''
+        Usage:
+            Add an example.
+
+        Returns:
+            The precision, recall and f1_score of the example, e.g. for metrics.RunningMetrics.
+        '''
+        pred, gold = self.encode(pred), self.encode(gold)
+        self.preds.append(pred)
+        self.golds.append(gold)
+        tp = len(set(pred) & set(gold))
+        precision = tp / len(pred) if pred else 0.0
+        recall = tp / len(gold) if gold else 0.0
+        f1_score = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        return {'precision': precision, 'recall': recall, 'f1_score': f1_score}
+
+    def _matrix(self, rows: list[list[int]]) -> np.ndarray:
+        matrix = np.zeros((len(rows), len(self.labels)), dtype=bool)
+        lengths = np.array([len(row) for row in rows], dtype=np.int64)
+        if lengths.sum():
+            matrix[np.repeat(np.arange(len(rows)), lengths), np.concatenate([row for row in rows if row])] = True
+        return matrix
+
+    @staticmethod
+    def _f1(precision: np.ndarray, recall: np.ndarray) -> np.ndarray:
+        total = precision + recall
+        return np.divide(2 * precision * recall, total, out=np.zeros_like(total, dtype=float), where=total > 0)
+
+    def compute(self, top_k: int = 3) -> tuple[dict[str, float], dict[str, Any]]:
+        '''
+        Usage:
+            Compute the metrics of all the examples that have been added.
+
+        Parameters:
+            :top_k: the number of the most confused labels of each label in the report
+
+        Returns:
+            A tuple of (the metrics, the report).
+            The metrics are
+                precision, recall, f1_score: the average of the examples, the same as the set metrics of each example
+                micro_precision, micro_recall, micro_f1: over all the (example, label) pairs
+                macro_precision, macro_recall, macro_f1: the average of the known labels that are predicted or gold
+                exact_match: the ratio of the examples whose predicted labels are the same as the gold labels
+            The report is
+                per_intent: label -> {precision, recall, f1, support, predicted}
+                confusion: label -> the labels that are predicted instead when the label is missed, with their counts
+        '''
+        if not self.preds:
+            return {}, {'per_intent': {}, 'confusion': {}}
+        P, G = self._matrix(self.preds), self._matrix(self.golds)
+        hit = P & G
+        tp, pred_count, gold_count = hit.sum(0), P.sum(0), G.sum(0)
+        # the metrics of each example
+        tp_i, pred_i, gold_i = hit.sum(1), P.sum(1), G.sum(1)
+        precision_i = np.divide(tp_i, pred_i, out=np.zeros(len(P)), where=pred_i > 0)
+        recall_i = np.divide(tp_i, gold_i, out=np.zeros(len(P)), where=gold_i > 0)
+        # the metrics of each label
+        precision_l = np.divide(tp, pred_count, out=np.zeros(len(self.labels)), where=pred_count > 0)
+        recall_l = np.divide(tp, gold_count, out=np.zeros(len(self.labels)), where=gold_count > 0)
+        f1_l = self._f1(precision_l, recall_l)
+        active = (pred_count + gold_count) > 0
+        known = active.copy()
+        known[self.known:] = False      # the unknown labels are reported, but not averaged in the macro metrics
+        micro_precision = tp.sum() / pred_count.sum() if pred_count.sum() else 0.0
+        micro_recall = tp.sum() / gold_count.sum() if gold_count.sum() else 0.0
+        metrics = {
+            'precision': float(precision_i.mean()),
+            'recall': float(recall_i.mean()),
+            'f1_score': float(self._f1(precision_i, recall_i).mean()),
+            'micro_precision': float(micro_precision),
+            'micro_recall': float(micro_recall),
+            'micro_f1': float(self._f1(np.array(micro_precision), np.array(micro_recall))),
+            'macro_precision': float(precision_l[known].mean()) if known.any() else 0.0,
+            'macro_recall': float(recall_l[known].mean()) if known.any() else 0.0,
+            'macro_f1': float(f1_l[known].mean()) if known.any() else 0.0,
+            'exact_match': float((P == G).all(1).mean()),
+        }
+        # confusion[i, j]: the examples in which the gold label i is missed and the label j is predicted wrongly
+        confusion = (G & ~P).T.astype(np.int64) @ (P & ~G).astype(np.int64)
+        report = {'per_intent': {}, 'confusion': {}}
+        for i, label in enumerate(self.labels):
+            if not active[i]:
+                continue
+            report['per_intent'][label] = {
+                'precision': float(precision_l[i]), 'recall': float(recall_l[i]), 'f1': float(f1_l[i]),
+                'support': int(gold_count[i]), 'predicted': int(pred_count[i]),
+            }
+            top = [j for j in np.argsort(-confusion[i], kind='stable')[:top_k] if confusion[i, j] > 0]
+            if top:
+                report['confusion'][label] = {self.labels[j]: int(confusion[i, j]) for j in top}
+        return metrics, report
+
+def profile_summary(records: list[dict], keys: list[str], percentiles: tuple[int, ...] = (50, 90, 99)) -> dict[str, dict[str, float]]:
+    '''
+    Usage:
+        The mean and the percentiles of each key of the records, the records without the key are skipped.
+
+    Example:
+        {"prompt_tokens": {"mean": 120.5, "p50": 118, "p90": 160, "p99": 201, "count": 300}, ...}
+    '''
+    summary = {}
+    for key in keys:
+        values = np.array([record[key] for record in records if record.get(key) is not None], dtype=float)
+        if not len(values):
+            continue
+        summary[key] = {'mean': float(values.mean()), 'count': int(len(values))}
+        summary[key].update({f'p{q}': float(v) for q, v in zip(percentiles, np.percentile(values, percentiles))})
+    return summary
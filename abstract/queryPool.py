@@ -184,20 +184,33 @@ class QueryPool(ABC):
             self.input_js.append(js)
             return []
         else:
-            output_js = deepcopy(self.input_js)
-            all_scores = self.get_all_scores()
-            for name, threshold in self.get_score_thresholds().items():
-                prompt_key_names = self.get_prompt_key_name()[name]
-                if threshold < 0:
-                    scores = [0] * len(self.input_js)
-                else:
-                    scores = all_scores[name]
-                for score, js in zip(scores, self.input_js):
-                    if score < threshold:        # filter out the input if its score is lower than threshold
-                        prompt_key_values = ' '.join([str(js[key_name]) for key_name in prompt_key_names])
-                        logger.warning(f"🥶 The {name} score of user input is too low: {prompt_key_values} => {score}")
-                        if js in output_js:    
-                            output_js.remove(js)
-                        break
-            self.input_js = []
-            return output_js
+            return self.flush()
+
+    def flush(self) -> list[dict]:
+        '''
+        Usage:
+            Score all the inputs in the pool, empty the pool 
+            and return the output_js that satisfy all the score thresholds.
+
+        Returns:
+            A list of output_js that satisfy all the score thresholds.
+        '''
+        if not self.input_js:
+            return []
+        output_js = deepcopy(self.input_js)
+        all_scores = self.get_all_scores()
+        for name, threshold in self.get_score_thresholds().items():
+            prompt_key_names = self.get_prompt_key_name()[name]
+            if threshold < 0:
+                scores = [0] * len(self.input_js)
+            else:
+                scores = all_scores[name]
+            for score, js in zip(scores, self.input_js):
+                if score < threshold:        # filter out the input if its score is lower than threshold
+                    prompt_key_values = ' '.join([str(js[key_name]) for key_name in prompt_key_names])
+                    logger.warning(f"🥶 The {name} score of user input is too low: {prompt_key_values} => {score}")
+                    if js in output_js:    
+                        output_js.remove(js)
+                    break
+        self.input_js = []
+        return output_js
@@ -0,0 +1,138 @@
+import os
+import gzip
+import json
+import codecs
+from typing import Iterator, Any
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SEPARATORS = ' \t\r\n,[]'     # the characters between records in .json arrays and .jsonl files
+CHUNK_SIZE = 1 << 16
+FORMATS = ('.json', '.jsonl', '.json.gz', '.jsonl.gz', '.json.zst', '.jsonl.zst', '.col')
+MANIFEST = '.manifest.json'     # the manifest of a sharded output, see writer.RecordWriter
+
+def compression_of(file_path: str) -> str:
+    if file_path.endswith('.gz'):
+        return 'gzip'
+    if file_path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+def open_binary(file_path: str) -> Any:
+    '''
+    Usage:
+        Open a file in binary mode, the file ends with .gz or .zst is decompressed transparently.
+    '''
+    compression = compression_of(file_path)
+    if compression == 'gzip':
+        return gzip.open(file_path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("Reading .zst requires zstandard, please pip install zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), read_across_frames=True, closefd=True)
+    return open(file_path, 'rb')
+
+def resolve_files(file_path: str) -> list[str]:
+    '''
+    Usage:
+        Get the files of a dataset. If there is a manifest of the sharded output 
+        (file_path + '.manifest.json', or file_path is the manifest itself), return its shards in order.
+        Otherwise, return [file_path].
+    '''
+    manifest_path = file_path if file_path.endswith(MANIFEST) else file_path + MANIFEST
+    if not os.path.exists(manifest_path):
+        return [file_path]
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    dirname = os.path.dirname(manifest_path)
+    return [os.path.join(dirname, shard['path']) for shard in manifest['shards']]
+
+def exists(file_path: str) -> bool:
+    return os.path.exists(file_path) or os.path.exists(file_path + MANIFEST)
+
+def iter_records(file_path: str, offset: int = 0, with_offset: bool = False) -> Iterator[Any]:
+    '''
+    Usage:
+        Lazily read the records (dict) from a file, only a small buffer is kept in memory.
+        All these formats are supported, optionally compressed by gzip (ends with .gz):
+            1. A json array of records, which is parsed incrementally.
+            Example:
+                [
+                    {"text": "This is a sample text."},
+                    {"text": "This is another sample text."}
+                ]
+            2. Each line is a valid json string.
+            Example:
+                {"text": "This is a sample text."}
+            3. There is a indention of 4 spaces, e.g. the output of augment(indent=4).
+            Example:
+                {
+                    "text": "This is a sample text."
+                    "labels": [
+                        "label1",
+                        "label2"
+                    ]
+                }
+
+    Parameters:
+        :file_path: the path of the file.
+        :offset: the byte offset to start from, it should be an offset yielded by a previous read.
+            For the gzip file, it is the offset in the decompressed data.
+        :with_offset: whether to yield (offset, record), the offset is the byte offset right after the record,
+            so that the reading can be resumed from it.
+
+    Returns:
+        An iterator of records, or (offset, record) if with_offset is True.
+        If the file is a sharded output, the records of all the shards are read in order, but offset is not supported.
+        If the file is a columnar dataset (a directory ends with .col, see columnar.py), offset is the index of the row.
+    '''
+    if os.path.isdir(file_path):
+        from columnar import ColumnarDataset
+        dataset = ColumnarDataset(file_path)
+        for i in range(offset, len(dataset)):
+            yield (i + 1, dataset[i]) if with_offset else dataset[i]
+        return
+
+    files = resolve_files(file_path)
+    if files == [file_path]:
+        yield from _iter_file(file_path, offset, with_offset)
+        return
+    if offset or with_offset:
+        raise ValueError(f"Byte offset is not supported for the sharded output: {file_path}")
+    for shard_path in files:
+        yield from _iter_file(shard_path)
+
+def _iter_file(file_path: str, offset: int = 0, with_offset: bool = False) -> Iterator[Any]:
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')('surrogateescape')
+    with open_binary(file_path) as f:
+        if offset:
+            f.seek(offset)
+        buf, pos, eof = '', 0, False
+        while True:
+            while pos < len(buf) and buf[pos] in SEPARATORS:
+                pos += 1
+                offset += 1
+            if pos < len(buf):
+                if buf[pos] != '{':
+                    raise ValueError(f"Invalid record in {file_path} at offset {offset}: {buf[pos:pos + 50]!r}")
+                try:
+                    record, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    end = -1        # the record is not complete in the buffer
+            elif eof:
+                return
+            else:
+                end = -1
+            if end == -1:
+                chunk = f.read(CHUNK_SIZE)
+                eof = not chunk
+                buf, pos = buf[pos:] + utf8.decode(chunk, final=eof), 0
+                continue
+            offset += len(buf[pos:end].encode('utf-8', 'surrogateescape'))
+            pos = end
+            yield (offset, record) if with_offset else record
@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import numpy as np
+from typing import Iterable, Iterator
+
+class ReferenceIndex:
+    ''' This is an on-disk, append-only store of the tokenized references used for dedup. '''
+    TOKENS = 'tokens.bin'       # int32 token ids of all references, back to back
+    OFFSETS = 'offsets.bin'     # int64 end offset of each reference in tokens.bin
+    HASHES = 'hashes.bin'       # uint64 hash of each reference, used for exact lookups
+    VOCAB = 'vocab.jsonl'       # one json string per line, the line number is the token id
+
+    def __init__(self, index_dir: str, readonly: bool = False):
+        '''
+        Usage:
+            Open (or create) a reference index in index_dir.
+            Each reference is a str that has been tokenized by jieba and joined by ' ',
+            it is stored as an array of token ids in a memory-mapped file plus an offsets file.
+            New references are only appended, so the index can be reused across runs
+            and shared read-only between worker processes.
+
+        Parameters:
+            :index_dir: the directory of the index files.
+            :readonly: whether to open the index read-only. A read-only index never writes to the files,
+                call refresh() to see the references appended by the writer.
+        '''
+        self.index_dir = index_dir
+        self.readonly = readonly
+        self.vocab = []         # list of token, the index is the token id
+        self.token2id = {}
+        self.hashes = set()
+        self._vocab_pos = 0     # how many bytes of vocab.jsonl have been read
+        self._size = 0
+        self._tokens = np.zeros(0, dtype=np.int32)
+        self._offsets = np.zeros(0, dtype=np.int64)
+        if not readonly:
+            os.makedirs(index_dir, exist_ok=True)
+            self._recover()
+        elif not os.path.exists(self._path(self.OFFSETS)):
+            raise FileNotFoundError(f"Reference index not found: {index_dir}")
+        self.refresh()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def _recover(self):
+        '''
+        Usage:
+            Drop the half written tail of an interrupted append.
+            offsets.bin is written last, so it decides how many references are committed.
+        '''
+        for name in (self.TOKENS, self.OFFSETS, self.HASHES, self.VOCAB):
+            open(self._path(name), 'ab').close()
+        size = os.path.getsize(self._path(self.OFFSETS)) // 8
+        end = 0
+        if size:
+            end = int(np.fromfile(self._path(self.OFFSETS), dtype=np.int64, count=size)[-1])
+        for name, length in ((self.OFFSETS, size * 8), (self.TOKENS, end * 4), (self.HASHES, size * 8)):
+            if os.path.getsize(self._path(name)) != length:
+                os.truncate(self._path(name), length)
+        with open(self._path(self.VOCAB), 'rb') as f:
+            data = f.read()
+        if data and not data.endswith(b'\n'):
+            os.truncate(self._path(self.VOCAB), data.rfind(b'\n') + 1)
+
+    def refresh(self):
+        '''
+        Usage:
+            Map the references that have been committed to the files since the last refresh.
+        '''
+        with open(self._path(self.VOCAB), 'rb') as f:
+            f.seek(self._vocab_pos)
+            for line in f:
+                if not line.endswith(b'\n'):        # the writer has not finished this line yet
+                    break
+                token = json.loads(line)
+                self.token2id[token] = len(self.vocab)
+                self.vocab.append(token)
+                self._vocab_pos += len(line)
+
+        size = os.path.getsize(self._path(self.OFFSETS)) // 8
+        if size == self._size:
+            return
+        self._offsets = np.memmap(self._path(self.OFFSETS), dtype=np.int64, mode='r', shape=(size,))
+        end = int(self._offsets[-1])
+        if end:
+            self._tokens = np.memmap(self._path(self.TOKENS), dtype=np.int32, mode='r', shape=(end,))
+        hashes = np.fromfile(self._path(self.HASHES), dtype=np.uint64, count=size, offset=self._size * 8)
+        self.hashes.update(hashes.tolist())
+        self._size = size
+
+    @staticmethod
+    def hash(reference: str) -> int:
+        return int.from_bytes(hashlib.blake2b(reference.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, reference: str) -> bool:
+        return self.hash(reference) in self.hashes
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += self._size
+        start = int(self._offsets[i - 1]) if i > 0 else 0
+        end = int(self._offsets[i])
+        return ' '.join([self.vocab[t] for t in self._tokens[start:end].tolist()])
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self._size):
+            yield self[i]
+
+    def append(self, reference: str):
+        self.extend([reference])
+
+    def extend(self, references: Iterable[str]):
+        '''
+        Usage:
+            Append the references to the index files and map them.
+
+        Parameters:
+            :references: a list of str that has been tokenized and joined by ' '
+        '''
+        if self.readonly:
+            raise PermissionError(f"Reference index is read-only: {self.index_dir}")
+        new_tokens, ids, offsets, hashes = [], [], [], []
+        base = int(self._offsets[-1]) if self._size else 0
+        for reference in references:
+            for token in reference.split(' '):
+                if token not in self.token2id:
+                    self.token2id[token] = len(self.vocab)
+                    self.vocab.append(token)
+                    new_tokens.append(token)
+                ids.append(self.token2id[token])
+            offsets.append(base + len(ids))
+            hashes.append(self.hash(reference))
+        if not offsets:
+            return
+
+        vocab_lines = ''.join(json.dumps(token, ensure_ascii=False) + '\n' for token in new_tokens).encode('utf-8')
+        with open(self._path(self.VOCAB), 'ab') as f:
+            f.write(vocab_lines)
+        self._vocab_pos += len(vocab_lines)
+        with open(self._path(self.TOKENS), 'ab') as f:
+            f.write(np.array(ids, dtype=np.int32).tobytes())
+        with open(self._path(self.HASHES), 'ab') as f:
+            f.write(np.array(hashes, dtype=np.uint64).tobytes())
+        with open(self._path(self.OFFSETS), 'ab') as f:      # commit point
+            f.write(np.array(offsets, dtype=np.int64).tobytes())
+        self.refresh()
+
+    def sync(self):
+        '''
+        Usage:
+            Force the index files to disk.
+        '''
+        for name in (self.VOCAB, self.TOKENS, self.HASHES, self.OFFSETS):
+            with open(self._path(name), 'ab') as f:
+                os.fsync(f.fileno())
+
+    def __getstate__(self) -> dict:
+        # worker processes attach to the same files read-only instead of copying the index
+        return {'index_dir': self.index_dir}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['index_dir'], readonly=True)
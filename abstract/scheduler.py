@@ -0,0 +1,214 @@
+import json
+import threading
+from utils import usage, usage_lock, logger
+
+class AugmentScheduler:
+    ''' This is a scheduler that allocates the rewrites of augmentation by the online acceptance rates. '''
+    def __init__(self,
+        max_calls: int = 0,
+        max_tokens: int = 0,
+        min_repeat: int = 1,
+        max_repeat: int = 0,
+        patience: int = 2,
+    ):
+        '''
+        Usage:
+            Pass it to DataAugmentation.augment(scheduler=...) to spend the LLM calls on the productive seeds.
+            Each rewrite of a seed by a prompt_func is tagged with (index of the seed, name of the prompt_func), and
+                attempts: the number of rewrites generated
+                repeats: the rewrites that are repetitive to the input or the previous rewrites of the same seed
+                duplicates: the rewrites that are removed by the dedup of the references (or too long)
+                rejected: the rewrites whose scores of the pool are lower than the thresholds
+                accepted: the rewrites that are written to the output
+            are counted for each seed and each prompt_func. Then
+                1. The number of rewrites of a seed is repeat_num scaled by the acceptance rate of its prompt_func
+                   relative to the overall acceptance rate, and by the diversity of the seed's own rewrites so far
+                   relative to the overall diversity, clamped to [min_repeat, max_repeat].
+                2. A seed stops at its quota, unless the acceptance rate of its prompt_func is above the running mean
+                   and the seed has no repetitive rewrites, then it gets extra rewrites until max_repeat.
+                   The extra rewrites are paid by the rewrites saved by the seeds that stopped before repeat_num,
+                   so they move the calls to the productive prompt_funcs instead of adding calls.
+                3. A seed stops early after patience consecutive repeats of its own rewrites.
+                   The duplicates and rejections of a seed are only known after all its rewrites are inserted,
+                   so they count in the acceptance rates of its prompt_func, not in the streak of the seed.
+                4. The augmentation stops when max_calls or max_tokens of the LLM (including the scoring) is used up.
+                   The calls in flight and the calls to score a batch of the pool are reserved, 
+                   so the rewrites stop early enough for the last scoring to fit in the budget.
+
+        Parameters:
+            :max_calls: the maximum number of LLM calls, 0 means no limit.
+            :max_tokens: the maximum number of LLM tokens (prompt + completion), 0 means no limit.
+            :min_repeat: the minimum number of rewrites of a seed.
+            :max_repeat: the maximum number of rewrites of a seed, 0 means twice the repeat_num.
+            :patience: the number of consecutive failures to stop rewriting a seed.
+        '''
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.min_repeat = min_repeat
+        self.max_repeat = max_repeat
+        self.patience = patience
+        self.seeds = {}         # (index of the seed, name of the prompt_func) -> stats
+        self.funcs = {}         # name of the prompt_func -> stats
+        self.total = self._new_stats()
+        self.lock = threading.Lock()
+        self.in_flight = 0          # the LLM calls of the rewrites that have been reserved but not finished
+        self.flush_calls = 0        # the LLM calls to score a batch of the pool, reserved for the last scoring
+        self.credit = 0             # the rewrites saved by the seeds that stopped before repeat_num, for the extra rewrites
+        with usage_lock:
+            self.start = dict(usage)
+
+    @staticmethod
+    def _new_stats() -> dict:
+        return {'attempts': 0, 'repeats': 0, 'duplicates': 0, 'rejected': 0, 'accepted': 0, 'streak': 0}
+
+    @staticmethod
+    def rate(stats: dict) -> float:
+        ''' The smoothed acceptance rate. '''
+        return (stats['accepted'] + 1) / (stats['attempts'] + 2)
+
+    @staticmethod
+    def diversity(stats: dict, prior: float = 0.5) -> float:
+        ''' The smoothed ratio of the rewrites that are not repetitive, prior is the ratio without attempts. '''
+        return (stats['attempts'] - stats['repeats'] + 2 * prior) / (stats['attempts'] + 2)
+
+    def _stats(self, tag: tuple) -> list[dict]:
+        if tag not in self.seeds:
+            self.seeds[tag] = self._new_stats()
+        if tag[1] not in self.funcs:
+            self.funcs[tag[1]] = self._new_stats()
+        return [self.seeds[tag], self.funcs[tag[1]], self.total]
+
+    def used(self) -> dict:
+        with usage_lock:
+            return {k: usage[k] - self.start[k] for k in usage}
+
+    def _exhausted(self) -> bool:
+        ''' Whether the budget is used up, counting the reserved calls, the caller holds the lock. '''
+        used = self.used()
+        reserved = self.in_flight + self.flush_calls
+        if self.max_calls and used['calls'] + reserved >= self.max_calls:
+            return True
+        if self.max_tokens:
+            tokens = used['prompt_tokens'] + used['completion_tokens']
+            per_call = tokens / used['calls'] if used['calls'] else 0
+            if tokens + reserved * per_call >= self.max_tokens:
+                return True
+        return False
+
+    def exhausted(self) -> bool:
+        with self.lock:
+            return self._exhausted()
+
+    def acquire(self) -> bool:
+        '''
+        Usage:
+            Reserve an LLM call of a rewrite, False if the budget is used up. Release it once the call is finished.
+        '''
+        with self.lock:
+            if self._exhausted():
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def reserve_flush(self, calls: int):
+        '''
+        Usage:
+            Reserve the LLM calls to score a batch of the pool, e.g. the number of score types * repeat_time.
+            It is updated by the calls measured when a batch is scored, see flushed.
+        '''
+        with self.lock:
+            self.flush_calls = calls
+
+    def flushed(self, calls: int):
+        ''' The LLM calls measured around the scoring of a batch, they may include the concurrent rewrites, which only overestimates. '''
+        if calls > 0:
+            self.reserve_flush(calls)
+
+    def quota(self, tag: tuple, repeat_num: int) -> int:
+        '''
+        Usage:
+            The number of rewrites allocated to a seed.
+        '''
+        with self.lock:
+            seed, func, total = self._stats(tag)
+            prior = self.diversity(total)
+            weight = self.rate(func) / self.rate(total) * self.diversity(seed, prior) / prior
+        return min(max(round(repeat_num * weight), self.min_repeat), self.max_repeat or 2 * repeat_num)
+
+    def next(self, tag: tuple, attempts: int, repeat_num: int) -> bool:
+        '''
+        Usage:
+            Whether to generate another rewrite for a seed that has been rewritten attempts times.
+            If True, an LLM call is reserved, release it once the call is finished.
+        '''
+        quota = self.quota(tag, repeat_num)
+        with self.lock:
+            seed = self._stats(tag)[0]
+            if seed['streak'] >= self.patience or (attempts >= quota and attempts < repeat_num):
+                self.credit += max(0, repeat_num - attempts)
+                return False
+            extra = attempts >= quota
+            if extra:
+                # the extra rewrites are only for the productive prompt_funcs, and paid by the saved rewrites
+                func, total = self.funcs[tag[1]], self.total
+                if attempts >= (self.max_repeat or 2 * repeat_num) or seed['repeats'] > 0 \
+                        or self.rate(func) <= self.rate(total) or self.credit <= 0:
+                    return False
+            if self._exhausted():
+                return False
+            if extra:
+                self.credit -= 1
+            self.in_flight += 1
+            return True
+
+    def observe(self, tag: tuple, diverse: bool):
+        '''
+        Usage:
+            Count a generated rewrite, diverse is whether it is different from the input and the previous rewrites.
+        '''
+        with self.lock:
+            for stats in self._stats(tag):
+                stats['attempts'] += 1
+                if diverse:
+                    stats['streak'] = 0
+                else:
+                    stats['repeats'] += 1
+                    stats['streak'] += 1
+
+    def record(self, tag: tuple, outcome: str):
+        '''
+        Usage:
+            Count the outcome of a rewrite, accepted, rejected (by the pool) or duplicate (by the dedup).
+            It is reported after the rewrites of the seed are finished, so it does not change the streak of the seed.
+        '''
+        if tag is None:         # e.g. the inputs restored from the checkpoint journal
+            return
+        with self.lock:
+            for stats in self._stats(tag):
+                stats[outcome if outcome != 'duplicate' else 'duplicates'] += 1
+
+    def report(self, save_path: str = '') -> dict:
+        '''
+        Usage:
+            Report the yield statistics of each seed and each prompt_func, and the LLM usage.
+            If save_path is provided, the report is saved as json.
+        '''
+        with self.lock:
+            report = {
+                'usage': self.used(),
+                'total': dict(self.total, rate=self.rate(self.total)),
+                'funcs': {name: dict(stats, rate=self.rate(stats)) for name, stats in self.funcs.items()},
+                'seeds': [dict(stats, seed=seed, func=func, rate=self.rate(stats)) for (seed, func), stats in sorted(self.seeds.items())],
+            }
+        for stats in [report['total']] + report['seeds'] + list(report['funcs'].values()):
+            stats.pop('streak')
+        if save_path:
+            with open(save_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=4)
+        total = report['total']
+        logger.info(f"📊 {total['accepted']} / {total['attempts']} rewrites accepted with {report['usage']['calls']} LLM calls")
+        return report
@@ -0,0 +1,156 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+from datasets import Dataset, concatenate_datasets, load_from_disk
+from evalCache import record_hash
+from typing import Any, Callable
+
+class TokenizedDatasetCache:
+    ''' This is a cache of the formatted and tokenized training records, which only processes the appended records. '''
+    checks = 8      # the number of the cached records whose hashes are compared with the dataset in each update
+
+    def __init__(self,
+        cache_dir: str,
+        tokenizer: Any,
+        formatting_prompts_func: Callable,
+        max_seq_length: int,
+        EOS: str = None,
+        version: str = ''
+    ):
+        '''
+        Usage:
+            The training file only grows by appending the augmented records, so the cache keeps the number of the records
+            it has processed, and each update formats the records after them by formatting_prompts_func, tokenizes them
+            like SFTTrainer and saves them to a new shard in cache_dir. The dataset of the records is the concatenation
+            of the shards, so the preprocessing of each iteration scales with the new records.
+            A few cached records (the first, the last and the evenly spaced ones) are compared with the dataset by their hashes,
+            if the file has been rewritten, e.g. cleansed, the cache is rebuilt from the whole dataset.
+            The cache is cleared if the tokenizer, max_seq_length, EOS, formatting_prompts_func, the global constants it reads
+            (e.g. the instruction and the prompt template) or version changes. Only the shards and the index are removed,
+            the other files of cache_dir are kept.
+            Pass the dataset to SFTTrainer with dataset_kwargs={'skip_prepare_dataset': True}.
+
+        Parameters:
+            :cache_dir: the directory of the shards and the index
+            :tokenizer: Hugging Face Transformers tokenizer
+            :formatting_prompts_func: the function that formats a batch of records to {"text": [...]}, see FineTune.finetune
+            :max_seq_length: the maximum number of tokens of a record, the longer ones are truncated
+            :EOS: the end-of-sentence token passed to formatting_prompts_func, default to tokenizer.eos_token
+            :version: any key that changes the formatted text but is not seen by the fingerprint, 
+                e.g. the version of a prompt loaded from a file by a helper of formatting_prompts_func
+        '''
+        self.cache_dir = cache_dir
+        self.tokenizer = tokenizer
+        self.formatting_prompts_func = formatting_prompts_func
+        self.max_seq_length = max_seq_length
+        self.EOS = EOS or tokenizer.eos_token
+        self.version = version
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.fingerprint = self._fingerprint()
+        self.shards = []        # [{"path": "shard-00000", "rows": 100}]
+        self.hashes = {}        # the row -> the hash of the record, of the checked rows
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.shards = index.get('shards', [])
+            if index.get('fingerprint') == self.fingerprint:
+                self.hashes = {int(row): h for row, h in index['hashes'].items()}
+            else:
+                self.clear()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._dataset = None    # the concatenation of the shards
+
+    @property
+    def rows(self) -> int:
+        ''' The number of the cached records. '''
+        return sum(shard['rows'] for shard in self.shards)
+
+    def _fingerprint(self) -> str:
+        func = self.formatting_prompts_func
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            source = getattr(func, '__qualname__', repr(func))
+        # the global constants read by the function and its comprehensions, e.g. the instruction and the prompt template
+        codes, names = [getattr(func, '__code__', None)], set()
+        while codes:
+            code = codes.pop()
+            if code is not None:
+                names.update(code.co_names)
+                codes.extend(const for const in code.co_consts if inspect.iscode(const))
+        namespace = getattr(func, '__globals__', {})
+        constants = {name: namespace[name] for name in sorted(names) if isinstance(namespace.get(name), (str, int, float, bool, tuple))}
+        config = {
+            'tokenizer': getattr(self.tokenizer, 'name_or_path', ''),
+            'vocab_size': len(self.tokenizer),
+            'max_seq_length': self.max_seq_length,
+            'EOS': self.EOS,
+            'formatting_prompts_func': source,
+            'constants': constants,
+            'version': self.version,
+        }
+        return hashlib.sha256(json.dumps(config, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def clear(self):
+        ''' Remove the shards and the index of the cache, the other files of cache_dir are kept. '''
+        for shard in self.shards:
+            path = os.path.join(self.cache_dir, os.path.basename(shard['path']))
+            if os.path.basename(path).startswith('shard-') and os.path.isdir(path):
+                shutil.rmtree(path)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        self.shards, self.hashes, self._dataset = [], {}, None
+
+    @staticmethod
+    def _hash(row: dict) -> str:
+        return record_hash({k: v for k, v in row.items() if v is not None})
+
+    def _check_rows(self, n: int) -> list[int]:
+        ''' The rows of the n cached records whose hashes are compared: the first, the last and the evenly spaced ones. '''
+        if n <= 0:
+            return []
+        return sorted({(n - 1) * i // max(1, self.checks - 1) for i in range(self.checks)})
+
+    def _write_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self.fingerprint, 'shards': self.shards, 'hashes': self.hashes}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _tokenize(self, examples: dict) -> dict:
+        # the same as the tokenization of SFTTrainer without packing
+        outputs = self.tokenizer(examples['text'], add_special_tokens=True, truncation=True, padding=False, max_length=self.max_seq_length)
+        return {'input_ids': outputs['input_ids'], 'attention_mask': outputs['attention_mask']}
+
+    def update(self, dataset: Any) -> Dataset:
+        '''
+        Usage:
+            Format and tokenize the records of dataset after the cached ones, and save them to a new shard.
+
+        Parameters:
+            :dataset: the Hugging Face Dataset of the training records, see finetune.load_train_dataset
+
+        Returns:
+            The tokenized dataset (input_ids, attention_mask) in the order of the records of dataset.
+        '''
+        cached = self.rows
+        if cached > len(dataset) or any(self._hash(dataset[row]) != h for row, h in self.hashes.items()):
+            self.clear()
+            cached = 0
+        if cached < len(dataset):
+            delta = dataset.select(range(cached, len(dataset)))
+            texts = delta.map(self.formatting_prompts_func, batched=True, fn_kwargs={"EOS": self.EOS}, remove_columns=delta.column_names)
+            tokenized = texts.map(self._tokenize, batched=True, remove_columns=texts.column_names)
+            shard = {'path': f'shard-{len(self.shards):05d}', 'rows': len(delta)}
+            tokenized.save_to_disk(os.path.join(self.cache_dir, shard['path']))
+            self.shards.append(shard)
+            self.hashes = {row: self._hash(dataset[row]) for row in self._check_rows(len(dataset))}
+            self._write_index()
+            self._dataset = None
+        if not self.shards:
+            return Dataset.from_dict({'input_ids': [], 'attention_mask': []})
+        if self._dataset is None:
+            self._dataset = concatenate_datasets([load_from_disk(os.path.join(self.cache_dir, shard['path'])) for shard in self.shards])
+        return self._dataset
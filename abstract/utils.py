@@ -7,6 +7,10 @@ from loguru import logger
 import numpy as np
 import random
 import torch
+import threading
+from copy import deepcopy
+from reader import iter_records
+from typing import Any
 
 ''' save augmentation logs '''
 os.makedirs('logs', exist_ok=True)
@@ -15,6 +19,17 @@ now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 logger.remove(0)
 logger.add(f"logs/{now}.log", format="<level>{level}</level> | <level>{message}</level>", rotation="10 MB")
 
+''' count the LLM calls and tokens of this process, e.g. for the budget of augmentation '''
+usage = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+usage_lock = threading.Lock()
+
+def count_usage(completion: Any):
+    with usage_lock:
+        usage['calls'] += 1
+        if getattr(completion, 'usage', None) is not None:
+            usage['prompt_tokens'] += completion.usage.prompt_tokens or 0
+            usage['completion_tokens'] += completion.usage.completion_tokens or 0
+
 def set_seed(seed: int):
     random.seed(seed)
     np.random.seed(seed)
@@ -55,9 +70,71 @@ def query(user_input: str,
         temperature=temperature,    # 温度在0-2之间，值越大，越有创造力
         seed=seed,
     )
+    count_usage(completion)
 
     return completion.choices[0].message.content
 
+def query_n(user_input: str, 
+    n: int = 1, 
+    system_prompt: str = '', 
+    model="gpt-4o-mini", 
+    temperature: float = 1.5, 
+    max_tokens: int = 200, 
+    seed: int = 42
+) -> list[str]:
+    '''
+    Usage:
+        Same as query, but get n choices of the response in one call.
+
+    Parameters:
+        :user_input: the user input
+        :n: the number of choices to generate
+        The other parameters are the same as query.
+
+    Returns:
+        A list of the n responses generated by the model.
+    '''
+    client = OpenAI()
+    completion = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input}
+        ],
+        n=n,
+        max_tokens=max_tokens,  
+        temperature=temperature,
+        seed=seed,
+    )
+    count_usage(completion)
+
+    return [choice.message.content for choice in completion.choices]
+
+def parse_list(response: str) -> list:
+    '''
+    Usage:
+        Parse a json list from the response of the model, the response may be wrapped in ```json ```.
+        If the response is not a valid list, it will return an empty list.
+
+    Parameters:
+        :response: the response of the model
+
+    Returns:
+        The parsed list.
+    '''
+    if not response:
+        return []
+    start, end = response.find('['), response.rfind(']')
+    if start == -1 or end < start:
+        logger.error(f"🐞 Invalid list response: {response}")
+        return []
+    try:
+        items = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        logger.error(f"🐞 Invalid list response: {response}")
+        return []
+    return items if isinstance(items, list) else []
+
 class Log:
     def __init__(self, output_path: str):
         '''
@@ -124,11 +201,128 @@ class Log:
             for js in self.logs:
                 f_a.write(json.dumps(js, ensure_ascii=False) + '\n')
 
+class Journal:
+    def __init__(self, output_path: str, commit_interval: int = 1):
+        '''
+        Usage:
+            Create an append-only checkpoint journal for augmentation.
+            Each record keeps the number of seeds that have been committed (idx), 
+            the position of the output (a writer.RecordWriter) when they were committed (offset), 
+            and the inputs that are still waiting in the pool to be scored (pool).
+            So that after an interruption, we can truncate the output to the offset, 
+            restore the pool and continue exactly from idx.
+
+        Parameters:
+            :output_path: the path of the output file.
+            :commit_interval: the number of updates in a group commit. 
+                The output and the journal are only fsynced once per group commit,
+                the larger it is, the less it costs, but the more seeds are redone after a crash.
+
+        Returns:
+            A file named 'augment.journal' in the same directory as the output file.
+            Example:
+                {"filename": "train.jsonl", "idx": 110, "offset": 52371, "pool": [{"input": "...", ...}]}
+        '''
+        dirname = os.path.dirname(output_path)
+        self.basename = os.path.basename(output_path)
+        self.journal_path = os.path.join(dirname, 'augment.journal')
+        self.commit_interval = max(1, commit_interval)
+        self.state = None       # the last committed record of this output file
+        self.pending = None     # the last updated record that has not been committed
+        self.count = 0
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        records = {}
+        lines = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as f_r:
+                for line in f_r:
+                    lines += 1
+                    try:
+                        js = json.loads(line)
+                    except json.JSONDecodeError:       # the torn tail of an interrupted write
+                        continue
+                    records[js['filename']] = js
+        self.state = records.get(self.basename)
+        if self.state is None and os.path.exists(os.path.join(dirname, 'augment.log')):
+            last_idx = Log(output_path).last_idx        # migrate from the old augment.log
+            if last_idx:
+                self.state = {'filename': self.basename, 'idx': last_idx, 'offset': None, 'pool': []}
+
+        if lines > max(len(records), 1) * 100:          # compact the journal, keep the last record of each file
+            tmp_path = self.journal_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f_w:
+                for js in records.values():
+                    f_w.write(json.dumps(js, ensure_ascii=False) + '\n')
+                f_w.flush()
+                os.fsync(f_w.fileno())
+            os.replace(tmp_path, self.journal_path)
+        self.f = open(self.journal_path, 'a', encoding='utf-8')
+
+    @property
+    def last_idx(self) -> int:
+        return self.state['idx'] if self.state else 0
+
+    @property
+    def offset(self) -> int:
+        return self.state['offset'] if self.state else None
+
+    @property
+    def pool(self) -> list[dict]:
+        return deepcopy(self.state['pool']) if self.state else []
+
+    def update(self, idx: int, pool: list[dict], output: Any, done: list[int] = None):
+        '''
+        Usage:
+            Record a consistent state after a seed has been committed. 
+            It is written to the journal at the next group commit.
+
+        Parameters:
+            :idx: the number of seeds that have been committed.
+            :pool: the inputs that are still waiting in the pool.
+            :output: the writer.RecordWriter of the output, all the records of the committed seeds have been put to it.
+            :done: the index of the seeds after idx that have also been committed, when seeds are committed out of order.
+        '''
+        # only the list is copied here, the inputs are copied at commit, most updates are replaced before it
+        js = {'filename': self.basename, 'idx': idx, 'offset': None, 'pool': list(pool)}
+        if done:
+            js['done'] = sorted(done)
+        self.pending = (js, output, output.records)
+        self.count += 1
+        if self.count >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        '''
+        Usage:
+            Make the output durable, then append the pending record with the position of the output to the journal.
+            If more records have been put to the output since the pending update, e.g. interrupted in the middle of a seed,
+            the pending record is dropped, since the position of the output no longer matches it.
+        '''
+        if self.pending is None:
+            return
+        js, output, records = self.pending
+        self.pending = None
+        if output.records != records:
+            logger.warning(f"🐞 The checkpoint of {self.basename} is dropped, the seeds after {self.last_idx} will be redone")
+            return
+        js['offset'] = output.commit()
+        js['pool'] = deepcopy(js['pool'])
+        self.f.write(json.dumps(js, ensure_ascii=False) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.state = js
+        self.count = 0
+
+    def close(self):
+        self.commit()
+        self.f.close()
+
 def load_jsonl(file_path: str) -> list[dict]:
     '''
     Usage:
-        Load a jsonl file into a list of dictionaries.
-        If the json data is not in a valid jsonl format, it will be skipped.
+        Load a jsonl file (optionally gzipped) into a list of dictionaries, see reader.iter_records for streaming.
         There are two possible formats:
             1. Each line is a valid json string.
             Example:
@@ -149,31 +343,7 @@ def load_jsonl(file_path: str) -> list[dict]:
     Returns:
         A list of dictionaries.
     '''
-    lines = open(file_path, 'r', encoding='utf-8', errors='ignore').readlines()
-    if not lines:
-        return []
-    data_list = []
-
-    if lines[0] == '{\n':
-        json_lines = []
-        for line in lines:
-            line = line.strip()
-            if line:
-                json_lines.append(line)
-            
-            if line == '}':
-                json_str = ''.join(json_lines)
-                json_obj = json.loads(json_str)
-                data_list.append(json_obj)
-                json_lines = []
-
-    else:
-        for line in lines:
-            line = line.strip()
-            if line:
-                data_list.append(json.loads(line))
-
-    return data_list
+    return list(iter_records(file_path))
 
 alpaca_prompt = (
     "Below is an instruction that describes a task, paired with an input that provides further context. "
@@ -0,0 +1,276 @@
+import os
+import json
+import gzip
+import queue
+import threading
+from typing import Any, Literal
+from reader import iter_records, compression_of, MANIFEST
+from columnar import ColumnarWriter, EXTENSION
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class RecordWriter:
+    ''' This is a writer that appends records to the output in a background thread. '''
+    EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self,
+        output_path: str,
+        indent: int = None,
+        compression: Literal['gzip', 'zstd'] = None,
+        shard_records: int = 0,
+        shard_bytes: int = 0,
+        position: Any = None,
+        queue_size: int = 1024
+    ):
+        '''
+        Usage:
+            Create a writer of the output file. The records are serialized and written by a background thread,
+            they are only flushed and fsynced to the disk at a group commit, see commit().
+            If compression, shard_records or shard_bytes is set, the output is written to shards, e.g.
+            train-00000.jsonl.gz, train-00001.jsonl.gz, ..., and a manifest train.jsonl.manifest.json lists
+            the shards and their record counts, reader.iter_records reads the manifest transparently.
+            If output_path is a columnar dataset (ends with .col), the records are appended to it by columnar.ColumnarWriter.
+            Otherwise, the records are appended to output_path directly.
+
+        Parameters:
+            :output_path: the path of the output file.
+            :indent: the indent of the json records.
+            :compression: None, gzip or zstd (requires zstandard).
+            :shard_records: the maximum number of records in a shard, 0 means no limit.
+            :shard_bytes: the maximum size of a shard on the disk, 0 means no limit.
+            :position: the position returned by a previous commit(), the output is truncated to it,
+                so that the records written after the position are dropped.
+            :queue_size: the maximum number of records waiting to be written.
+        '''
+        if compression not in self.EXTENSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd compression requires zstandard, please pip install zstandard")
+        self.output_path = output_path
+        self.indent = indent
+        self.compression = compression
+        self.shard_records = shard_records
+        self.shard_bytes = shard_bytes
+        self.columnar = output_path.rstrip('/').endswith(EXTENSION)
+        self.sharded = bool(compression or shard_records or shard_bytes)
+        if self.columnar and self.sharded:
+            raise ValueError("The columnar dataset can not be compressed or sharded")
+        self.manifest_path = output_path + MANIFEST
+        self.records = 0            # the number of records that have been put
+        dirname = os.path.dirname(output_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.shards = []            # the shards in the manifest, {'path': str, 'records': int, 'bytes': int}
+        self._raw = None            # the file object of the current shard
+        self._stream = None         # the compressor that writes to self._raw
+        self._columnar = None       # the ColumnarWriter if the output is a columnar dataset
+        if self.sharded:
+            self._load_manifest()
+        if self.columnar:
+            self._columnar = ColumnarWriter(output_path, rows=position if isinstance(position, int) else None)
+        else:
+            if position is not None:
+                self._truncate(position)
+            self._open()
+
+        self._error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.shards = json.load(f)['shards']
+        elif os.path.exists(self.output_path):        # the output written without sharding becomes the first shard
+            records = sum(1 for _ in iter_records(self.output_path))
+            self.shards = [{'path': os.path.basename(self.output_path), 'records': records, 'bytes': os.path.getsize(self.output_path)}]
+            self._write_manifest()
+
+    def _write_manifest(self):
+        manifest = {
+            'records': sum(shard['records'] for shard in self.shards),
+            'compression': self.compression,
+            'shards': self.shards,
+        }
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def _shard_path(self, shard: dict) -> str:
+        return os.path.join(os.path.dirname(self.output_path), shard['path'])
+
+    def _truncate(self, position: Any):
+        if not self.sharded:
+            if isinstance(position, int) and os.path.exists(self.output_path) and os.path.getsize(self.output_path) > position:
+                os.truncate(self.output_path, position)
+            return
+        if not isinstance(position, dict):
+            return
+        k = position['shard']
+        for shard in self.shards[k + 1:]:
+            if os.path.exists(self._shard_path(shard)):
+                os.remove(self._shard_path(shard))
+        self.shards = self.shards[:k + 1]
+        if k < len(self.shards):
+            path = self._shard_path(self.shards[k])
+            if os.path.exists(path) and os.path.getsize(path) > position['offset']:
+                os.truncate(path, position['offset'])
+            self.shards[k].update({'records': position['shard_records'], 'bytes': position['offset']})
+        self._write_manifest()
+
+    def _open(self):
+        if not self.sharded:
+            self._raw = open(self.output_path, 'ab')
+            return
+        last = self.shards[-1] if self.shards else None
+        if last is None or last['path'] == os.path.basename(self.output_path) or self._full(last['records'], last['bytes']) \
+                or compression_of(last['path']) != self.compression:
+            base, ext = os.path.splitext(os.path.basename(self.output_path))
+            last = {'path': f"{base}-{len(self.shards):05d}{ext or '.jsonl'}{self.EXTENSIONS[self.compression]}", 'records': 0, 'bytes': 0}
+            self.shards.append(last)
+        self._raw = open(self._shard_path(last), 'ab')
+
+    def _full(self, records: int, size: int) -> bool:
+        return (self.shard_records and records >= self.shard_records) or (self.shard_bytes and size >= self.shard_bytes)
+
+    def _write(self, js: dict):
+        if self._columnar is not None:
+            self._columnar.write(js)
+            return
+        data = (json.dumps(js, ensure_ascii=False, indent=self.indent) + '\n').encode('utf-8')
+        if self.sharded and self._full(self.shards[-1]['records'], self._raw.tell()):
+            self._commit()
+            self._raw.close()
+            self._open()
+        if self._stream is None:
+            if self.compression == 'gzip':      # each group commit closes a gzip member, the members are concatenated
+                self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb', mtime=0)
+            elif self.compression == 'zstd':    # each group commit closes a zstd frame
+                self._stream = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+            else:
+                self._stream = self._raw
+        self._stream.write(data)
+        if self.sharded:
+            self.shards[-1]['records'] += 1
+
+    def _commit(self) -> Any:
+        if self._columnar is not None:
+            return self._columnar.commit()
+        if self._stream is not None and self._stream is not self._raw:
+            self._stream.close()
+        self._stream = None
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        if not self.sharded:
+            return self._raw.tell()
+        self.shards[-1]['bytes'] = self._raw.tell()
+        self._write_manifest()
+        return {
+            'shard': len(self.shards) - 1,
+            'offset': self._raw.tell(),
+            'shard_records': self.shards[-1]['records'],
+            'records': sum(shard['records'] for shard in self.shards),
+        }
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if self._error is None and item[0] == 'record':
+                    self._write(item[1])
+                elif self._error is None and item[0] in ('commit', 'close'):
+                    item[2]['position'] = self._commit()
+                    if item[0] == 'close':
+                        (self._columnar or self._raw).close()
+            except Exception as e:
+                self._error = e
+            if item[0] in ('commit', 'close'):
+                item[1].set()
+                if item[0] == 'close':
+                    return
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError(f"Failed to write {self.output_path}") from self._error
+
+    def put(self, js: dict):
+        '''
+        Usage:
+            Put a record to the queue, it is written by the background thread.
+        '''
+        self._check()
+        self._queue.put(('record', js))
+        self.records += 1
+
+    def _request(self, kind: str) -> Any:
+        event, result = threading.Event(), {}
+        self._queue.put((kind, event, result))
+        event.wait()
+        self._check()
+        return result.get('position')
+
+    def commit(self) -> Any:
+        '''
+        Usage:
+            Group commit, wait until all the records put are written, flushed and fsynced,
+            and the manifest is updated if the output is sharded.
+
+        Returns:
+            The position of the output, it can be passed to RecordWriter(position=...) to truncate the output.
+            It is the size of the output file, the number of rows of the columnar dataset, 
+            or a dict of the shard and the offset in the shard if sharded.
+        '''
+        return self._request('commit')
+
+    def close(self) -> Any:
+        if not self._thread.is_alive():
+            return None
+        return self._request('close')
+
+class RecordRouter:
+    ''' This is a writer that routes the records to the RecordWriter of their tag. '''
+    def __init__(self, output_paths: dict[str, str], key: str, position: dict = None, **kwargs):
+        '''
+        Usage:
+            Create a RecordWriter for each output path, a record is written to the output of its tag js[key],
+            and the tag is removed from the written record. It has the same put, commit and close as RecordWriter,
+            so it can be used by utils.Journal, and the position is a dict of the position of each output.
+
+        Parameters:
+            :output_paths: the output path of each tag, e.g. {'lazy_func': 'lazy.jsonl', 'implicit_func': 'implicit.jsonl'}
+            :key: the key of the tag in the records
+            :position: the position returned by a previous commit(), each output is truncated to its position
+            :kwargs: other arguments for RecordWriter, e.g. indent and compression
+        '''
+        self.key = key
+        position = position if isinstance(position, dict) else {}
+        self.writers = {name: RecordWriter(path, position=position.get(name), **kwargs) for name, path in output_paths.items()}
+
+    @property
+    def records(self) -> int:
+        return sum(writer.records for writer in self.writers.values())
+
+    def put(self, js: dict):
+        js = dict(js)
+        self.writers[js.pop(self.key)].put(js)
+
+    def commit(self) -> dict:
+        return {name: writer.commit() for name, writer in self.writers.items()}
+
+    def close(self) -> dict:
+        position, error = {}, None
+        for name, writer in self.writers.items():       # close all the writers even if one of them fails
+            try:
+                position[name] = writer.close()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return position
@@ -6,75 +6,121 @@ sys.path.append('..')
 from dataAug import DataAugmentation
 from utils import load_jsonl
 from main import Pool, lazy_func, implicit_func
-import pandas as pd
-from prompt import example_prompt, relevant_prompt
+from mapping import load_mapping
+from prompt import example_prompt
+from relevance import RelevanceCache, CombinationSampler, relevant_combinations
 import random
 from utils import query, logger
+from reader import iter_records
+from writer import RecordWriter
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import json
+import os
 
-def generate_seed(initial_size=300, max_query_size=2, min_rel_score=7):
-    instruction = (
-        "你是一个强大的意图识别专家，你能准确地识别输入中的意图类别，如果输入中的意图存在于#意图列表#中，则将其加入到返回结果中。\n"
-        "不要回答用户的问题，而是一个由[]括起来的列表，只允许返回用户输入中的所有意图列表，不允许解释理由。\n"
-        "#意图列表#:\n{intentions}"
-    )
-    dataset = []
-    query_set = set()
-    df = pd.read_excel('../dataset/活动映射表.xlsx')
-    mapping = {k: v for k, v in zip(df['query'], df['name'])}
+def load_seed(output_path: str) -> tuple[list[dict], int]:
+    '''
+    Usage:
+        Load the seeds that have been generated to output_path, 
+        the torn tail of an interrupted write is dropped.
+
+    Returns:
+        The seeds and the byte offset right after the last complete seed.
+    '''
+    dataset, offset = [], 0
+    if not os.path.exists(output_path):
+        return dataset, offset
+    try:
+        for offset, js in iter_records(output_path, with_offset=True):
+            dataset.append(js)
+    except ValueError:
+        logger.warning(f"🐞 The tail of {output_path} after offset {offset} is dropped")
+    return dataset, offset
+
+def generate_one(random_queries: list[str], mapping: dict, instruction: str) -> dict:
+    '''
+    Usage:
+        Generate an example input of a relevant combination of queries.
+
+    Returns:
+        The seed, or None if the response is invalid.
+    '''
+    random_names = sorted(set([mapping[q] for q in random_queries]))
+    prompt = example_prompt.format(query=str(random_queries))
+    question = query(prompt)
+    if not question:
+        return None
+    return {'instruction': instruction, 'input': question, 'query': random_queries, 'output': random_names}
+
+def generate_seed(initial_size=300, max_query_size=2, min_rel_score=7, output_path='../dataset/seed.jsonl', workers=8, seed=None,
+                  cache_path='../dataset/relevance.jsonl', batch_size=20, mapping_path='../dataset/活动映射表.xlsx'):
+    '''
+    Usage:
+        Generate initial_size seeds of random combinations of queries, at most workers combinations are in flight.
+        The combinations are drawn without repeats by relevance.CombinationSampler, batch_size of them are scored
+        in one relevance prompt, and the scores are kept in relevance.RelevanceCache (cache_path), so a set is never scored twice.
+        The seeds are appended to output_path in the order the combinations are drawn, one json per line,
+        and the generation resumes from the seeds in output_path, their combinations are never drawn again.
+        If seed is set, the combinations are drawn by random.Random(seed), so that the same combinations are tried.
+        The queries, labels and instruction are loaded from the compiled mapping of mapping_path, see mapping.load_mapping.
+
+    Returns:
+        The list of seeds.
+    '''
+    rng = random.Random(seed)
+    compiled = load_mapping(mapping_path)
+    mapping = compiled['mapping']
     queries = list(mapping.keys())
-    instruction = instruction.format(intentions=str(list(set(mapping.values()))))
-    while len(dataset) < initial_size:
-        random_size = random.randint(1, max_query_size)
-        random_queries = list(set(random.sample(queries, random_size)))
-        if tuple(random_queries) in query_set:
-            logger.warning(f"🤢 repetitve query set: {random_queries}")
-            continue
-        query_set.add(tuple(random_queries))
-        if len(random_queries) > 1:
-            prompt = relevant_prompt.format(str(random_queries))
-            response = query(prompt)
-            if not response or len(response) > 10:
-                logger.error(f"🤔 The response is not valid")
+    instruction = compiled['instruction']
+
+    dataset, offset = load_seed(output_path)
+    query_set = set(tuple(sorted(js['query'])) for js in dataset)
+    cache = RelevanceCache(cache_path)
+    sampler = CombinationSampler(queries, max_query_size, rng, exclude=query_set)
+    candidates = relevant_combinations(sampler, cache, min_rel_score, batch_size=batch_size)
+
+    writer = RecordWriter(output_path, position=offset)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()       # the futures in the drawn order, so the output is in the same order for the same seed
+    try:
+        while len(dataset) < initial_size:
+            while len(pending) < min(workers, initial_size - len(dataset)):
+                random_queries = next(candidates, None)
+                if random_queries is None:
+                    break
+                pending.append(executor.submit(generate_one, random_queries, mapping, instruction))
+            if not pending:
+                logger.warning(f"🤢 All the combinations have been drawn, only {len(dataset)} seeds are generated")
+                break
+            js = pending.popleft().result()
+            if js is None:
                 continue
-            if response[0].isdigit():
-                score = int(response)
-                if score < min_rel_score:
-                    logger.warning(f"☠️ The relevantness of query set is too low: {random_queries} => {score}")
-                    continue
-        random_names = list(set([mapping[q] for q in random_queries]))
-        prompt = example_prompt.format(query=str(random_queries))
-        question = query(prompt)
-        if not question:
-            continue
-        js = {'instruction': instruction, 'input': question, 'query': random_queries, 'output': random_names}
-        dataset.append(js)
-        logger.success(f"🎉 {len(dataset)} / {initial_size} {question} => {random_queries}")
-
-        with open('../dataset/seed.json', 'w', encoding='utf-8') as f:
-            json.dump(dataset, f, ensure_ascii=False, indent=4)
+            dataset.append(js)
+            writer.put(js)
+            writer.commit()
+            logger.success(f"🎉 {len(dataset)} / {initial_size} {js['input']} => {js['query']}")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        writer.close()
+        cache.close()
+    return dataset
 
 if __name__ == '__main__':
     pool = Pool(pool_size=10, repeat_time=2)
-    generate_seed(initial_size=300, max_query_size=3, min_rel_score=7)
+    generate_seed(initial_size=300, max_query_size=3, min_rel_score=7, output_path='../dataset/seed.jsonl', workers=8, seed=42)
 
-    dataAug = DataAugmentation.from_file('../dataset/seed.json', ref=False)
+    dataAug = DataAugmentation.from_file('../dataset/seed.jsonl', ref=False)
     dataAug.cleanse(pool, save_path='../dataset/clean_seed.json')
 
     dataAug = DataAugmentation.from_file('../dataset/clean_seed.json')
 
-    lazy_augment = dataAug.augment(
-        pool=pool,
-        prompt_func=lazy_func,
-        output_path='../dataset/lazy_augment.jsonl',
-        from_log=False,
-        indent=4
-    )
-
-    implicit_augment = dataAug.augment(
+    dataAug.augment(
         pool=pool,
-        prompt_func=implicit_func,
-        output_path='../dataset/implicit_augment.jsonl',
+        prompt_func=[lazy_func, implicit_func],
+        output_path={
+            'lazy_func': '../dataset/lazy_augment.jsonl',
+            'implicit_func': '../dataset/implicit_augment.jsonl',
+        },
         from_log=False,
         indent=4
     )
@@ -5,16 +5,32 @@ sys.path.append('..')
 from abstract.queryPool import QueryPool
 from abstract.finetune import FineTune
 from abstract.evaluate import ABCEvaluator
-from prompt import natural_prompt, correct_prompt, lazy_prompt, implicit_prompt, alpaca_prompt
+from mapping import load_mapping, intent_order
+from prompt import natural_prompt, correct_prompt, lazy_prompt, implicit_prompt, list_prompt, alpaca_prompt
 
-instruction = '''
+instruction_template = '''
 你是一个强大的意图识别专家，你能准确地识别输入中的意图类别，如果输入中的意图存在于#意图列表#中，则将其加入到返回结果中。
 你的回答应该是一个由[]括起来的列表，只需要返回用户输入中的所有意图列表，不允许解释理由。
 一个可能的回答样例为：["云朵大作战","小云果园","AI新头像"]
 #意图列表#:
-['云朵大作战', '猜谜开红包', '小云果园', 'AI新头像', '邀好友，攒云朵', '送3个月会员（焕新礼）', '连续备份有礼', '天天开盲盒', '召唤相册达人活动', '云盘欢乐透，月月赢好礼', '领1T超大云空间', '组团领红包', '抽抽乐，享好礼', '移动云盘会员日', '云朵中心', '用户回馈活动', '玩转公众号', '开启App通知领好礼', '云端看电影']
+{intentions}
 '''
 
+mapping = {}        # the compiled mapping of the intents, see setup_intents
+instruction = ''    # the instruction with the intent list, see setup_intents
+
+def setup_intents(xlsx_path: str = '../dataset/活动映射表.xlsx', order_path: str = '../dataset/test.jsonl') -> dict:
+    '''
+    Usage:
+        Load the intents of the mapping spreadsheet and build the instruction of the training and evaluation prompts.
+        The intents keep the order of the intent list of order_path, which the existing datasets and adapters were built with,
+        the new intents of the spreadsheet follow. Call it before finetune, the Evaluator calls it if it is not called.
+    '''
+    global mapping, instruction
+    mapping = load_mapping(xlsx_path, label_order=intent_order(order_path))
+    instruction = instruction_template.format(intentions=str(mapping['labels']))
+    return mapping
+
 class Pool(QueryPool):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -35,33 +51,30 @@ class Pool(QueryPool):
     def get_prompt_key_name(self) -> dict[str, list[str]]:
         return {'correct': ['input', 'query'], 'natural': ['input']}
 
-import concurrent.futures
-import time
-
 class Evaluator(ABCEvaluator):
     def __init__(self, *args, **kwargs):
+        # greedy decoding constrained to a list of the known intents, which stops at the closing bracket
+        kwargs.setdefault('do_sample', False)
+        kwargs.setdefault('stop_at_bracket', True)
+        if not instruction:
+            setup_intents()
+        kwargs.setdefault('labels', mapping['labels'])
+        kwargs.setdefault('label_vocab', kwargs['labels'])
         super().__init__(*args, **kwargs)
+        # the template and the instruction before the input are the same for all the prompts
+        template = alpaca_prompt.split('{}')
+        self.set_prefix(template[0] + instruction + template[1])
 
-    def inference_with_timeout(self, prompt, timeout=5):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(self.inference, prompt)
-            try:
-                return future.result(timeout=timeout)
-            except concurrent.futures.TimeoutError:
-                print(f"Inference took longer than {timeout} seconds.")
-                return None
-
-    def forward(self, data):
-        gold = data['output']
+    def prompt(self, data):
         # instruction = data['instruction']
-        input_ = data['input']
-        prompt = alpaca_prompt.format(
+        return alpaca_prompt.format(
             instruction,    # instruction
-            input_,         # input
+            data['input'],  # input
             "",             # output - leave this blank for generation!
         )
-        # output = self.inference_with_timeout(prompt)
-        output = self.inference(prompt)
+
+    def parse(self, output, data):
+        gold = data['output']
         if output is None:
             return [], gold
         output = output.split('### Response:')[-1].replace('\n', '').strip()
@@ -114,12 +127,19 @@ def implicit_func(js: dict, history: list[str]) -> str:
     )
     return prompt
 
+def lazy_list_func(js: dict, history: list[str], num: int) -> str:
+    return lazy_func(js, history) + list_prompt.format(num=num)
+
+def implicit_list_func(js: dict, history: list[str], num: int) -> str:
+    return implicit_func(js, history) + list_prompt.format(num=num)
+
 def main():
     '''
     "unsloth/Meta-Llama-3.1-8B-bnb-4bit",
     "unsloth/Phi-3.5-mini-instruct",          
     "unsloth/Phi-3-medium-4k-instruct",
     '''
+    setup_intents()
     pool = Pool(pool_size=10, repeat_time=2)
 
     fourbit_models = [
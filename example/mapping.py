@@ -0,0 +1,103 @@
+import os
+import ast
+import json
+import hashlib
+
+SEED_INSTRUCTION = (
+    "你是一个强大的意图识别专家，你能准确地识别输入中的意图类别，如果输入中的意图存在于#意图列表#中，则将其加入到返回结果中。\n"
+    "不要回答用户的问题，而是一个由[]括起来的列表，只允许返回用户输入中的所有意图列表，不允许解释理由。\n"
+    "#意图列表#:\n{intentions}"
+)
+
+def file_sha256(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def intent_order(data_path: str, marker: str = '#意图列表#:') -> list[str]:
+    '''
+    Usage:
+        The intent list of the instruction of the first record of a jsonl dataset, e.g. test.jsonl,
+        which is the order of the intents the model is trained and evaluated with. 
+        Return None if the file is missing or the instruction has no intent list.
+    '''
+    if not os.path.exists(data_path):
+        return None
+    with open(data_path, 'r', encoding='utf-8') as f:
+        line = f.readline()
+    instruction = json.loads(line).get('instruction', '') if line.strip() else ''
+    if marker not in instruction:
+        return None
+    try:
+        labels = ast.literal_eval(instruction.split(marker, 1)[1].strip())
+    except (ValueError, SyntaxError):
+        return None
+    return [str(label) for label in labels] if isinstance(labels, (list, tuple)) else None
+
+def compile_mapping(xlsx_path: str, compiled_path: str, instruction: str = SEED_INSTRUCTION, label_order: list[str] = None) -> dict:
+    '''
+    Usage:
+        Read the mapping spreadsheet (columns query and name) and compile it to compiled_path as json.
+
+    Returns:
+        The compiled mapping, see load_mapping.
+    '''
+    import pandas as pd     # pandas and openpyxl are slow to import, only needed when the spreadsheet changes
+    df = pd.read_excel(xlsx_path)
+    mapping = {str(k): str(v) for k, v in zip(df['query'], df['name'])}
+    names = list(dict.fromkeys(mapping.values()))
+    # the labels of label_order first in its order, then the new ones in the order of the spreadsheet, so the instruction is deterministic
+    labels = [label for label in label_order or [] if label in names]
+    labels += [label for label in names if label not in labels]
+    compiled = {
+        'source': os.path.basename(xlsx_path),
+        'sha256': file_sha256(xlsx_path),
+        'template': instruction,
+        'label_order': label_order,
+        'instruction': instruction.format(intentions=str(labels)),
+        'mapping': mapping,
+        'labels': labels,
+    }
+    tmp_path = compiled_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(compiled, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, compiled_path)
+    return compiled
+
+def load_mapping(
+    xlsx_path: str = '../dataset/活动映射表.xlsx', 
+    compiled_path: str = '', 
+    instruction: str = SEED_INSTRUCTION, 
+    label_order: list[str] = None
+) -> dict:
+    '''
+    Usage:
+        Load the compiled mapping of the spreadsheet, e.g. 活动映射表.xlsx or 功能映射表.xlsx.
+        It is only compiled again when the sha256 of the spreadsheet, the instruction template or label_order changes,
+        so pandas is not imported in most runs. If the spreadsheet is missing, the compiled mapping is used as is.
+        The compiled json is generated, it is ignored by git.
+
+    Parameters:
+        :xlsx_path: the path of the spreadsheet
+        :compiled_path: the path of the compiled json, default to xlsx_path with the extension .mapping.json
+        :instruction: the instruction template, {intentions} is filled with the list of labels
+        :label_order: the order of the labels, e.g. intent_order of the dataset, the labels that are not in it
+            follow in the order of the spreadsheet. Default to the order of the spreadsheet.
+
+    Returns:
+        A dict of
+            :mapping: query -> name (label)
+            :labels: the labels in label_order, then the rest in the order of the spreadsheet
+            :instruction: the instruction with the labels
+            :sha256: the sha256 of the spreadsheet
+    '''
+    compiled_path = compiled_path or os.path.splitext(xlsx_path)[0] + '.mapping.json'
+    if os.path.exists(compiled_path):
+        with open(compiled_path, 'r', encoding='utf-8') as f:
+            compiled = json.load(f)
+        if compiled.get('template') == instruction and compiled.get('label_order') == label_order and \
+                (not os.path.exists(xlsx_path) or compiled.get('sha256') == file_sha256(xlsx_path)):
+            return compiled
+    return compile_mapping(xlsx_path, compiled_path, instruction, label_order)
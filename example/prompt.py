@@ -63,6 +63,51 @@ Example:
 #Rewritten Prompt#:
 '''
 
+list_prompt = '''
+Instead of one #Rewritten Prompt#, give {num} different #Rewritten Prompt#, 
+each of them MUST be different from the others, the #Given Prompt# and #Previous Generated Prompts#.
+Return a json list of {num} strings enclosed in [], without any other reason.
+'''
+
+example_prompt = '''
+假设你是一名用户，请你模拟真实环境下，根据#关键词#，输出#用户输入#，
+要求：生成的#用户输入#中必须包含有所有的#关键词#
+#用户输入#的提问方式可以各种各样，例如“如何”，“怎样”，“xxx是什么”，“xxx怎么用”等等。
+#用户输入#要尽可能自然流畅，不要太过冗长。
+"用户输入"不允许出现在#用户输入#中
+
+样例1
+#关键词#: ["欢乐透"]
+#用户输入#: 欢乐透怎么参与呢？
+
+样例2：
+#关键词#: ["月月抽好礼", "现金活动"]
+#用户输入#: 怎么找到美图的模板，并且智能美颜呢？
+
+开始：
+#关键词#: {query}
+#用户输入#:
+'''
+
+relevant_prompt = '''
+We would like you to evaluate the relevance and interconnectivity between the following intentions.
+You should give an overall score on a scale of 1 to 10, where a higher score indicates higher relevance and interconnectivity,
+while the lower the score, the less relevant they are.
+You must just give a score without any other reasons.
+## Intentions: 
+{}
+## Score:
+'''
+
+batch_relevant_prompt = '''
+We would like you to evaluate the relevance and interconnectivity between the intentions in each of the following groups separately.
+You should give an overall score of each group on a scale of 1 to 10, where a higher score indicates higher relevance and interconnectivity,
+while the lower the score, the less relevant they are.
+Please return a list of scores, one for each group in order, enclosed in [], without any other reasons.
+{}
+## Scores:
+'''
+
 alpaca_prompt = (
     "Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request."
     "### Instruction:"
@@ -0,0 +1,175 @@
+import os
+import json
+import math
+import random
+from itertools import combinations, islice
+from typing import Iterable, Iterator
+from utils import query, parse_list, logger
+from prompt import relevant_prompt, batch_relevant_prompt
+
+class RelevanceCache:
+    ''' This is a persistent cache of the relevance scores of the intent sets. '''
+    def __init__(self, cache_path: str = '../dataset/relevance.jsonl'):
+        '''
+        Usage:
+            The relevance score of each intent set (sorted) is appended to cache_path once it is scored by the LLM,
+            so that a set is never scored again, even across runs.
+            The scores of the pairs in a larger set bound its relevance,
+            if any pair of the set is not relevant, the set is not relevant without asking the LLM.
+
+        Parameters:
+            :cache_path: the path of the jsonl cache, each line is {"queries": [...], "score": 8}
+        '''
+        self.cache_path = cache_path
+        self.scores = {}        # tuple of the sorted intents -> score
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        js = json.loads(line)
+                    except json.JSONDecodeError:       # the torn tail of an interrupted write
+                        continue
+                    self.scores[self.key(js['queries'])] = js['score']
+        dirname = os.path.dirname(cache_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.f = open(cache_path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def key(queries: Iterable[str]) -> tuple:
+        return tuple(sorted(queries))
+
+    def add(self, queries: list[str], score: float):
+        self.scores[self.key(queries)] = score
+        self.f.write(json.dumps({'queries': list(self.key(queries)), 'score': score}, ensure_ascii=False) + '\n')
+        self.f.flush()
+
+    def bound(self, queries: list[str]) -> float:
+        '''
+        Usage:
+            The lowest score of the pairs of the set that have been scored, or None if none of them is scored.
+        '''
+        scores = [self.scores[pair] for pair in combinations(self.key(queries), 2) if pair in self.scores]
+        return min(scores) if scores else None
+
+    def relevant(self, queries: list[str], min_rel_score: float) -> bool:
+        '''
+        Usage:
+            Whether the intents are relevant by the cache, a single intent is always relevant.
+
+        Returns:
+            True or False, or None if it is unknown and should be scored by the LLM.
+        '''
+        if len(queries) <= 1:
+            return True
+        score = self.scores.get(self.key(queries))
+        if score is not None:
+            return score >= min_rel_score
+        bound = self.bound(queries)
+        if bound is not None and bound < min_rel_score:
+            return False
+        return None
+
+    def score(self, batch: list[list[str]], max_batch: int = 20):
+        '''
+        Usage:
+            Score the intent sets that are not in the cache, max_batch sets in one prompt.
+            If the response of a batch is invalid, the sets are scored one by one by relevant_prompt.
+        '''
+        batch = list({self.key(queries): queries for queries in batch if self.key(queries) not in self.scores}.values())
+        for i in range(0, len(batch), max_batch):
+            chunk = batch[i:i + max_batch]
+            groups = ''.join(f"## Group {j + 1}: {queries}\n" for j, queries in enumerate(chunk))
+            scores = parse_list(query(batch_relevant_prompt.format(groups))) if len(chunk) > 1 else []
+            if len(scores) == len(chunk) and all(isinstance(score, (int, float)) for score in scores):
+                for queries, score in zip(chunk, scores):
+                    self.add(queries, score)
+                continue
+            if len(chunk) > 1:
+                logger.error(f"🐞 Invalid batch relevance response, score the {len(chunk)} sets one by one")
+            for queries in chunk:
+                response = query(relevant_prompt.format(str(queries)))
+                if not response or len(response) > 10 or not response.strip().isdigit():
+                    logger.error(f"🤔 The response is not valid")
+                    continue
+                self.add(queries, int(response.strip()))
+
+    def close(self):
+        self.f.close()
+
+class CombinationSampler:
+    ''' This is a sampler that draws distinct combinations of the items lazily. '''
+    def __init__(self, items: Iterable[str], max_size: int, rng: random.Random = None, exclude: Iterable[tuple] = ()):
+        '''
+        Usage:
+            Draw combinations of 1 to max_size items in a random order without repeats and without rejection:
+            the size is drawn uniformly among the sizes that have combinations left,
+            then a combination of the size is drawn by a sparse Fisher–Yates shuffle over the ranks of the combinations,
+            and the rank is unranked into the combination, so only the drawn ranks are kept in memory.
+
+        Parameters:
+            :items: the items to combine, e.g. the queries of the mapping
+            :max_size: the maximum size of a combination
+            :rng: the random.Random to draw, seed it to draw the same combinations
+            :exclude: the combinations (tuple of sorted items) that should not be drawn, e.g. the ones in the existing output
+        '''
+        self.items = sorted(set(items))
+        self.rng = rng or random.Random()
+        self.exclude = set(exclude)
+        self.totals = {k: math.comb(len(self.items), k) for k in range(1, min(max_size, len(self.items)) + 1)}
+        self.drawn = {k: 0 for k in self.totals}
+        self.swaps = {k: {} for k in self.totals}      # the sparse permutation of the ranks of each size
+
+    def unrank(self, rank: int, k: int) -> list[str]:
+        ''' The combination of k items at rank in the lexicographic order. '''
+        n, combination, start = len(self.items), [], 0
+        for left in range(k, 0, -1):
+            for c in range(start, n):
+                count = math.comb(n - c - 1, left - 1)
+                if rank < count:
+                    combination.append(self.items[c])
+                    start = c + 1
+                    break
+                rank -= count
+        return combination
+
+    def __iter__(self) -> Iterator[list[str]]:
+        return self
+
+    def __next__(self) -> list[str]:
+        while True:
+            sizes = [k for k in self.totals if self.drawn[k] < self.totals[k]]
+            if not sizes:
+                raise StopIteration
+            k = self.rng.choice(sizes)
+            i, swaps = self.drawn[k], self.swaps[k]
+            j = self.rng.randrange(i, self.totals[k])
+            rank = swaps.get(j, j)
+            swaps[j] = swaps.pop(i, i)
+            self.drawn[k] += 1
+            combination = self.unrank(rank, k)
+            if tuple(combination) not in self.exclude:
+                return combination
+
+def relevant_combinations(
+    sampler: CombinationSampler,
+    cache: RelevanceCache,
+    min_rel_score: float = 7,
+    batch_size: int = 20
+) -> Iterator[list[str]]:
+    '''
+    Usage:
+        Draw batch_size combinations at a time, score the unknown ones in batched prompts,
+        and yield the relevant ones in the drawn order.
+    '''
+    while True:
+        batch = list(islice(sampler, batch_size))
+        if not batch:
+            return
+        cache.score([queries for queries in batch if cache.relevant(queries, min_rel_score) is None])
+        for queries in batch:
+            if cache.relevant(queries, min_rel_score):
+                yield queries
+            else:
+                score = cache.scores.get(cache.key(queries), cache.bound(queries))
+                logger.warning(f"☠️ The relevantness of query set is too low: {queries} => {score}")
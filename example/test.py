@@ -11,5 +11,5 @@ model, tokenizer = FastLanguageModel.from_pretrained(
 )
 FastLanguageModel.for_inference(model)
 
-evaluator = Evaluator(model, tokenizer, 100)
+evaluator = Evaluator(model, tokenizer, 100, cache_dir="../dataset/eval_cache")   # re-evaluating the same model is read from the cache
 result = evaluator.evaluate(test_file_path="../dataset/test.jsonl")
\ No newline at end of file
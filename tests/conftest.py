@@ -0,0 +1,29 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import pytest
+
+CHARS = "abcdefghijklmnopqrstuvwxyz[]\",#: 0123456789'\n"
+
+@pytest.fixture(scope='session')
+def tiny_tokenizer():
+    ''' A character-level tokenizer, so that any text is tokenized the same with and without a prefix, and decoded back as it is. '''
+    tokenizers = pytest.importorskip('tokenizers')
+    transformers = pytest.importorskip('transformers')
+    vocab = {'<pad>': 0, '<eos>': 1, '<unk>': 2}
+    for c in CHARS:
+        vocab.setdefault(c, len(vocab))
+    tok = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token='<unk>'))
+    tok.pre_tokenizer = tokenizers.pre_tokenizers.Split('', 'isolated')
+    tok.decoder = tokenizers.decoders.Fuse()
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=tok, eos_token='<eos>', pad_token='<pad>', unk_token='<unk>')
+
+@pytest.fixture(scope='session')
+def tiny_llama(tiny_tokenizer):
+    ''' A random tiny Llama of the character-level tokenizer. '''
+    torch = pytest.importorskip('torch')
+    transformers = pytest.importorskip('transformers')
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=len(tiny_tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512, eos_token_id=1, pad_token_id=0, bos_token_id=None)
+    return transformers.LlamaForCausalLM(config), tiny_tokenizer
@@ -0,0 +1,61 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import pytest
+pytest.importorskip('numpy')
+from columnar import ColumnarWriter, ColumnarDataset, write_columnar, is_columnar
+from reader import iter_records
+
+RECORDS = [
+    {'instruction': '#意图列表#: [...]', 'input': '帮我领红包', 'output': ['组团领红包', '小云果园'], 'score': 0.5},
+    {'instruction': '#意图列表#: [...]', 'input': '', 'output': [], 'score': None, 'meta': {'seed': 1, 'tags': ['a']}},
+    {'instruction': 'another instruction', 'input': '云朵大作战 🎈', 'output': ['云朵大作战']},
+    {'input': 'no instruction', 'output': ['小云果园'], 'meta': [1, 2]},
+]
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'train.col')
+    assert write_columnar(RECORDS, path) == len(RECORDS)
+    assert is_columnar(path)
+    dataset = ColumnarDataset(path)
+    assert len(dataset) == len(RECORDS)
+    assert list(dataset) == RECORDS
+    assert dataset[-1] == RECORDS[-1]
+    assert list(iter_records(path)) == RECORDS
+    assert list(iter_records(path, offset=2)) == RECORDS[2:]
+    assert dataset.columns['instruction']['type'] == 'dict'
+    assert dataset.columns['output']['type'] == 'labels'
+    with pytest.raises(IndexError):
+        dataset[len(RECORDS)]
+
+def test_append_and_truncate(tmp_path):
+    path = str(tmp_path / 'train.col')
+    writer = ColumnarWriter(path)
+    for js in RECORDS[:2]:
+        writer.write(js)
+    assert writer.commit() == 2
+    for js in RECORDS[2:]:          # written to the disk but not committed, e.g. killed before the commit
+        writer.write(js)
+    for files in writer._files.values():
+        for f in files.values():
+            f.close()
+    assert len(ColumnarDataset(path)) == 2
+
+    writer = ColumnarWriter(path, rows=2)
+    for js in RECORDS[2:] + RECORDS[:1]:
+        writer.write(js)
+    assert writer.close() == 5
+    assert list(ColumnarDataset(path)) == RECORDS + RECORDS[:1]
+
+def test_invalid_value(tmp_path):
+    writer = ColumnarWriter(str(tmp_path / 'train.col'))
+    writer.write(RECORDS[0])
+    with pytest.raises(ValueError):
+        writer.write({'output': 'not a list'})
+
+def test_to_hf(tmp_path):
+    pytest.importorskip('datasets')
+    path = str(tmp_path / 'train.col')
+    records = [{'input': js['input'], 'output': js['output']} for js in RECORDS]
+    write_columnar(records, path)
+    assert ColumnarDataset(path).to_hf().to_list() == records
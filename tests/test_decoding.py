@@ -0,0 +1,101 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import ast
+import random
+import itertools
+import pytest
+torch = pytest.importorskip('torch')
+tokenizers = pytest.importorskip('tokenizers')
+from transformers import PreTrainedTokenizerFast
+from decoding import LabelListGrammar, BracketStoppingCriteria
+from evaluate import ABCEvaluator
+
+CHAR_LABELS = ['abc', 'ab', 'b c']
+BPE_LABELS = ['云朵中心', '小云果园', 'AI新头像', '组团领红包', 'abc', 'ab']
+
+class Evaluator(ABCEvaluator):
+    def prompt(self, data):
+        return f"## input: {data['input']}\n## output:"
+
+    def parse(self, output, data):
+        return output.split('## output:')[-1], data['output']
+
+    def metric(self, pred, gold):
+        return {'accuracy': float(pred == gold)}
+
+    def is_wrong(self, pred, gold):
+        return pred != gold
+
+@pytest.fixture(scope='module')
+def bpe_tokenizer():
+    ''' A byte-level BPE tokenizer trained on the rendered lists, so the tokens are merged across the brackets, the quotes and sep. '''
+    rng = random.Random(0)
+    tok = tokenizers.Tokenizer(tokenizers.models.BPE())
+    tok.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = tokenizers.decoders.ByteLevel()
+    corpus = [str(rng.sample(BPE_LABELS, rng.randint(0, 3))) for _ in range(2000)]
+    trainer = tokenizers.trainers.BpeTrainer(vocab_size=400, special_tokens=['<eos>'], initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet())
+    tok.train_from_iterator(corpus, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tok, eos_token='<eos>')
+
+def rendered_lists(labels: list[str], n: int = 3) -> list[str]:
+    return [str(list(p)) for k in range(n + 1) for p in itertools.permutations(labels, k)]
+
+def random_walk(grammar: LabelListGrammar, tokenizer, seed: int, limit: int = 200) -> list[int]:
+    ''' Generate by picking a random allowed token at each step until eos, return the generated ids without eos. '''
+    rng, generated = random.Random(seed), []
+    for _ in range(limit):
+        token = rng.choice(grammar.allowed_tokens(generated))
+        if token == tokenizer.eos_token_id:
+            return generated
+        generated.append(token)
+    raise AssertionError(f"No eos after {limit} tokens: {tokenizer.decode(generated)!r}")
+
+def test_constrained_greedy_parses_to_known_labels(tiny_llama):
+    model, tokenizer = tiny_llama
+    records = [{'input': 'abc' * (i % 5 + 1) + str(i), 'output': "['abc']"} for i in range(9)]
+    for batch_size in (1, 4):
+        evaluator = Evaluator(model, tokenizer, max_new_tokens=64, do_sample=False, device='cpu', batch_size=batch_size, labels=CHAR_LABELS)
+        for _, (pred, _) in evaluator._predict_all(records):
+            assert all(label in CHAR_LABELS for label in ast.literal_eval(pred)), pred
+
+@pytest.mark.parametrize('name', ['char', 'bpe'])
+def test_constrained_walks_parse_to_known_labels(name, tiny_tokenizer, bpe_tokenizer):
+    tokenizer, labels = (tiny_tokenizer, CHAR_LABELS) if name == 'char' else (bpe_tokenizer, BPE_LABELS)
+    grammar = LabelListGrammar(tokenizer, labels)
+    for seed in range(50):
+        generated = random_walk(grammar, tokenizer, seed)
+        text = tokenizer.decode(generated)
+        assert all(label in labels for label in ast.literal_eval(text)), text
+        assert tokenizer(text, add_special_tokens=False)['input_ids'] == generated      # the canonical tokenization
+
+@pytest.mark.parametrize('name', ['char', 'bpe'])
+def test_eos_only_after_bracket(name, tiny_tokenizer, bpe_tokenizer):
+    tokenizer, labels = (tiny_tokenizer, CHAR_LABELS) if name == 'char' else (bpe_tokenizer, BPE_LABELS)
+    grammar = LabelListGrammar(tokenizer, labels)
+    for text in rendered_lists(labels):
+        ids = tokenizer(text, add_special_tokens=False)['input_ids']
+        for i in range(len(ids) + 1):
+            allowed = grammar.allowed_tokens(ids[:i])
+            if i < len(ids):
+                assert ids[i] in allowed, (text, tokenizer.decode(ids[:i]))     # the canonical tokenization is allowed
+            assert (tokenizer.eos_token_id in allowed) == (i == len(ids)), (text, tokenizer.decode(ids[:i]))
+        assert grammar.allowed_tokens(ids + [tokenizer.eos_token_id]) == [tokenizer.eos_token_id]
+
+@pytest.mark.parametrize('text', ['hello', "['zzz", "['abc'x", "['abc']]"])
+def test_unconstrained_prefix_falls_back_to_vocabulary(text, tiny_tokenizer):
+    grammar = LabelListGrammar(tiny_tokenizer, CHAR_LABELS)
+    ids = tiny_tokenizer(text, add_special_tokens=False)['input_ids']
+    assert grammar.completions(text) is None
+    assert grammar.allowed_tokens(ids) == list(range(len(tiny_tokenizer)))
+
+def test_bracket_stopping_criteria(tiny_tokenizer):
+    prompt = "[x] ## output:"
+    start = len(tiny_tokenizer(prompt)['input_ids'])
+    criteria = BracketStoppingCriteria(tiny_tokenizer, start)
+    outputs = ["['ab", "['ab']", "]['ab'", "['ab', 'abc']"]
+    ids = [tiny_tokenizer(prompt + output)['input_ids'] for output in outputs]
+    width = max(len(row) for row in ids)
+    input_ids = torch.tensor([row + [tiny_tokenizer.pad_token_id] * (width - len(row)) for row in ids])
+    assert criteria(input_ids, None).tolist() == [False, True, False, True]
@@ -0,0 +1,49 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import pytest
+torch = pytest.importorskip('torch')
+from evaluate import ABCEvaluator
+
+PREFIX = "## instruction: list the intents\n"
+
+class Evaluator(ABCEvaluator):
+    def prompt(self, data):
+        return f"{PREFIX}## input: {data['input']}\n## output:"
+
+    def parse(self, output, data):
+        return output.split('## output:')[-1], data['output']
+
+    def metric(self, pred, gold):
+        return {'accuracy': float(pred == gold)}
+
+    def is_wrong(self, pred, gold):
+        return pred != gold
+
+@pytest.fixture(scope='module')
+def records():
+    return [{'input': 'abc' * (i % 5 + 1) + str(i), 'output': "['a']"} for i in range(13)]
+
+def test_batched_equals_single(tiny_llama, records):
+    model, tokenizer = tiny_llama
+    single = Evaluator(model, tokenizer, max_new_tokens=8, do_sample=False, device='cpu')
+    batched = Evaluator(model, tokenizer, max_new_tokens=8, do_sample=False, device='cpu', batch_size=4)
+    expected = [single.forward(data) for data in records]
+    assert [result for _, result in batched._predict_all(records)] == expected
+
+def test_prefix_cache_equals_uncached(tiny_llama, records):
+    model, tokenizer = tiny_llama
+    uncached = Evaluator(model, tokenizer, max_new_tokens=8, do_sample=False, device='cpu', batch_size=4)
+    cached = Evaluator(model, tokenizer, max_new_tokens=8, do_sample=False, device='cpu', batch_size=4)
+    cached.set_prefix(PREFIX)
+    expected = [result for _, result in uncached._predict_all(records)]
+    assert [result for _, result in cached._predict_all(records)] == expected
+    assert cached._prefix_cache, 'the prompts should be generated from the prefix cache'
+
+def test_encodings_are_released(tiny_llama, records):
+    model, tokenizer = tiny_llama
+    evaluator = Evaluator(model, tokenizer, max_new_tokens=2, do_sample=False, device='cpu', batch_size=4)
+    evaluator.inference_batch([evaluator.prompt(data) for data in records[:3]])
+    assert evaluator._encodings is None
+    list(evaluator._predict_all(records))
+    assert evaluator._encodings is None
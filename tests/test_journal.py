@@ -0,0 +1,75 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import pytest
+pytest.importorskip('openai')
+pytest.importorskip('dotenv')
+from writer import RecordWriter
+from reader import iter_records
+
+@pytest.fixture(scope='module')
+def Journal(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('cwd'))        # utils adds its log file under ./logs at import
+    try:
+        from utils import Journal
+    finally:
+        os.chdir(cwd)
+    return Journal
+
+def seed_records(idx: int) -> list[dict]:
+    return [{'input': f'seed {idx} - {k}', 'output': ['label']} for k in range(2)]
+
+def test_resume_from_last_commit(tmp_path, Journal):
+    path = str(tmp_path / 'train.jsonl')
+    journal, writer = Journal(path), RecordWriter(path)
+    for idx in range(1, 4):
+        for js in seed_records(idx):
+            writer.put(js)
+        journal.update(idx, [{'input': f'pool {idx}'}], writer)
+    for js in seed_records(4):      # interrupted in the middle of the 4th seed
+        writer.put(js)
+    writer.close()
+
+    journal = Journal(path)
+    assert journal.last_idx == 3
+    assert journal.pool == [{'input': 'pool 3'}]
+    writer = RecordWriter(path, position=journal.offset)
+    writer.close()
+    assert list(iter_records(path)) == [js for idx in range(1, 4) for js in seed_records(idx)]
+
+def test_stale_update_is_dropped(tmp_path, Journal):
+    path = str(tmp_path / 'train.jsonl')
+    journal, writer = Journal(path, commit_interval=2), RecordWriter(path)
+    for js in seed_records(1):
+        writer.put(js)
+    journal.update(1, [], writer)
+    writer.put(seed_records(2)[0])      # the output no longer matches the pending update
+    journal.close()
+    writer.close()
+    assert Journal(path).last_idx == 0
+
+def test_done_seeds_and_torn_tail(tmp_path, Journal):
+    path = str(tmp_path / 'train.jsonl')
+    journal, writer = Journal(path), RecordWriter(path)
+    for js in seed_records(1):
+        writer.put(js)
+    journal.update(2, [], writer, done=[4, 3])
+    journal.close()
+    writer.close()
+    with open(tmp_path / 'augment.journal', 'a', encoding='utf-8') as f:
+        f.write('{"filename": "train.jsonl", "idx": 9')      # the torn tail of an interrupted write
+
+    journal = Journal(path)
+    assert journal.last_idx == 2
+    assert journal.state['done'] == [3, 4]
+
+def test_outputs_share_the_journal(tmp_path, Journal):
+    paths = [str(tmp_path / 'a.jsonl'), str(tmp_path / 'b.jsonl')]
+    for i, path in enumerate(paths):
+        journal, writer = Journal(path), RecordWriter(path)
+        writer.put(seed_records(i)[0])
+        journal.update(i + 1, [], writer)
+        journal.close()
+        writer.close()
+    assert [Journal(path).last_idx for path in paths] == [1, 2]
@@ -0,0 +1,26 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import pytest
+from metrics import MultiLabelMetrics
+
+def test_unknown_labels_do_not_match_each_other():
+    metrics = MultiLabelMetrics(['a', 'b'])
+    assert metrics.add(['foo'], ['bar']) == {'precision': 0.0, 'recall': 0.0, 'f1_score': 0.0}
+    result, _ = metrics.compute()
+    assert result['f1_score'] == 0.0
+    assert result['exact_match'] == 0.0
+
+def test_each_unknown_label_is_a_false_positive():
+    metrics = MultiLabelMetrics(['a', 'b'])
+    assert metrics.add(['a', 'x', 'y'], ['a'])['precision'] == pytest.approx(1 / 3)
+    result, report = metrics.compute()
+    assert result['micro_precision'] == pytest.approx(1 / 3)
+    assert result['macro_precision'] == 1.0         # the unknown labels are not averaged
+    assert report['per_intent']['x']['predicted'] == 1
+
+def test_same_unknown_label_matches():
+    metrics = MultiLabelMetrics(['a'])
+    metrics.add(['z'], ['z'])
+    result, _ = metrics.compute()
+    assert result['exact_match'] == 1.0
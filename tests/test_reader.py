@@ -0,0 +1,60 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import gzip
+import json
+import pytest
+import reader
+from reader import iter_records
+from writer import RecordWriter
+
+RECORDS = [{'input': f'小云果园 {i} ' + '界' * (i * 7), 'output': [f'label{i}'], 'nested': {'a': [1, {'b': ']'}]}} for i in range(12)]
+
+def write(path: str, fmt: str):
+    if fmt == 'array':
+        text = json.dumps(RECORDS, ensure_ascii=False, indent=4)
+    else:
+        text = ''.join(json.dumps(js, ensure_ascii=False, indent=4 if fmt == 'indent' else None) + '\n' for js in RECORDS)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        f.write(text)
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(reader, 'CHUNK_SIZE', 7)        # the records and the utf-8 characters are split across the chunks
+
+@pytest.mark.parametrize('fmt', ['array', 'jsonl', 'indent'])
+@pytest.mark.parametrize('ext', ['.json', '.json.gz'])
+def test_formats(tmp_path, fmt, ext):
+    path = str(tmp_path / f'train{ext}')
+    write(path, fmt)
+    assert list(iter_records(path)) == RECORDS
+
+@pytest.mark.parametrize('fmt', ['array', 'jsonl', 'indent'])
+@pytest.mark.parametrize('ext', ['.json', '.json.gz'])
+def test_resume_from_offset(tmp_path, fmt, ext):
+    path = str(tmp_path / f'train{ext}')
+    write(path, fmt)
+    offsets = [offset for offset, _ in iter_records(path, with_offset=True)]
+    for i, offset in enumerate(offsets):
+        assert list(iter_records(path, offset=offset)) == RECORDS[i + 1:]
+
+def test_sharded_output(tmp_path):
+    path = str(tmp_path / 'train.jsonl')
+    writer = RecordWriter(path, compression='gzip', shard_records=5)
+    for js in RECORDS:
+        writer.put(js)
+    writer.close()
+    assert len(reader.resolve_files(path)) == 3
+    assert reader.exists(path) and not os.path.exists(path)
+    assert list(iter_records(path)) == RECORDS
+    with pytest.raises(ValueError):
+        next(iter_records(path, offset=1))
+
+def test_invalid_record(tmp_path):
+    path = tmp_path / 'train.jsonl'
+    path.write_text(json.dumps(RECORDS[0]) + '\n"text"\n', encoding='utf-8')
+    records = iter_records(str(path))
+    assert next(records) == RECORDS[0]
+    with pytest.raises(ValueError):
+        next(records)
@@ -0,0 +1,63 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abstract'))
+import pytest
+datasets = pytest.importorskip('datasets')
+from tokenCache import TokenizedDatasetCache
+
+TEMPLATE = "## input: {}\n## output: {}"
+
+def formatting_prompts_func(examples, EOS):
+    return {'text': [TEMPLATE.format(i, o) + EOS for i, o in zip(examples['input'], examples['output'])]}
+
+def records(n: int, changed: int = None) -> 'datasets.Dataset':
+    rows = [{'input': f'abc {i}', 'output': "['a']" if i != changed else "['b']"} for i in range(n)]
+    return datasets.Dataset.from_list(rows)
+
+def expected(tokenizer, dataset) -> list[list[int]]:
+    texts = formatting_prompts_func(dataset.to_dict(), tokenizer.eos_token)['text']
+    return tokenizer(texts, truncation=True, max_length=32)['input_ids']
+
+def test_only_appended_records_are_processed(tmp_path, tiny_tokenizer):
+    cache = TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32)
+    cache.update(records(5))
+    tokenized = cache.update(records(8))
+    assert [shard['rows'] for shard in cache.shards] == [5, 3]
+    assert tokenized['input_ids'] == expected(tiny_tokenizer, records(8))
+
+    cache = TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32)
+    tokenized = cache.update(records(8))
+    assert [shard['rows'] for shard in cache.shards] == [5, 3]      # reused, nothing is processed
+    assert tokenized['input_ids'] == expected(tiny_tokenizer, records(8))
+
+@pytest.mark.parametrize('dataset', [records(8, changed=0), records(8, changed=7), records(3)], ids=['first', 'last', 'shrunk'])
+def test_rewritten_file_is_rebuilt(tmp_path, tiny_tokenizer, dataset):
+    cache = TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32)
+    cache.update(records(5))
+    cache.update(records(8))
+    tokenized = cache.update(dataset)
+    assert [shard['rows'] for shard in cache.shards] == [len(dataset)]
+    assert tokenized['input_ids'] == expected(tiny_tokenizer, dataset)
+
+def test_changes_clear_the_cache(tmp_path, tiny_tokenizer, monkeypatch):
+    TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32).update(records(5))
+    assert TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32).rows == 5
+    assert TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 16).rows == 0
+
+    TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32).update(records(5))
+    assert TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32, version='v2').rows == 0
+
+    TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32).update(records(5))
+    monkeypatch.setitem(formatting_prompts_func.__globals__, 'TEMPLATE', "## input: {}\n## answer: {}")
+    cache = TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32)
+    assert cache.rows == 0
+    assert cache.update(records(5))['input_ids'] == expected(tiny_tokenizer, records(5))
+
+def test_clear_keeps_other_files(tmp_path, tiny_tokenizer):
+    (tmp_path / 'notes.txt').write_text('kept', encoding='utf-8')
+    cache = TokenizedDatasetCache(str(tmp_path), tiny_tokenizer, formatting_prompts_func, 32)
+    cache.update(records(5))
+    assert os.path.isdir(tmp_path / 'shard-00000')
+    cache.clear()
+    assert sorted(os.listdir(tmp_path)) == ['notes.txt']
+    assert len(cache.update(records(0))) == 0